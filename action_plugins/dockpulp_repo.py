@@ -0,0 +1,177 @@
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import json
+
+from ansible.errors import AnsibleError
+from ansible.module_utils.six import string_types
+from ansible.parsing.mod_args import ModuleArgsParser
+from ansible.plugins.action import ActionBase
+from ansible.template import Templar
+from ansible.utils.display import Display
+
+display = Display()
+
+REPO_ARGS = ("repo_name", "namespace", "content_url", "description", "distribution")
+
+# The results of the batched loops of this worker process, by task and host.
+# Ansible runs all the items of a loop in the same worker process, one
+# action plugin instance per item.
+BATCHES = {}
+
+
+def args_key(args):
+    """The key of the module args of a loop item"""
+    return json.dumps(args, sort_keys=True, default=str)
+
+
+def valid_repo(args):
+    """Check the repo of a loop item like dockpulp_repos does, which fails
+    without changing any repo when one of its repos is invalid"""
+    if not all(args.get(key) and isinstance(args[key], string_types) for key in REPO_ARGS):
+        return False
+    content_url = args["content_url"]
+    return content_url.startswith("/content") and content_url.rstrip("/").endswith(
+        args["repo_name"]
+    )
+
+
+class ActionModule(ActionBase):
+    """Run the dockpulp_repo tasks of a loop as one dockpulp_repos module run.
+
+    On the first item of a loop, the module args of every item are
+    templated, and the repos with the same env, credentials and settings
+    are ensured by a single dockpulp_repos module, sharing one login and
+    one inventory lookup. Its changes are still applied one at a time, like
+    the items of a loop. Every item then returns its own result from the
+    batch. Tasks outside of a loop, loops this plugin can't template ahead
+    (with_* lookups, extended loop vars, async) or with a list of envs, and
+    the items with an invalid repo, run the dockpulp_repo module as usual.
+    """
+
+    TRANSFERS_FILES = False
+    _supports_check_mode = True
+    _supports_async = True
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp
+
+        batch = self._get_batch(task_vars or {})
+        key = args_key(self._task.args)
+        if batch is not None and key in batch:
+            result.update(batch[key])
+            return result
+
+        wrap_async = self._task.async_val and not self._connection.has_native_async
+        result.update(self._execute_module(task_vars=task_vars, wrap_async=wrap_async))
+        if not wrap_async:
+            self._remove_tmp_path(self._connection._shell.tmpdir)
+        return result
+
+    def _get_batch(self, task_vars):
+        """The results of the batch of the current loop, run on its first item.
+        Returns:
+            A dictionary of results by args_key, None when not batched
+        """
+        task = self._task
+        extended = getattr(task.loop_control, "extended", False)
+        if task._ds.get("loop") is None or task.async_val or extended:
+            return None
+
+        cache_key = (task._uuid, task_vars.get("inventory_hostname"))
+        if cache_key not in BATCHES:
+            try:
+                BATCHES[cache_key] = self._run_batch(task_vars)
+            except Exception as e:
+                # Run one module per item, which reports its own errors
+                display.vvv("dockpulp_repo: not batching the loop: %s" % e)
+                BATCHES[cache_key] = None
+        return BATCHES[cache_key]
+
+    def _loop_args(self, task_vars):
+        """Template the module args of every item of the loop.
+        Returns:
+            A list of module args, without the items skipped by "when"
+        """
+        task = self._task
+        loop_var = task_vars.get("ansible_loop_var", "item")
+        index_var = task_vars.get("ansible_index_var")
+        # The loop and the args of the task were templated for the current
+        # item, take them from the task's data structure
+        parser_args = {}
+        if hasattr(task, "collections"):
+            parser_args["collection_list"] = task.collections
+        raw_args = ModuleArgsParser(task._ds, **parser_args).parse()[1]
+
+        items = Templar(loader=self._loader, variables=task_vars).template(task._ds.get("loop"))
+        if not isinstance(items, list):
+            raise AnsibleError("the loop of %s is not a list" % task.get_name())
+
+        loop_args = []
+        for index, item in enumerate(items):
+            item_vars = dict(task_vars)
+            item_vars[loop_var] = item
+            if index_var:
+                item_vars[index_var] = index
+            templar = Templar(loader=self._loader, variables=item_vars)
+            if task.when and not task.evaluate_conditional(templar, item_vars):
+                continue
+            args = templar.template(raw_args)
+            if isinstance(args.get("env"), list):
+                # dockpulp_repos ensures its repos in a single env
+                raise AnsibleError("the env of %s is a list" % task.get_name())
+            # Keep the values of module_defaults, merged in the current args
+            for key, value in self._task.args.items():
+                args.setdefault(key, value)
+            loop_args.append(args)
+        return loop_args
+
+    def _run_batch(self, task_vars):
+        """Ensure the repos of every item, one dockpulp_repos run per group
+        of items sharing the same env, credentials and settings.
+        Returns:
+            A dictionary of results by args_key
+        """
+        groups = {}
+        for args in self._loop_args(task_vars):
+            if not valid_repo(args):
+                # Left to its own dockpulp_repo module, to fail alone
+                continue
+            shared = {key: value for key, value in args.items() if key not in REPO_ARGS}
+            group = groups.setdefault(args_key(shared), (shared, []))
+            group[1].append(args)
+
+        # dockpulp_repos, in the same collection as the task's module
+        collection, dot, _ = self._task.action.rpartition(".")
+        module_name = collection + dot + "dockpulp_repos"
+        batch = {}
+        for shared, items in groups.values():
+            repos = [{key: args.get(key) for key in REPO_ARGS} for args in items]
+            display.vvv("dockpulp_repo: ensuring %d repos in one batch" % len(repos))
+            module_result = self._execute_module(
+                module_name=module_name,
+                module_args=dict(shared, repos=repos, max_workers=1),
+                task_vars=task_vars,
+            )
+            self._remove_tmp_path(self._connection._shell.tmpdir)
+            for index, args in enumerate(items):
+                batch[args_key(args)] = self._item_result(module_result, index)
+        return batch
+
+    def _item_result(self, module_result, index):
+        """The dockpulp_repo result of one repo of a dockpulp_repos result"""
+        results = module_result.get("results")
+        if not results:
+            # The whole batch failed, before ensuring any repo
+            return {key: value for key, value in module_result.items() if key != "invocation"}
+        result = dict(results[index])
+        result.pop("repo_name", None)
+        result.pop("full_repo_name", None)
+        if result.get("returncode") or result.get("msg"):
+            result["failed"] = True
+        for key in ("backend", "metrics"):
+            if key in module_result:
+                result[key] = module_result[key]
+        return result
@@ -1,6 +1,16 @@
-import subprocess
-from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.dockpulp_common import diff_settings, describe_changes
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+from ansible.module_utils.dockpulp_backend import BACKEND_CHOICES, HAS_DOCKPULP, select_backend
+from ansible.module_utils.dockpulp_cache import SESSION_TTL
+from ansible.module_utils.dockpulp_common import (
+    ENGINE_CHOICES,
+    INVENTORY_FILE_MAX_AGE,
+    ensure_dockpulp_repo,
+    ensure_dockpulp_repo_envs,
+    load_offline_inventory,
+    validate_content_url,
+)
+from ansible.module_utils.dockpulp_http import HAS_REQUESTS, HTTP_TIMEOUT, POOL_SIZE, TASK_TIMEOUT
+from ansible.module_utils.dockpulp_metrics import METRICS
 
 
 ANSIBLE_METADATA = {
@@ -10,7 +20,7 @@ ANSIBLE_METADATA = {
 }
 
 
-DOCUMENTATION = '''
+DOCUMENTATION = """
 ---
 module: dockpulp_repo
 
@@ -22,6 +32,9 @@ options:
      description:
        - The environment to run dock-pulp command, which is configured in /etc/dockpulp.conf
        - "Example: stage"
+       - A list of environments ensures the repo in all of them at once, and
+         returns the result of every env under "envs".
+     type: raw
    dockpulp_user:
        - The user to login to docker pulp server
    dockpulp_password:
@@ -60,13 +73,182 @@ options:
        - "Example: tech-preview"
      choices: [ga, tech-preview, tech-preview, beta]
      required: true
+   backend:
+     description:
+       - How to run the dock-pulp operations. "library" imports the dockpulp library
+         and calls its API in-process, "cli" runs the dock-pulp command for every
+         operation (the default), and "auto" uses the library when it is installed.
+       - "broker" calls the dockpulp library in a local broker process, started on
+         first use and shared by all the module processes of the user over a Unix
+         socket, which keeps the login between them. The broker exits after 5
+         minutes without a request.
+       - "rest" calls the Pulp v2 REST API in-process with the requests library,
+         over pooled HTTP connections kept alive between calls, see http.
+     choices: [auto, cli, library, broker, rest]
+     default: cli
+   wait:
+     description:
+       - Wait for the Pulp tasks spawned by the updates and deletes of the rest
+         backend. The tasks of all the repos are polled together, with a poll
+         interval growing from 0.1 to 5 seconds. A repo fails when its task fails,
+         or is still running after wait_timeout seconds.
+       - With false, the module returns once the changes are submitted, with the
+         task_ids of every changed repo, to check later with dockpulp_task_info.
+         The other backends return once their changes are over.
+     default: true
+     type: bool
+   wait_timeout:
+     description:
+       - Number of seconds to wait for the Pulp tasks of the run, with wait.
+     default: 600
+     type: int
+   http:
+     description:
+       - Settings of the HTTP connections of the rest backend. The connections,
+         their TLS sessions and their auth are reused by all the calls of the
+         module to the same server.
+     type: dict
+     suboptions:
+       url:
+         description:
+           - The URL of the Pulp server. Defaults to the server of the env in
+             /etc/dockpulp.conf.
+       pool_size:
+         description:
+           - Number of connections kept open to the server. Calls over it wait
+             for a free connection.
+         type: int
+         default: 10
+       keepalive:
+         description: Keep the connections open between calls.
+         type: bool
+         default: true
+       timeout:
+         description: Seconds allowed for one HTTP request.
+         type: int
+         default: 120
+   inventory_ttl:
+     description:
+       - Number of seconds a local snapshot of all the repos of the env is used
+         instead of looking up every repo on the server. The snapshot is taken with
+         one listing of the server, and kept up to date with the creates and
+         updates of the module. Set to 0 (the default) to look up every repo.
+     default: 0
+     type: int
+   inventory_file:
+     description:
+       - Path of an exported inventory snapshot of the env, to run check mode
+         against instead of the server, without logging in. The snapshot is a
+         JSON file with the repos by full repo name under "repos" and the time
+         they were listed under "fetched_at", like the inventory snapshots that
+         inventory_ttl keeps in the cache directory. Only supported in check mode.
+     type: path
+   inventory_file_max_age:
+     description:
+       - Number of seconds after which the snapshot of inventory_file is
+         reported as stale, with a warning.
+     default: 86400
+     type: int
+   fingerprint_max_age:
+     description:
+       - Number of seconds a repo applied with the same values is not looked up
+         again. A hash of the values of every repo found in line with the server,
+         or created or updated, is kept with the env and its time in a local
+         state file. Set to 0 (the default) to look up every repo.
+     default: 0
+     type: int
+   force_refresh:
+     description:
+       - Look up every repo, even the ones with a fingerprint younger than
+         fingerprint_max_age.
+     default: false
+     type: bool
+   metrics:
+     description:
+       - Return the wall time of the login, lookup, create and update phases, and
+         the number of dock-pulp commands run with the bytes of their output, as
+         "metrics" in the result.
+     default: false
+     type: bool
+   engine:
+     description:
+       - How to run the dock-pulp operations of the module. "sync" runs them with
+         a blocking call each. "asyncio" runs them from an event loop, each within
+         the timeouts of its operation.
+     choices: [sync, asyncio]
+     default: sync
+   timeouts:
+     description:
+       - Seconds allowed for every dock-pulp operation with the asyncio engine, by
+         operation. The operations not set are allowed 120 seconds.
+     type: dict
+     suboptions:
+       login:
+         description: Seconds allowed to log in.
+         type: int
+       lookup:
+         description: Seconds allowed to look up a repo, or a batch of repos.
+         type: int
+       create:
+         description: Seconds allowed to create a repo.
+         type: int
+       update:
+         description: Seconds allowed to update a repo.
+         type: int
+       delete:
+         description: Seconds allowed to delete a repo.
+         type: int
+   rate_limit:
+     description:
+       - Maximum number of dock-pulp calls per second to the env, on average, from
+         all the module processes of the host together, like the forks of a play.
+         The calls over the limit wait for their turn. Set to 0 (the default) for
+         no limit.
+     default: 0
+     type: float
+   rate_burst:
+     description:
+       - Number of dock-pulp calls allowed at once after an idle time, with
+         rate_limit. Defaults to rate_limit rounded up.
+     default: 0
+     type: int
+   adaptive_timeouts:
+     description:
+       - Record the duration of every dock-pulp call of the env in a rolling
+         histogram by operation, shared by the module processes of the host, and
+         lower the timeout of every call to 3 times the p99 duration of its
+         operation, at least 10 seconds. The timeouts stay unchanged until an
+         operation has about 20 recent calls.
+     default: false
+     type: bool
+   read_retries:
+     description:
+       - Number of retries of the dock-pulp lookups timing out or failing on the
+         way to the server, like a refused connection or a 503, after a random
+         backoff growing from 0.5 up to 10 seconds. Changes are never retried.
+         The lookups are not retried by default.
+     default: 0
+     type: int
+   circuit_breaker:
+     description:
+       - Number of consecutive dock-pulp calls to the env timing out or failing on
+         the way to the server after which its calls fail at once for 30 seconds,
+         from all the module processes of the host. Disabled by default, with 0.
+     default: 0
+     type: int
+   session_ttl:
+     description:
+       - Number of seconds a dock-pulp login is reused by later tasks, for the same
+         env and dockpulp_user. Set to 0 to always log in.
+     default: 28800
+     type: int
 requirements:
   - "python >= 3.6"
   - "lxml"
   - "requests-gssapi"
-'''
+"""
 
-EXAMPLES = '''
+EXAMPLES = """
 - name: create dockpulp repositories on rhel8
   hosts: localhost
   tasks:
@@ -93,301 +275,49 @@ EXAMPLES = '''
       content_url: /content/dist/containers/rhel9/multiarch/containers/redhat-rhceph-rhceph-4-rhel9
       description: This is a test repo for create dockpulp repo
       distribution: ga
-'''
-
-DOCK_PULP_TIMEOUT = 120
-
-UPDATE_MAP = {
-    "description": "--description",
-    "title": "--title",
-    "docker-id": "--dockerid",
-    "distribution": "--distribution",
-}
-
-LOGGED_IN = {
-    "qa": False,
-    "stage": False,
-    "prod": False,
-}
-
-COMPARABLES = ["description", "title", "docker-id", "distribution"]
-
-
-def login(env, dockpulp_user, dockpulp_password, timeout=DOCK_PULP_TIMEOUT):
-    """Login to docker pulp
-    Args:
-        env: The environment to log in to
-        timeout: Maximum number of seconds to wait for a result (default = 120)
-    Returns:
-        True if login is successful, False otherwise
-        stdout when the command is executed
-    """
-    command = [
-        "dock-pulp",
-        "-d",
-        "--server",
-        env,
-        "login",
-        "-u",
-        dockpulp_user,
-        "-p",
-        dockpulp_password,
-    ]
-    if LOGGED_IN[env]:
-        return LOGGED_IN[env], ""
-
-    returncode, stdout = execute_command(command, timeout)
-    if returncode == 0:
-        LOGGED_IN[env] = True
-    return LOGGED_IN[env], stdout
-
-
-def execute_command(command, timeout=DOCK_PULP_TIMEOUT):
-    """Execute a given command using the subprocess module
-    Args:
-        command (list): List of args for a command
-        timeout: Maximum number of seconds to wait for a result
-    Returns:
-        The CompletedProcess object from running the command
-    """
-    # Attempting dock-pulp command with args
-    # In python39, we use subprocess.run
-    # To support py27, we use subprocess.Popen
-    result = subprocess.Popen(
-        command,
-        encoding="utf8",
-        stderr=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-    )
-    outs, errs = result.communicate(timeout=timeout)
-    return result.poll(), outs + errs
-
-
-def create_command(env, dockpulp_repo):
-    """Build the command to create the repos based on the
-    current environment.
-    Args:
-        server: The environment to use
-        component (dict): The dockpulp repo to create
-    Returns:
-        The command required to create dock-pulp repository
-    """
-    repo_name = dockpulp_repo.get("repo_name")
-    distribution = dockpulp_repo.get("distribution")
-    description = dockpulp_repo.get("description")
-    namespace = dockpulp_repo.get("namespace")
-    content_url = dockpulp_repo.get("content_url")
-
-    command = [
-        "dock-pulp",
-        "--server",
-        env,
-        "create",
-        namespace,
-        repo_name,
-        content_url,
-        "--description=%s" % description,
-        "--distribution=%s" % distribution,
-    ]
-    return command
-
-
-def update_command(env, full_name, differences):
-    """Build the command to update a given repo
-    based on which fields need to be modified
-    Args:
-        server: Environment to run command on
-        full_name: the full repo name
-        modified (dict): A dictionary of changes
-    Returns:
-        The command to update an existing repository
-    """
-    command = [
-        "dock-pulp",
-        "--server",
-        env,
-        "update",
-        full_name,
-    ]
-    # Modified is in the form [('key', 'current_value', 'new_value')]
-    for key, _, new_value in differences:
-        line = "%s=%s" % (UPDATE_MAP.get(key), new_value)
-        command.append(line)
-    return command
-
-
-def get_comparable_repo(repo):
-    """Get a subset of comparable data from a repo.
-    HB can only change certain values so it's important to only compare those.
-    Args:
-        repo (dict): The repo to pull comparable values from
-    Returns:
-        A subset of the repo dict with only comparable values
-    """
-    if not repo:
-        return repo
-    return {key: value for key, value in repo.items() if key in COMPARABLES}
-
-
-def update_dockpulp_repo(env, full_repo_name, differences):
-    command = update_command(env, full_repo_name, differences)
-    _, stdout = execute_command(command)
-    returncode = 0 if "updating repo %s" % full_repo_name in stdout else 1
-    return returncode
-
-
-def create_dockpulp_repo(env, dockpulp_repo):
-    command = create_command(env, dockpulp_repo)
-    returncode, stdout = execute_command(command)
-    return returncode
-
-
-def parse_output(output):
-    """Parse the output of a dock-pulp command
-    Args:
-        output (str): The output of the dock-pulp command
-    Returns:
-        A dictionary with the results parsed
-    Example:
-        {'title': 'repo-name', 'distribution': 'ga'}
-    """
-    values = {}
-    lines = output.split("\n")
-    for line in lines:
-        if "=" in line:
-            parsed = line.strip("INFO").strip().split(" = ")
-            values[parsed[0]] = parsed[1]
-
-    return values
-
-
-def get_existing_repo(
-    full_repo_name, env, dockpulp_user, dockpulp_password, timeout=DOCK_PULP_TIMEOUT
-):
-    """Check that a Docker Pulp repo exists. If it does, return the result.
-    Args:
-        full_repo_name: the full name of the repo to check
-        server: 'stage', 'prod', 'qa'
-        timeout: maximum number of seconds allowed for the command to execute
-    Returns:
-        A dictonary representing the repo or None if it does not exist
-    """
-    login_succeed, stdout = login(env, dockpulp_user, dockpulp_password)
-    if not login_succeed:
-        raise RuntimeError("Error logging into dock-pulp: %s" % stdout)
-
-    command = ["dock-pulp", "-d", "--server", env, "list", "-d", full_repo_name]
-    returncode, stdout = execute_command(command)
-
-    if returncode != 0:
-        return None
-
-    return parse_output(stdout)
-
-
-def prepare_diff_data(dockpulp_repo, repo):
-    """Prepare diff data for result.
-    Args:
-        dockpulp_repo (dict): dockpulp repo from dockpulp server
-        repo (dict): Repo specified via module params
-    Returns:
-        A dictonary for comparing the existing repo and params
-    """
-    if dockpulp_repo:
-        before_header = dockpulp_repo["docker-id"]
-        after_header = repo["docker-id"]
-    else:
-        before_header = "Not present"
-        after_header = "New container repository %s" % repo["docker-id"]
-
-        # Need to use an empty dict instead of None otherwise
-        # ansible's built-in diff callback will throw errors
-        # trying to call splitlines() on it
-        dockpulp_repo = {}
-
-    return {
-        "before_header": before_header,
-        "after_header": after_header,
-        "before": dockpulp_repo,
-        "after": repo,
-    }
-
-
-def ensure_dockpulp_repo(params, check_mode=True):
-    """Ensure that this CDN repo exists in the Docker pulp server.
-    Args:
-        param params({}): The dockpulp repo to create
-        check_mode (bool): describe what would happen, but don't do it.
-    Returns:
-        A dictonary for ansible result
-    """
-    result = {"returncode": 0, "changed": False, "stdout_lines": []}
-    env = params.get("env")
-    dockpulp_user = params.get("dockpulp_user")
-    dockpulp_password = params.get("dockpulp_password")
-    login_succeed, stdout = login(env, dockpulp_user, dockpulp_password)
-    if not login_succeed:
-        raise RuntimeError("Error logging into dock-pulp: %s" % stdout)
-
-    # The only fields that are possible to change are distribution and description
-    # Only way for others to change would be repo name or namepsace change
-    # which would lead to a new repo created anyways
-    repo_name = params.get("repo_name")
-    namespace = params.get("namespace")
-    description = params.get("description")
-    distribution = params.get("distribution")
-    full_repo_name = "redhat-%s-%s" % (namespace, repo_name)
-    new_repo = {
-        "description": description,
-        "title": full_repo_name,
-        "docker-id": "%s/%s" % (namespace, repo_name),
-        "distribution": distribution,
-    }
-    # Get a comparable existing one
-    old_repo = get_comparable_repo(
-        get_existing_repo(full_repo_name, env, dockpulp_user, dockpulp_password)
-    )
-    if old_repo:
-        differences = diff_settings(old_repo, new_repo)
-
-    # Repo exists and have same params, no need to update
-    if old_repo and not differences:
-        # Repo for %s already exists - skipping
-        return result
-
-    # Dockpulp repo exists but need update
-    if old_repo and differences:
-        result["changed"] = True
-        changes = describe_changes(differences)
-        result["stdout_lines"].extend(changes)
-        result["diff"] = prepare_diff_data(old_repo, new_repo)
-        if not check_mode:
-            returncode = update_dockpulp_repo(env, full_repo_name, differences)
-            result["returncode"] = returncode
-        return result
-
-    # Dockpulp repo doesn't exist, create a new dockpulp repo
-    if not old_repo:
-        result["changed"] = True
-        result["stdout_lines"] = ["Created %s" % full_repo_name]
-        result["diff"] = prepare_diff_data(old_repo, new_repo)
-        if not check_mode:
-            new_repo_params = {
-                "description": description,
-                "repo_name": repo_name,
-                "namespace": namespace,
-                "distribution": distribution,
-            }
-            returncode = create_dockpulp_repo(env, new_repo_params)
-            result["returncode"] = returncode
-        return result
+"""
 
 
 def run_module():
     module_args = dict(
-        env=dict(required=True),
+        env=dict(required=True, type="raw"),
         dockpulp_user=dict(required=True),
         dockpulp_password=dict(required=True, no_log=True),
+        backend=dict(choices=BACKEND_CHOICES, default="cli"),
+        wait=dict(type="bool", default=True),
+        wait_timeout=dict(type="int", default=TASK_TIMEOUT),
+        http=dict(
+            type="dict",
+            options=dict(
+                url=dict(),
+                pool_size=dict(type="int", default=POOL_SIZE),
+                keepalive=dict(type="bool", default=True),
+                timeout=dict(type="int", default=HTTP_TIMEOUT),
+            ),
+        ),
+        session_ttl=dict(type="int", default=SESSION_TTL),
+        rate_limit=dict(type="float", default=0),
+        rate_burst=dict(type="int", default=0),
+        adaptive_timeouts=dict(type="bool", default=False),
+        read_retries=dict(type="int", default=0),
+        circuit_breaker=dict(type="int", default=0),
+        inventory_ttl=dict(type="int", default=0),
+        inventory_file=dict(type="path"),
+        inventory_file_max_age=dict(type="int", default=INVENTORY_FILE_MAX_AGE),
+        metrics=dict(type="bool", default=False),
+        fingerprint_max_age=dict(type="int", default=0),
+        force_refresh=dict(type="bool", default=False),
+        engine=dict(choices=ENGINE_CHOICES, default="sync"),
+        timeouts=dict(
+            type="dict",
+            options=dict(
+                login=dict(type="int"),
+                lookup=dict(type="int"),
+                create=dict(type="int"),
+                update=dict(type="int"),
+                delete=dict(type="int"),
+            ),
+        ),
         repo_name=dict(required=True),
         namespace=dict(required=True),
         content_url=dict(required=True),
@@ -399,26 +329,90 @@ def run_module():
     check_mode = module.check_mode
     params = module.params
 
-    repo_name = params["repo_name"]
-    content_url = params["content_url"]
-    if not content_url.startswith("/content"):
-        module.fail_json(
-            msg="the content-url needs to start with /content",
-            changed=False,
-            rc=1,
-        )
-    if not content_url.rstrip("/").endswith(repo_name):
-        module.fail_json(
-            msg="the content-url needs to end with %s" % repo_name,
-            changed=False,
-            rc=1,
-        )
+    error = validate_content_url(params["repo_name"], params["content_url"])
+    if error:
+        module.fail_json(msg=error, changed=False, rc=1)
+
+    # The inventory_file is read without a backend
+    backend = None if params["inventory_file"] else params["backend"]
+    if backend in ("library", "broker") and not HAS_DOCKPULP:
+        module.fail_json(msg=missing_required_lib("dockpulp"), changed=False, rc=1)
+
+    if backend == "rest" and not HAS_REQUESTS:
+        module.fail_json(msg=missing_required_lib("requests"), changed=False, rc=1)
+
+    envs = params["env"]
+    if isinstance(envs, list):
+        if not envs or not all(isinstance(env, str) for env in envs):
+            module.fail_json(msg="env must be a string or a list of strings", changed=False, rc=1)
+        if params["inventory_file"]:
+            module.fail_json(msg="inventory_file needs a single env", changed=False, rc=1)
+    elif not isinstance(envs, str):
+        module.fail_json(msg="env must be a string or a list of strings", changed=False, rc=1)
+
+    if params["inventory_file"]:
+        if not check_mode:
+            module.fail_json(
+                msg="inventory_file is only supported in check mode", changed=False, rc=1
+            )
+        try:
+            warning = load_offline_inventory(
+                params["env"], params["inventory_file"], params["inventory_file_max_age"]
+            )
+        except (IOError, ValueError) as e:
+            module.fail_json(msg="Error loading the inventory file: %s" % e, changed=False, rc=1)
+        if warning:
+            module.warn(warning)
+
+    if params["metrics"]:
+        METRICS.enable()
+
+    if isinstance(envs, list):
+        run_envs(module, params, list(dict.fromkeys(envs)), check_mode)
 
     try:
+        if backend:
+            backend = select_backend(params["env"], backend, params["http"], params["session_ttl"])
         result = ensure_dockpulp_repo(params, check_mode)
     except RuntimeError as e:
         module.fail_json(msg=str(e), changed=False, rc=1)
 
+    result["backend"] = backend
+    if params["metrics"]:
+        result["metrics"] = METRICS.as_dict()
+    module.exit_json(**result)
+
+
+def run_envs(module, params, envs, check_mode):
+    """Ensure the repo in several environments, with one result per env"""
+    try:
+        backends = {
+            env: select_backend(env, params["backend"], params["http"], params["session_ttl"])
+            for env in envs
+        }
+    except RuntimeError as e:
+        module.fail_json(msg=str(e), changed=False, rc=1)
+
+    results = ensure_dockpulp_repo_envs(params, envs, check_mode)
+    diffs = []
+    for env, env_result in results.items():
+        env_result["backend"] = backends[env]
+        if "diff" in env_result:
+            diff = dict(env_result["diff"])
+            diff["before_header"] = "%s: %s" % (env, diff["before_header"])
+            diff["after_header"] = "%s: %s" % (env, diff["after_header"])
+            diffs.append(diff)
+
+    result = {
+        "changed": any(r["changed"] for r in results.values()),
+        "envs": results,
+        "diff": diffs,
+    }
+    if params["metrics"]:
+        result["metrics"] = METRICS.as_dict()
+    failed = [env for env, env_result in results.items() if env_result["returncode"] != 0]
+    if failed:
+        module.fail_json(msg="Error ensuring the repo in: %s" % ", ".join(failed), **result)
     module.exit_json(**result)
 
 
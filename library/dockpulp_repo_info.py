@@ -0,0 +1,253 @@
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+from ansible.module_utils.dockpulp_backend import BACKEND_CHOICES, HAS_DOCKPULP, select_backend
+from ansible.module_utils.dockpulp_cache import SESSION_TTL
+from ansible.module_utils.dockpulp_common import BATCH_SIZE, find_dockpulp_repos
+from ansible.module_utils.dockpulp_http import HAS_REQUESTS, HTTP_TIMEOUT, POOL_SIZE
+from ansible.module_utils.dockpulp_metrics import METRICS
+
+
+ANSIBLE_METADATA = {
+    "metadata_version": "1.0",
+    "status": ["preview"],
+    "supported_by": "honeybadger",
+}
+
+
+DOCUMENTATION = """
+---
+module: dockpulp_repo_info
+
+short_description: List dockpulp repositories of Docker Pulp server
+description:
+- List the CDN repositories within Red Hat's Docker Pulp server, filtered by
+  namespace, distribution and name, one page at a time. The listing of the
+  server is parsed while it's read, and stops once the page is full.
+options:
+   env:
+     description:
+       - The environment to run dock-pulp command, which is configured in /etc/dockpulp.conf
+       - "Example: stage"
+     required: true
+   dockpulp_user:
+     description:
+       - The user to login to docker pulp server
+     required: true
+   dockpulp_password:
+     description:
+       - The password to login to docker pulp server
+     required: true
+   names:
+     description:
+       - The full names of the repos to look up, instead of listing all the
+         repos of the env. The repos which do not exist are left out.
+     type: list
+     elements: str
+   namespace:
+     description:
+       - Only return the repos of this namespace.
+       - "Example: rhceph"
+   distribution:
+     description:
+       - Only return the repos of this distribution.
+       - "Example: ga"
+   name:
+     description:
+       - Only return the repos with a repo_name matching this shell glob.
+       - "Example: rhceph-4-*"
+   offset:
+     description:
+       - Number of matching repos to skip, from the next_offset of the previous page.
+     default: 0
+     type: int
+   limit:
+     description:
+       - Maximum number of repos to return. Set to 0 (the default) to return all
+         the matching repos.
+     default: 0
+     type: int
+   backend:
+     description:
+       - How to run the dock-pulp operations. "library" imports the dockpulp library
+         and calls its API in-process, "cli" runs the dock-pulp command for every
+         operation (the default), and "auto" uses the library when it is installed.
+       - "broker" calls the dockpulp library in a local broker process, started on
+         first use and shared by all the module processes of the user over a Unix
+         socket, which keeps the login between them. The broker exits after 5
+         minutes without a request.
+       - "rest" calls the Pulp v2 REST API in-process with the requests library,
+         over pooled HTTP connections kept alive between calls, see http.
+     choices: [auto, cli, library, broker, rest]
+     default: cli
+   http:
+     description:
+       - Settings of the HTTP connections of the rest backend. The connections,
+         their TLS sessions and their auth are reused by all the calls of the
+         module to the same server.
+     type: dict
+     suboptions:
+       url:
+         description:
+           - The URL of the Pulp server. Defaults to the server of the env in
+             /etc/dockpulp.conf.
+       pool_size:
+         description:
+           - Number of connections kept open to the server. Calls over it wait
+             for a free connection.
+         type: int
+         default: 10
+       keepalive:
+         description: Keep the connections open between calls.
+         type: bool
+         default: true
+       timeout:
+         description: Seconds allowed for one HTTP request.
+         type: int
+         default: 120
+   batch_size:
+     description:
+       - Maximum number of repos listed by a single dock-pulp list, or a single
+         call of the library backend.
+     default: 50
+     type: int
+   metrics:
+     description:
+       - Return the wall time of the login and find_dockpulp_repos phases, and the
+         number of dock-pulp commands run with the bytes of their output, as
+         "metrics" in the result.
+     default: false
+     type: bool
+   rate_limit:
+     description:
+       - Maximum number of dock-pulp calls per second to the env, on average, from
+         all the module processes of the host together, like the forks of a play.
+         The calls over the limit wait for their turn. Set to 0 (the default) for
+         no limit.
+     default: 0
+     type: float
+   rate_burst:
+     description:
+       - Number of dock-pulp calls allowed at once after an idle time, with
+         rate_limit. Defaults to rate_limit rounded up.
+     default: 0
+     type: int
+   adaptive_timeouts:
+     description:
+       - Record the duration of every dock-pulp call of the env in a rolling
+         histogram by operation, shared by the module processes of the host, and
+         lower the timeout of every call to 3 times the p99 duration of its
+         operation, at least 10 seconds. The timeouts stay unchanged until an
+         operation has about 20 recent calls.
+     default: false
+     type: bool
+   read_retries:
+     description:
+       - Number of retries of the dock-pulp lookups timing out or failing on the
+         way to the server, like a refused connection or a 503, after a random
+         backoff growing from 0.5 up to 10 seconds. Changes are never retried.
+         The lookups are not retried by default.
+     default: 0
+     type: int
+   circuit_breaker:
+     description:
+       - Number of consecutive dock-pulp calls to the env timing out or failing on
+         the way to the server after which its calls fail at once for 30 seconds,
+         from all the module processes of the host. Disabled by default, with 0.
+     default: 0
+     type: int
+   session_ttl:
+     description:
+       - Number of seconds a dock-pulp login is reused by later tasks, for the same
+         env and dockpulp_user. Set to 0 to always log in.
+     default: 28800
+     type: int
+requirements:
+  - "python >= 3.6"
+  - "lxml"
+  - "requests-gssapi"
+"""
+
+EXAMPLES = """
+- name: list dockpulp repositories
+  hosts: localhost
+  tasks:
+  - name: List the ga rhceph-4 repos
+    dockpulp_repo_info:
+      env: stage
+      dockpulp_user: fakeuser
+      dockpulp_password: fakeuserPassw0rd
+      namespace: rhceph
+      distribution: ga
+      name: rhceph-4-*
+      limit: 100
+    register: rhceph_repos
+"""
+
+
+def run_module():
+    module_args = dict(
+        env=dict(required=True),
+        dockpulp_user=dict(required=True),
+        dockpulp_password=dict(required=True, no_log=True),
+        names=dict(type="list", elements="str"),
+        namespace=dict(),
+        distribution=dict(),
+        name=dict(),
+        offset=dict(type="int", default=0),
+        limit=dict(type="int", default=0),
+        backend=dict(choices=BACKEND_CHOICES, default="cli"),
+        http=dict(
+            type="dict",
+            options=dict(
+                url=dict(),
+                pool_size=dict(type="int", default=POOL_SIZE),
+                keepalive=dict(type="bool", default=True),
+                timeout=dict(type="int", default=HTTP_TIMEOUT),
+            ),
+        ),
+        batch_size=dict(type="int", default=BATCH_SIZE),
+        metrics=dict(type="bool", default=False),
+        session_ttl=dict(type="int", default=SESSION_TTL),
+        rate_limit=dict(type="float", default=0),
+        rate_burst=dict(type="int", default=0),
+        adaptive_timeouts=dict(type="bool", default=False),
+        read_retries=dict(type="int", default=0),
+        circuit_breaker=dict(type="int", default=0),
+    )
+    module = AnsibleModule(argument_spec=module_args, supports_check_mode=True)
+
+    params = module.params
+
+    if params["backend"] in ("library", "broker") and not HAS_DOCKPULP:
+        module.fail_json(msg=missing_required_lib("dockpulp"), changed=False, rc=1)
+
+    if params["backend"] == "rest" and not HAS_REQUESTS:
+        module.fail_json(msg=missing_required_lib("requests"), changed=False, rc=1)
+
+    if params["metrics"]:
+        METRICS.enable()
+
+    try:
+        backend = select_backend(
+            params["env"], params["backend"], params["http"], params["session_ttl"]
+        )
+        repos, next_offset = find_dockpulp_repos(params)
+    except RuntimeError as e:
+        module.fail_json(msg=str(e), changed=False, rc=1)
+
+    result = {
+        "changed": False,
+        "repos": repos,
+        "next_offset": next_offset,
+        "backend": backend,
+    }
+    if params["metrics"]:
+        result["metrics"] = METRICS.as_dict()
+    module.exit_json(**result)
+
+
+def main():
+    run_module()
+
+
+if __name__ == "__main__":
+    main()
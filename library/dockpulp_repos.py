@@ -0,0 +1,456 @@
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+from ansible.module_utils.dockpulp_backend import BACKEND_CHOICES, HAS_DOCKPULP, select_backend
+from ansible.module_utils.dockpulp_cache import SESSION_TTL
+from ansible.module_utils.dockpulp_common import (
+    BATCH_SIZE,
+    ENGINE_CHOICES,
+    HAS_YAML,
+    INVENTORY_FILE_MAX_AGE,
+    apply_plan,
+    ensure_dockpulp_repos,
+    export_plan,
+    load_manifest,
+    load_offline_inventory,
+    reconcile_dockpulp_repos,
+    validate_content_url,
+)
+from ansible.module_utils.dockpulp_http import HAS_REQUESTS, HTTP_TIMEOUT, POOL_SIZE, TASK_TIMEOUT
+from ansible.module_utils.dockpulp_metrics import METRICS
+from ansible.module_utils.six import string_types
+
+
+ANSIBLE_METADATA = {
+    "metadata_version": "1.0",
+    "status": ["preview"],
+    "supported_by": "honeybadger",
+}
+
+
+DOCUMENTATION = """
+---
+module: dockpulp_repos
+
+short_description: Create and update many dockpulp repositories in Docker Pulp server
+description:
+- Create and update a list of CDN repositories within Red Hat's Docker Pulp server
+  in a single module run. The module logs in once, and only creates or updates the
+  repositories that differ from the server.
+options:
+   env:
+     description:
+       - The environment to run dock-pulp command, which is configured in /etc/dockpulp.conf
+       - "Example: stage"
+     required: true
+   dockpulp_user:
+     description:
+       - The user to login to docker pulp server
+     required: true
+   dockpulp_password:
+     description:
+       - The password to login to docker pulp server
+     required: true
+   repos:
+     description:
+       - The list of dockpulp repos to ensure. Every item accepts the same
+         repo_name, namespace, content_url, description and distribution
+         fields as the dockpulp_repo module.
+       - Exactly one of repos and manifest is required, except to apply a
+         plan_file.
+     type: list
+     elements: dict
+   manifest:
+     description:
+       - The path of a JSON or YAML file with the list of repos to ensure, as a
+         list or under a "repos" key. The repos are matched with one listing
+         of all the repos of the env by docker-id, and only the differences are
+         applied. Files not ending in .json need PyYAML.
+     type: path
+   prune:
+     description:
+       - Delete the repos of the env which are not in repos or manifest. Only
+         the repos of the namespaces of repos or manifest are deleted.
+     default: false
+     type: bool
+   plan_file:
+     description:
+       - In check mode, the path of a JSON file to write the plan of the run to,
+         with the action (create, update, delete or noop), the differences and
+         the values observed on the server of every repo.
+       - Outside of check mode, the path of such a plan to apply instead of
+         repos or manifest. Only the planned changes are applied, after reading
+         the repos to change again. A repo changed on the server since the plan
+         was made fails without being changed.
+       - The plan wins over repos and manifest, which only make the plan and
+         are left unused, with a warning, when applying it.
+     type: path
+   backend:
+     description:
+       - How to run the dock-pulp operations. "library" imports the dockpulp library
+         and calls its API in-process, "cli" runs the dock-pulp command for every
+         operation (the default), and "auto" uses the library when it is installed.
+       - "broker" calls the dockpulp library in a local broker process, started on
+         first use and shared by all the module processes of the user over a Unix
+         socket, which keeps the login between them. The broker exits after 5
+         minutes without a request.
+       - "rest" calls the Pulp v2 REST API in-process with the requests library,
+         over pooled HTTP connections kept alive between calls, see http.
+     choices: [auto, cli, library, broker, rest]
+     default: cli
+   wait:
+     description:
+       - Wait for the Pulp tasks spawned by the updates and deletes of the rest
+         backend. The tasks of all the repos are polled together, with a poll
+         interval growing from 0.1 to 5 seconds. A repo fails when its task fails,
+         or is still running after wait_timeout seconds.
+       - With false, the module returns once the changes are submitted, with the
+         task_ids of every changed repo, to check later with dockpulp_task_info.
+         The other backends return once their changes are over.
+     default: true
+     type: bool
+   wait_timeout:
+     description:
+       - Number of seconds to wait for the Pulp tasks of the run, with wait.
+     default: 600
+     type: int
+   http:
+     description:
+       - Settings of the HTTP connections of the rest backend. The connections,
+         their TLS sessions and their auth are reused by all the calls of the
+         module to the same server.
+     type: dict
+     suboptions:
+       url:
+         description:
+           - The URL of the Pulp server. Defaults to the server of the env in
+             /etc/dockpulp.conf.
+       pool_size:
+         description:
+           - Number of connections kept open to the server. Calls over it wait
+             for a free connection.
+         type: int
+         default: 10
+       keepalive:
+         description: Keep the connections open between calls.
+         type: bool
+         default: true
+       timeout:
+         description: Seconds allowed for one HTTP request.
+         type: int
+         default: 120
+   batch_size:
+     description:
+       - Maximum number of repos looked up by a single dock-pulp list.
+     default: 50
+     type: int
+   max_workers:
+     description:
+       - Maximum number of repos created or updated at the same time, or of
+         dock-pulp operations at the same time with the asyncio engine. The
+         results are still returned in the order of the repos option.
+     default: 4
+     type: int
+   inventory_ttl:
+     description:
+       - Number of seconds a local snapshot of all the repos of the env is used
+         instead of looking up every repo on the server. The snapshot is taken with
+         one listing of the server, and kept up to date with the creates and
+         updates of the module. Set to 0 (the default) to look up every repo.
+     default: 0
+     type: int
+   inventory_file:
+     description:
+       - Path of an exported inventory snapshot of the env, to run check mode
+         against instead of the server, without logging in. The snapshot is a
+         JSON file with the repos by full repo name under "repos" and the time
+         they were listed under "fetched_at", like the inventory snapshots that
+         inventory_ttl keeps in the cache directory. Only supported in check mode.
+     type: path
+   inventory_file_max_age:
+     description:
+       - Number of seconds after which the snapshot of inventory_file is
+         reported as stale, with a warning.
+     default: 86400
+     type: int
+   fingerprint_max_age:
+     description:
+       - Number of seconds a repo applied with the same values is not looked up
+         again. A hash of the values of every repo found in line with the server,
+         or created or updated, is kept with the env and its time in a local
+         state file. Set to 0 (the default) to look up every repo. Not used
+         with manifest or prune, which list all the repos of the env.
+     default: 0
+     type: int
+   force_refresh:
+     description:
+       - Look up every repo, even the ones with a fingerprint younger than
+         fingerprint_max_age.
+     default: false
+     type: bool
+   metrics:
+     description:
+       - Return the wall time of the login, lookup, create and update phases, and
+         the number of dock-pulp commands run with the bytes of their output, as
+         "metrics" in the result.
+     default: false
+     type: bool
+   engine:
+     description:
+       - How to run the dock-pulp operations of the module. "sync" looks up the
+         batches one after the other and applies the changes with up to
+         max_workers threads. "asyncio" runs all the lookups and then all the
+         changes from one event loop, up to max_workers dock-pulp operations at
+         the same time, each within the timeouts of its operation.
+     choices: [sync, asyncio]
+     default: sync
+   timeouts:
+     description:
+       - Seconds allowed for every dock-pulp operation with the asyncio engine, by
+         operation. The operations not set are allowed 120 seconds.
+     type: dict
+     suboptions:
+       login:
+         description: Seconds allowed to log in.
+         type: int
+       lookup:
+         description: Seconds allowed to look up a repo, or a batch of repos.
+         type: int
+       create:
+         description: Seconds allowed to create a repo.
+         type: int
+       update:
+         description: Seconds allowed to update a repo.
+         type: int
+       delete:
+         description: Seconds allowed to delete a repo.
+         type: int
+   rate_limit:
+     description:
+       - Maximum number of dock-pulp calls per second to the env, on average, from
+         all the module processes of the host together, like the forks of a play.
+         The calls over the limit wait for their turn. Set to 0 (the default) for
+         no limit.
+     default: 0
+     type: float
+   rate_burst:
+     description:
+       - Number of dock-pulp calls allowed at once after an idle time, with
+         rate_limit. Defaults to rate_limit rounded up.
+     default: 0
+     type: int
+   adaptive_timeouts:
+     description:
+       - Record the duration of every dock-pulp call of the env in a rolling
+         histogram by operation, shared by the module processes of the host, and
+         lower the timeout of every call to 3 times the p99 duration of its
+         operation, at least 10 seconds. The timeouts stay unchanged until an
+         operation has about 20 recent calls.
+     default: false
+     type: bool
+   read_retries:
+     description:
+       - Number of retries of the dock-pulp lookups timing out or failing on the
+         way to the server, like a refused connection or a 503, after a random
+         backoff growing from 0.5 up to 10 seconds. Changes are never retried.
+         The lookups are not retried by default.
+     default: 0
+     type: int
+   circuit_breaker:
+     description:
+       - Number of consecutive dock-pulp calls to the env timing out or failing on
+         the way to the server after which its calls fail at once for 30 seconds,
+         from all the module processes of the host. Disabled by default, with 0.
+     default: 0
+     type: int
+   session_ttl:
+     description:
+       - Number of seconds a dock-pulp login is reused by later tasks, for the same
+         env and dockpulp_user. Set to 0 to always log in.
+     default: 28800
+     type: int
+requirements:
+  - "python >= 3.6"
+  - "lxml"
+  - "requests-gssapi"
+"""
+
+EXAMPLES = """
+- name: create dockpulp repositories
+  hosts: localhost
+  tasks:
+  - name: Add rhceph-4 cdn repos
+    dockpulp_repos:
+      env: stage
+      dockpulp_user: fakeuser
+      dockpulp_password: fakeuserPassw0rd
+      repos:
+      - repo_name: rhceph-4-rhel8
+        namespace: rhceph
+        content_url: /content/dist/containers/rhel8/containers/redhat-rhceph-rhceph-4-rhel8
+        description: This is a test repo for create dockpulp repo
+        distribution: ga
+      - repo_name: rhceph-4-rhel9
+        namespace: rhceph
+        content_url: /content/dist/containers/rhel9/containers/redhat-rhceph-rhceph-4-rhel9
+        description: This is a test repo for create dockpulp repo
+        distribution: ga
+"""
+
+
+def run_module():
+    repo_args = dict(
+        repo_name=dict(required=True),
+        namespace=dict(required=True),
+        content_url=dict(required=True),
+        description=dict(required=True),
+        distribution=dict(required=True),
+    )
+    module_args = dict(
+        env=dict(required=True),
+        dockpulp_user=dict(required=True),
+        dockpulp_password=dict(required=True, no_log=True),
+        backend=dict(choices=BACKEND_CHOICES, default="cli"),
+        wait=dict(type="bool", default=True),
+        wait_timeout=dict(type="int", default=TASK_TIMEOUT),
+        http=dict(
+            type="dict",
+            options=dict(
+                url=dict(),
+                pool_size=dict(type="int", default=POOL_SIZE),
+                keepalive=dict(type="bool", default=True),
+                timeout=dict(type="int", default=HTTP_TIMEOUT),
+            ),
+        ),
+        session_ttl=dict(type="int", default=SESSION_TTL),
+        rate_limit=dict(type="float", default=0),
+        rate_burst=dict(type="int", default=0),
+        adaptive_timeouts=dict(type="bool", default=False),
+        read_retries=dict(type="int", default=0),
+        circuit_breaker=dict(type="int", default=0),
+        inventory_ttl=dict(type="int", default=0),
+        inventory_file=dict(type="path"),
+        inventory_file_max_age=dict(type="int", default=INVENTORY_FILE_MAX_AGE),
+        metrics=dict(type="bool", default=False),
+        fingerprint_max_age=dict(type="int", default=0),
+        force_refresh=dict(type="bool", default=False),
+        engine=dict(choices=ENGINE_CHOICES, default="sync"),
+        timeouts=dict(
+            type="dict",
+            options=dict(
+                login=dict(type="int"),
+                lookup=dict(type="int"),
+                create=dict(type="int"),
+                update=dict(type="int"),
+                delete=dict(type="int"),
+            ),
+        ),
+        batch_size=dict(type="int", default=BATCH_SIZE),
+        max_workers=dict(type="int", default=4),
+        repos=dict(type="list", elements="dict", options=repo_args),
+        manifest=dict(type="path"),
+        prune=dict(type="bool", default=False),
+        plan_file=dict(type="path"),
+    )
+    module = AnsibleModule(
+        argument_spec=module_args,
+        mutually_exclusive=[("repos", "manifest")],
+        required_one_of=[("repos", "manifest", "plan_file")],
+        supports_check_mode=True,
+    )
+
+    check_mode = module.check_mode
+    params = module.params
+
+    if params["plan_file"] and check_mode and not (params["repos"] or params["manifest"]):
+        module.fail_json(
+            msg="one of repos or manifest is required to write a plan", changed=False, rc=1
+        )
+    if params["plan_file"] and not check_mode and (params["repos"] or params["manifest"]):
+        module.warn("repos and manifest are not used when applying the plan_file")
+
+    if params["manifest"]:
+        if not params["manifest"].endswith(".json") and not HAS_YAML:
+            module.fail_json(msg=missing_required_lib("PyYAML"), changed=False, rc=1)
+        try:
+            params["repos"] = load_manifest(params["manifest"])
+        except (IOError, ValueError) as e:
+            module.fail_json(msg="Error loading the manifest: %s" % e, changed=False, rc=1)
+
+    for repo in params["repos"] or []:
+        missing = [key for key in repo_args if not repo.get(key)]
+        if missing:
+            module.fail_json(
+                msg="missing %s in repo %s" % (", ".join(missing), repo), changed=False, rc=1
+            )
+        # The repos of a manifest are not converted by the argument spec
+        not_strings = [key for key in repo_args if not isinstance(repo[key], string_types)]
+        if not_strings:
+            module.fail_json(
+                msg="%s need to be strings in repo %s" % (", ".join(not_strings), repo),
+                changed=False,
+                rc=1,
+            )
+        error = validate_content_url(repo["repo_name"], repo["content_url"])
+        if error:
+            module.fail_json(msg=error, changed=False, rc=1)
+
+    # The inventory_file is read without a backend
+    backend = None if params["inventory_file"] else params["backend"]
+    if backend in ("library", "broker") and not HAS_DOCKPULP:
+        module.fail_json(msg=missing_required_lib("dockpulp"), changed=False, rc=1)
+
+    if backend == "rest" and not HAS_REQUESTS:
+        module.fail_json(msg=missing_required_lib("requests"), changed=False, rc=1)
+
+    if params["inventory_file"]:
+        if not check_mode:
+            module.fail_json(
+                msg="inventory_file is only supported in check mode", changed=False, rc=1
+            )
+        try:
+            warning = load_offline_inventory(
+                params["env"], params["inventory_file"], params["inventory_file_max_age"]
+            )
+        except (IOError, ValueError) as e:
+            module.fail_json(msg="Error loading the inventory file: %s" % e, changed=False, rc=1)
+        if warning:
+            module.warn(warning)
+
+    if params["metrics"]:
+        METRICS.enable()
+
+    try:
+        if backend:
+            backend = select_backend(params["env"], backend, params["http"], params["session_ttl"])
+        if params["plan_file"]:
+            try:
+                results = export_plan(params) if check_mode else apply_plan(params)
+            except (IOError, ValueError) as e:
+                module.fail_json(msg="Error with the plan_file: %s" % e, changed=False, rc=1)
+        elif params["manifest"] or params["prune"]:
+            results = reconcile_dockpulp_repos(params, check_mode)
+        else:
+            results = ensure_dockpulp_repos(params, check_mode)
+    except RuntimeError as e:
+        module.fail_json(msg=str(e), changed=False, rc=1)
+
+    result = {
+        "changed": any(r["changed"] for r in results),
+        "results": results,
+        "backend": backend,
+        "diff": [r["diff"] for r in results if "diff" in r],
+    }
+    if params["metrics"]:
+        result["metrics"] = METRICS.as_dict()
+    failed = [r["full_repo_name"] for r in results if r["returncode"] != 0]
+    if failed:
+        module.fail_json(msg="Error ensuring dockpulp repos: %s" % ", ".join(failed), **result)
+
+    module.exit_json(**result)
+
+
+def main():
+    run_module()
+
+
+if __name__ == "__main__":
+    main()
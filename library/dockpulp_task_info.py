@@ -0,0 +1,189 @@
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+from ansible.module_utils.dockpulp_backend import select_backend
+from ansible.module_utils.dockpulp_common import get_tasks
+from ansible.module_utils.dockpulp_http import (
+    HAS_REQUESTS,
+    HTTP_TIMEOUT,
+    POOL_SIZE,
+    TASK_FINAL_STATES,
+    TASK_TIMEOUT,
+)
+from ansible.module_utils.dockpulp_metrics import METRICS
+
+
+ANSIBLE_METADATA = {
+    "metadata_version": "1.0",
+    "status": ["preview"],
+    "supported_by": "honeybadger",
+}
+
+
+DOCUMENTATION = """
+---
+module: dockpulp_task_info
+
+short_description: Check the Pulp tasks of dockpulp repository changes
+description:
+- Get the state of the Pulp tasks spawned by dockpulp_repo or dockpulp_repos
+  with the rest backend and wait set to false, from their task_ids. The tasks
+  are polled in batches, and optionally until they are over.
+- The module fails when a task failed, was canceled or was not found.
+options:
+   env:
+     description:
+       - The environment to run dock-pulp command, which is configured in /etc/dockpulp.conf
+       - "Example: stage"
+     required: true
+   dockpulp_user:
+     description:
+       - The user to login to docker pulp server
+     required: true
+   dockpulp_password:
+     description:
+       - The password to login to docker pulp server
+     required: true
+   task_ids:
+     description:
+       - The ids of the tasks to check, from the task_ids of the changed repos.
+     required: true
+     type: list
+     elements: str
+   wait:
+     description:
+       - Poll the tasks until they are all over, or for wait_timeout seconds,
+         with a poll interval growing from 0.1 to 5 seconds.
+     default: false
+     type: bool
+   wait_timeout:
+     description:
+       - Number of seconds to wait for the tasks, with wait.
+     default: 600
+     type: int
+   http:
+     description:
+       - Settings of the HTTP connections to the Pulp server, like the http
+         option of dockpulp_repos.
+     type: dict
+     suboptions:
+       url:
+         description:
+           - The URL of the Pulp server. Defaults to the server of the env in
+             /etc/dockpulp.conf.
+       pool_size:
+         description: Number of connections kept open to the server.
+         type: int
+         default: 10
+       keepalive:
+         description: Keep the connections open between calls.
+         type: bool
+         default: true
+       timeout:
+         description: Seconds allowed for one HTTP request.
+         type: int
+         default: 120
+   metrics:
+     description:
+       - Return the wall time of the login and wait_tasks phases, and the number
+         of HTTP requests and task polls, as "metrics" in the result.
+     default: false
+     type: bool
+   rate_limit:
+     description:
+       - Maximum number of calls per second to the env, on average, from all the
+         module processes of the host together. Set to 0 (the default) for no limit.
+     default: 0
+     type: float
+   rate_burst:
+     description:
+       - Number of calls allowed at once after an idle time, with rate_limit.
+         Defaults to rate_limit rounded up.
+     default: 0
+     type: int
+requirements:
+  - "python >= 3.6"
+  - "requests"
+"""
+
+EXAMPLES = """
+- name: create dockpulp repositories without waiting
+  hosts: localhost
+  tasks:
+  - name: Update the rhceph-4 cdn repos
+    dockpulp_repos:
+      env: stage
+      dockpulp_user: fakeuser
+      dockpulp_password: fakeuserPassw0rd
+      backend: rest
+      wait: false
+      repos: "{{ rhceph_repos }}"
+    register: submitted
+
+  - name: Wait for their Pulp tasks
+    dockpulp_task_info:
+      env: stage
+      dockpulp_user: fakeuser
+      dockpulp_password: fakeuserPassw0rd
+      task_ids: "{{ submitted.results | map(attribute='task_ids', default=[]) | flatten }}"
+      wait: true
+"""
+
+
+def run_module():
+    module_args = dict(
+        env=dict(required=True),
+        dockpulp_user=dict(required=True),
+        dockpulp_password=dict(required=True, no_log=True),
+        task_ids=dict(required=True, type="list", elements="str"),
+        wait=dict(type="bool", default=False),
+        wait_timeout=dict(type="int", default=TASK_TIMEOUT),
+        http=dict(
+            type="dict",
+            options=dict(
+                url=dict(),
+                pool_size=dict(type="int", default=POOL_SIZE),
+                keepalive=dict(type="bool", default=True),
+                timeout=dict(type="int", default=HTTP_TIMEOUT),
+            ),
+        ),
+        metrics=dict(type="bool", default=False),
+        rate_limit=dict(type="float", default=0),
+        rate_burst=dict(type="int", default=0),
+    )
+    module = AnsibleModule(argument_spec=module_args, supports_check_mode=True)
+
+    params = module.params
+
+    if not HAS_REQUESTS:
+        module.fail_json(msg=missing_required_lib("requests"), changed=False, rc=1)
+
+    if params["metrics"]:
+        METRICS.enable()
+
+    try:
+        select_backend(params["env"], "rest", params["http"])
+        tasks = get_tasks(params)
+    except RuntimeError as e:
+        module.fail_json(msg=str(e), changed=False, rc=1)
+
+    result = {
+        "changed": False,
+        "tasks": tasks,
+        "finished": all(task["state"] in TASK_FINAL_STATES for task in tasks),
+    }
+    if params["metrics"]:
+        result["metrics"] = METRICS.as_dict()
+    failed = [
+        task["task_id"] for task in tasks if task["state"] in ("error", "canceled", "missing")
+    ]
+    if failed:
+        module.fail_json(msg="Pulp tasks failed: %s" % ", ".join(failed), **result)
+
+    module.exit_json(**result)
+
+
+def main():
+    run_module()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+import asyncio
+import time
+from ansible.module_utils.dockpulp_backend import BACKENDS
+from ansible.module_utils.dockpulp_common import (
+    BATCH_SIZE,
+    DOCK_PULP_TIMEOUT,
+    INVENTORY,
+    build_new_repo,
+    connect,
+    create_command,
+    delete_command,
+    is_auth_error,
+    list_command,
+    login,
+    logout,
+    missing_repos,
+    parse_output,
+    parse_repos,
+    plan_dockpulp_repos,
+    save_inventory,
+    track_tasks,
+    update_command,
+    update_inventory,
+)
+from ansible.module_utils.dockpulp_latency import (
+    CommandTimeout,
+    backoff,
+    check_circuit,
+    command_operation,
+    is_transient_error,
+    policy,
+    record_latency,
+    record_outcome,
+    timeout_for,
+)
+from ansible.module_utils.dockpulp_metrics import METRICS
+from ansible.module_utils.dockpulp_ratelimit import command_env, reserve
+
+# Seconds allowed for one operation, by operation
+TIMEOUTS = {
+    "login": DOCK_PULP_TIMEOUT,
+    "lookup": DOCK_PULP_TIMEOUT,
+    "create": DOCK_PULP_TIMEOUT,
+    "update": DOCK_PULP_TIMEOUT,
+    "delete": DOCK_PULP_TIMEOUT,
+}
+
+MAX_CONCURRENCY = 16
+
+# Parts listed at the same time after a batch with missing repos
+BATCH_SPLIT = 4
+
+
+async def execute_command(command, timeout=DOCK_PULP_TIMEOUT):
+    """Execute a given command without blocking the event loop
+    Args:
+        command (list): List of args for a command
+        timeout: Maximum number of seconds to wait for a result, lowered
+                 by adaptive timeouts like dockpulp_common.execute_command
+    Returns:
+        The returncode and the output of the command
+    Raises:
+        RuntimeError if the circuit of the environment is open
+        CommandTimeout, a RuntimeError, if the command timed out, after
+        killing it and counting the failure for the circuit breaker
+    """
+    env = command_env(command)
+    operation = command_operation(command)
+    check_circuit(env)
+    timeout = timeout_for(env, operation, timeout)
+    wait = reserve(env)
+    if wait:
+        with METRICS.timer("rate_limit"):
+            await asyncio.sleep(wait)
+    start = time.time()
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        outs, errs = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        record_latency(env, operation, time.time() - start)
+        record_outcome(env, False)
+        METRICS.count("commands")
+        raise CommandTimeout(command, timeout)
+    output = (outs + errs).decode("utf8")
+    record_latency(env, operation, time.time() - start)
+    record_outcome(env, process.returncode == 0 or not is_transient_error(output))
+    METRICS.count("commands")
+    METRICS.count("output_bytes", len(outs) + len(errs))
+    return process.returncode, output
+
+
+def chunks(items, size):
+    """Split a list in lists of up to size items"""
+    parts = []
+    for start in range(0, len(items), size):
+        end = start + size
+        parts.append(items[start:end])
+    return parts
+
+
+class AsyncEngine(object):
+    """Run the dock-pulp operations of an environment concurrently, up to
+    max_concurrency at once. The calls of the in-process backend, which
+    block, run in the default executor of the event loop.
+    Example:
+        engine = AsyncEngine("qa", user, password, max_concurrency=100)
+        repos = await engine.get_existing_repos(full_repo_names)
+    """
+
+    def __init__(
+        self, env, dockpulp_user, dockpulp_password, max_concurrency=MAX_CONCURRENCY, timeouts=None
+    ):
+        self.env = env
+        self.dockpulp_user = dockpulp_user
+        self.dockpulp_password = dockpulp_password
+        self.timeouts = dict(TIMEOUTS)
+        self.timeouts.update(
+            (operation, timeout) for operation, timeout in (timeouts or {}).items() if timeout
+        )
+        self.max_concurrency = max_concurrency
+        self.login_generation = 0
+        # Created in the event loop of the engine, by start()
+        self.semaphore = None
+        self.login_lock = None
+
+    def start(self):
+        self.semaphore = asyncio.Semaphore(max(1, self.max_concurrency))
+        self.login_lock = asyncio.Lock()
+
+    async def command(self, operation, command):
+        """Run a dock-pulp command, within the timeout of its operation"""
+        async with self.semaphore:
+            return await execute_command(command, self.timeouts[operation])
+
+    async def read(self, command):
+        """Run a dock-pulp lookup, retried like dockpulp_common.read_command
+        without holding a slot of max_concurrency during the backoff"""
+        retries = policy(self.env)["retries"]
+        attempt = 0
+        while True:
+            try:
+                returncode, output = await self.command("lookup", command)
+                if returncode == 0 or not is_transient_error(output) or attempt >= retries:
+                    return returncode, output
+            except CommandTimeout:
+                if attempt >= retries:
+                    raise
+            METRICS.count("read_retries")
+            await asyncio.sleep(backoff(attempt))
+            attempt += 1
+
+    async def call(self, operation, func, *args):
+        """Call a blocking function in the executor, within the timeout of its operation
+        Raises:
+            RuntimeError if the call timed out
+        """
+        loop = asyncio.get_event_loop()
+        timeout = self.timeouts[operation]
+        async with self.semaphore:
+            try:
+                return await asyncio.wait_for(loop.run_in_executor(None, func, *args), timeout)
+            except asyncio.TimeoutError:
+                raise RuntimeError(
+                    "The %s of %s timed out after %s seconds" % (operation, self.env, timeout)
+                )
+
+    async def relogin(self, generation):
+        """Log in again after an authentication error. Of the operations
+        failing at the same time, only the first one logs in again.
+        Args:
+            generation: The login_generation the failed operation ran with
+        """
+        async with self.login_lock:
+            if generation != self.login_generation:
+                return
+            logout(self.env, self.dockpulp_user)
+            login_succeed, stdout = await self.call(
+                "login",
+                login,
+                self.env,
+                self.dockpulp_user,
+                self.dockpulp_password,
+                self.timeouts["login"],
+            )
+            if not login_succeed:
+                raise RuntimeError("Error logging into dock-pulp: %s" % stdout)
+            self.login_generation += 1
+
+    async def get_existing_repo(self, full_repo_name):
+        """Look up one repo, see dockpulp_common.get_existing_repo"""
+        if self.env in INVENTORY:
+            return INVENTORY[self.env].get(full_repo_name)
+        if self.env in BACKENDS:
+            return await self.call("lookup", BACKENDS[self.env].get_repo, full_repo_name)
+
+        command = list_command(self.env, [full_repo_name])
+        generation = self.login_generation
+        returncode, stdout = await self.read(command)
+        # The cached login is no longer valid, log in again and retry once
+        if returncode != 0 and is_auth_error(stdout):
+            await self.relogin(generation)
+            returncode, stdout = await self.read(command)
+        if returncode != 0:
+            return None
+        return parse_output(stdout)
+
+    async def list_batch(self, batch):
+        """List a batch of repos, see dockpulp_common.list_batch. The rest
+        of a batch with missing repos is listed again in two halves at the
+        same time, so a batch of new repos takes about one list per repo in
+        a few rounds, instead of one round per repo.
+        """
+        returncode, stdout = await self.read(list_command(self.env, batch))
+        if returncode == 0:
+            return parse_repos(stdout)
+        missing = missing_repos(stdout, batch)
+        if not missing:
+            return None
+        found = {full_repo_name: None for full_repo_name in missing}
+        remaining = [name for name in batch if name not in missing]
+        if not remaining:
+            return found
+        size = -(-len(remaining) // BATCH_SPLIT)
+        parts = chunks(remaining, size)
+        for listed in await asyncio.gather(*[self.list_batch(part) for part in parts]):
+            if listed is None:
+                return None
+            found.update(listed)
+        return found
+
+    async def get_batch(self, batch):
+        """Look up a batch of repos with one dock-pulp list"""
+        found = None
+        if self.env in INVENTORY:
+            found = INVENTORY[self.env]
+        elif self.env in BACKENDS:
+            found = await self.call("lookup", BACKENDS[self.env].get_repos, batch)
+        else:
+            found = await self.list_batch(batch)
+
+        # A list failed for another reason, like an expired login, look up
+        # the repos of that batch one by one
+        if found is None:
+            repos = await asyncio.gather(*[self.get_existing_repo(name) for name in batch])
+            found = dict(zip(batch, repos))
+        return {full_repo_name: found.get(full_repo_name) for full_repo_name in batch}
+
+    async def get_existing_repos(self, full_repo_names, batch_size=BATCH_SIZE):
+        """Look up many repos, all their batches at once
+        Returns:
+            A dictonary of the repos by full repo name, None for the repos which
+            do not exist
+        """
+        with METRICS.timer("get_existing_repos"):
+            batches = chunks(full_repo_names, batch_size)
+            repos = {}
+            for found in await asyncio.gather(*[self.get_batch(batch) for batch in batches]):
+                repos.update(found)
+            return repos
+
+    async def create_repo(self, dockpulp_repo):
+        """Create a repo, see dockpulp_common.create_dockpulp_repo"""
+        with METRICS.timer("create_dockpulp_repo"):
+            if self.env in BACKENDS:
+                return await self.call("create", BACKENDS[self.env].create_repo, dockpulp_repo)
+            command = create_command(self.env, dockpulp_repo)
+            returncode, stdout = await self.command("create", command)
+            if returncode != 0 and is_auth_error(stdout):
+                logout(self.env)
+            return returncode
+
+    async def update_repo(self, full_repo_name, differences):
+        """Update a repo, see dockpulp_common.update_dockpulp_repo"""
+        with METRICS.timer("update_dockpulp_repo"):
+            if self.env in BACKENDS:
+                return await self.call(
+                    "update", BACKENDS[self.env].update_repo, full_repo_name, differences
+                )
+            command = update_command(self.env, full_repo_name, differences)
+            returncode, stdout = await self.command("update", command)
+            if returncode != 0 and is_auth_error(stdout):
+                logout(self.env)
+            return returncode
+
+    async def delete_repo(self, full_repo_name):
+        """Delete a repo, see dockpulp_common.delete_dockpulp_repo"""
+        with METRICS.timer("delete_dockpulp_repo"):
+            if self.env in BACKENDS:
+                return await self.call("delete", BACKENDS[self.env].delete_repo, full_repo_name)
+            command = delete_command(self.env, full_repo_name)
+            returncode, stdout = await self.command("delete", command)
+            if returncode != 0 and is_auth_error(stdout):
+                logout(self.env)
+            return returncode
+
+    async def apply_planned_change(self, planned):
+        """Apply a change of plan_dockpulp_repos, see dockpulp_common.apply_planned_change"""
+        result, change = planned
+        try:
+            if change[0] == "update":
+                full_repo_name, differences = change[1], change[2]
+                returncode = await self.update_repo(full_repo_name, differences)
+                values = {key: new_value for key, _, new_value in differences}
+            elif change[0] == "delete":
+                full_repo_name, values = change[1], None
+                returncode = await self.delete_repo(full_repo_name)
+            else:
+                full_repo_name, values = build_new_repo(change[1])
+                returncode = await self.create_repo(change[1])
+            if returncode == 0:
+                update_inventory(self.env, full_repo_name, values)
+            result["returncode"] = returncode
+        except CommandTimeout as e:
+            result["returncode"] = 1
+            result["msg"] = "Timed out after %s seconds" % e.timeout
+        except Exception as e:
+            result["returncode"] = 1
+            result["msg"] = str(e)
+
+
+def new_engine(params):
+    """An AsyncEngine for the env, credentials, max_workers and timeouts of
+    the module params, to start in the event loop"""
+    return AsyncEngine(
+        params.get("env"),
+        params.get("dockpulp_user"),
+        params.get("dockpulp_password"),
+        params.get("max_workers") or MAX_CONCURRENCY,
+        params.get("timeouts"),
+    )
+
+
+async def apply_planned_changes_async(params, changes):
+    """Apply planned changes all at once, see dockpulp_common.apply_planned_changes"""
+    engine = new_engine(params)
+    engine.start()
+    await asyncio.gather(*[engine.apply_planned_change(planned) for planned in changes])
+
+
+async def ensure_dockpulp_repos_async(params, check_mode=True):
+    """Ensure that a list of CDN repos exists in the Docker pulp server,
+    with all the lookups and then all the changes running at once, up to
+    "max_workers" dock-pulp operations at the same time.
+    See dockpulp_common.ensure_dockpulp_repos for the params and results.
+    """
+    env = params.get("env")
+    # One login for the whole run, before any concurrent operation
+    connect(params)
+
+    engine = new_engine(params)
+    engine.start()
+    repos = params.get("repos") or []
+    full_repo_names = [build_new_repo(repo)[0] for repo in repos]
+    existing_repos = await engine.get_existing_repos(
+        full_repo_names, params.get("batch_size") or BATCH_SIZE
+    )
+    results, changes = plan_dockpulp_repos(repos, existing_repos, check_mode)
+    await asyncio.gather(*[engine.apply_planned_change(planned) for planned in changes])
+    # Poll the tasks of the changes outside of the event loop
+    await asyncio.get_event_loop().run_in_executor(
+        None, track_tasks, params, [result for result, _ in changes]
+    )
+    save_inventory(env)
+    return results
+
+
+def run_async(coroutine):
+    """Run a coroutine in a new event loop, from synchronous code"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
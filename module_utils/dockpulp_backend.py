@@ -0,0 +1,201 @@
+from ansible.module_utils.dockpulp_cache import SESSION_TTL
+from ansible.module_utils.dockpulp_http import HAS_REQUESTS, RestBackend
+from ansible.module_utils.dockpulp_ratelimit import acquire
+
+try:
+    import dockpulp
+    from dockpulp.errors import DockPulpError
+
+    HAS_DOCKPULP = True
+except ImportError:
+    HAS_DOCKPULP = False
+
+
+BACKEND_CHOICES = ["auto", "cli", "library", "broker", "rest"]
+
+# The keys of dockpulp's updateRepo for the compared fields named otherwise,
+# as dock-pulp update maps its --title and --dockerid options
+UPDATE_KEYS = {"title": "display_name", "docker-id": "repo-registry-id"}
+
+# The in-process backend of every environment, environments without one
+# fork the dock-pulp CLI
+BACKENDS = {}
+
+
+class LibraryBackend(object):
+    """Run dock-pulp operations in-process through the dockpulp library.
+    The Pulp object reads /etc/dockpulp.conf once, and keeps the login
+    certificate for the lifetime of the module process.
+    """
+
+    name = "library"
+
+    def __init__(self, env):
+        self.env = env
+        self.pulp = dockpulp.Pulp(env=env)
+
+    def login(self, dockpulp_user, dockpulp_password):
+        """Login to docker pulp
+        Returns:
+            True if login is successful, False otherwise
+            the error message if the login failed
+        """
+        acquire(self.env)
+        try:
+            self.pulp.login(dockpulp_user, dockpulp_password)
+        except DockPulpError as e:
+            return False, str(e)
+        return True, ""
+
+    def get_repo(self, full_repo_name):
+        """Get a Docker Pulp repo
+        Returns:
+            A dictonary representing the repo or None if it does not exist
+        """
+        acquire(self.env)
+        try:
+            repos = self.pulp.listRepos(repos=[full_repo_name], content=False)
+        except DockPulpError:
+            return None
+        return repos[0] if repos else None
+
+    def get_repos(self, full_repo_names):
+        """Get many Docker Pulp repos with one call
+        Returns:
+            A dictonary of the repos by full repo name, None if one of the
+            repos does not exist
+        """
+        acquire(self.env)
+        try:
+            repos = self.pulp.listRepos(repos=full_repo_names, content=False)
+        except DockPulpError:
+            return None
+        return {repo["id"]: repo for repo in repos}
+
+    def list_repos(self):
+        """List all the repos of the environment
+        Returns:
+            A dictonary of the repos by full repo name, None if the listing failed
+        """
+        acquire(self.env)
+        try:
+            repos = self.pulp.listRepos(content=False)
+        except DockPulpError:
+            return None
+        return {repo["id"]: repo for repo in repos}
+
+    def repo_ids(self):
+        """List the ids of all the repos of the environment
+        Raises:
+            RuntimeError if the listing failed
+        """
+        acquire(self.env)
+        try:
+            return self.pulp.getAllRepoIDs()
+        except DockPulpError as e:
+            raise RuntimeError("Error listing the repos of %s: %s" % (self.env, e))
+
+    def iter_repos(self, page_size):
+        """List all the repos of the environment, with one call for their ids
+        and then one per page_size repos, without holding the details of all
+        the repos at once
+        Yields:
+            Every repo of the environment
+        Raises:
+            RuntimeError if the listing failed
+        """
+        repo_ids = self.repo_ids()
+        for start in range(0, len(repo_ids), page_size):
+            end = start + page_size
+            acquire(self.env)
+            try:
+                repos = self.pulp.listRepos(repos=repo_ids[start:end], content=False)
+            except DockPulpError as e:
+                raise RuntimeError("Error listing the repos of %s: %s" % (self.env, e))
+            for repo in repos:
+                yield repo
+
+    def create_repo(self, dockpulp_repo):
+        """Create a repo, with the same arguments as dock-pulp create
+        Returns:
+            0 if the repo was created, 1 otherwise
+        """
+        namespace = dockpulp_repo.get("namespace")
+        acquire(self.env)
+        try:
+            self.pulp.createRepo(
+                "%s-%s" % (namespace, dockpulp_repo.get("repo_name")),
+                dockpulp_repo.get("content_url"),
+                desc=dockpulp_repo.get("description"),
+                productline=namespace,
+                distribution=dockpulp_repo.get("distribution"),
+            )
+        except DockPulpError:
+            return 1
+        return 0
+
+    def update_repo(self, full_repo_name, differences):
+        """Update the fields of a repo
+        Args:
+            differences: list of ('key', 'current_value', 'new_value')
+        Returns:
+            0 if the repo was updated, 1 otherwise
+        """
+        update = {UPDATE_KEYS.get(key, key): new_value for key, _, new_value in differences}
+        acquire(self.env)
+        try:
+            self.pulp.updateRepo(full_repo_name, update)
+        except DockPulpError:
+            return 1
+        return 0
+
+    def delete_repo(self, full_repo_name):
+        """Delete a repo
+        Returns:
+            0 if the repo was deleted, 1 otherwise
+        """
+        acquire(self.env)
+        try:
+            self.pulp.deleteRepo(full_repo_name)
+        except DockPulpError:
+            return 1
+        return 0
+
+
+def select_backend(env, backend="cli", http=None, session_ttl=SESSION_TTL):
+    """Select how to run dock-pulp operations for an environment.
+    Args:
+        env: The environment of the operations
+        backend: "library" to use the dockpulp library in-process, "broker" to
+                 use it in a local broker process shared by the module
+                 processes, "rest" to call the Pulp API in-process over pooled
+                 HTTP connections, "cli" to fork the dock-pulp CLI, "auto" for
+                 the library when installed
+        http (dict): The url, pool_size, keepalive and timeout of the rest backend
+        session_ttl: Maximum age in seconds of the logins the broker reuses
+    Returns:
+        The name of the backend in use
+    """
+    if backend == "auto":
+        backend = "library" if HAS_DOCKPULP else "cli"
+    if backend == "rest":
+        if not HAS_REQUESTS:
+            raise RuntimeError("The requests library is required for the rest backend")
+        if env not in BACKENDS or BACKENDS[env].name != backend:
+            options = {key: value for key, value in (http or {}).items() if value is not None}
+            BACKENDS[env] = RestBackend(env, **options)
+        return BACKENDS[env].name
+    if backend in ("library", "broker"):
+        if not HAS_DOCKPULP:
+            raise RuntimeError("The dockpulp library is required for the %s backend" % backend)
+        if env not in BACKENDS or BACKENDS[env].name != backend:
+            if backend == "broker":
+                # Imported when used, it imports this module
+                from ansible.module_utils.dockpulp_broker import BrokerBackend
+
+                BACKENDS[env] = BrokerBackend(env, session_ttl=session_ttl)
+            else:
+                BACKENDS[env] = LibraryBackend(env)
+        return BACKENDS[env].name
+    BACKENDS.pop(env, None)
+    return "cli"
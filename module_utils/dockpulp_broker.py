@@ -0,0 +1,337 @@
+import errno
+import json
+import os
+import socket
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:  # PY2
+    import SocketServer as socketserver
+
+from ansible.module_utils.dockpulp_backend import LibraryBackend
+from ansible.module_utils.dockpulp_cache import (
+    SESSION_TTL,
+    file_lock,
+    get_cache_dir,
+    password_hash,
+)
+from ansible.module_utils.dockpulp_common import is_auth_error
+from ansible.module_utils.dockpulp_metrics import METRICS
+from ansible.module_utils.dockpulp_ratelimit import acquire
+
+# Seconds without a request after which the broker exits
+BROKER_IDLE_TIMEOUT = 300
+
+# Seconds allowed for a new broker to accept connections
+BROKER_START_TIMEOUT = 10
+
+# Seconds allowed for one request to the broker
+BROKER_REQUEST_TIMEOUT = 120
+
+# The operations of the backends the broker runs, see LibraryBackend
+OPERATIONS = (
+    "ping",
+    "login",
+    "logout",
+    "get_repo",
+    "get_repos",
+    "list_repos",
+    "repo_ids",
+    "create_repo",
+    "update_repo",
+    "delete_repo",
+)
+
+
+def broker_path():
+    """The Unix socket of the broker, in the user-private cache directory"""
+    return os.path.join(get_cache_dir(), "broker.sock")
+
+
+class Broker(object):
+    """Run the operations of the broker requests, with one backend per
+    environment and user kept for the lifetime of the broker, so its login
+    and its connections are reused by every module process. The operations
+    of a backend run one at a time, as the dockpulp library isn't thread-safe.
+    """
+
+    def __init__(self, backend_factory=None):
+        self.backend_factory = backend_factory or LibraryBackend
+        self.backends = {}
+        # The time of the logins, by environment, user and password hash
+        self.logins = {}
+        self.lock = threading.Lock()
+        self.last_request = time.time()
+
+    def backend(self, env, dockpulp_user):
+        """The backend of an environment and user, and the lock of its operations"""
+        with self.lock:
+            key = (env, dockpulp_user)
+            if key not in self.backends:
+                self.backends[key] = (self.backend_factory(env), threading.Lock())
+            return self.backends[key]
+
+    def login(self, env, dockpulp_user, dockpulp_password, session_ttl=SESSION_TTL):
+        """Log in once per environment and user, for all the module processes.
+        A login is reused with the same password, for up to session_ttl seconds.
+        """
+        key = (env, dockpulp_user, password_hash(dockpulp_password))
+        with self.lock:
+            logged_in_at = self.logins.get(key)
+        if logged_in_at and time.time() - logged_in_at < session_ttl:
+            return True, ""
+        backend, lock = self.backend(env, dockpulp_user)
+        with lock:
+            login_succeed, stdout = backend.login(dockpulp_user, dockpulp_password)
+        with self.lock:
+            self.logout(env, dockpulp_user)
+            if login_succeed:
+                self.logins[key] = time.time()
+        return login_succeed, stdout
+
+    def logout(self, env, dockpulp_user=None):
+        """Forget the logins to an environment, of a user or of all users"""
+        for key in list(self.logins):
+            if key[0] == env and dockpulp_user in (None, key[1]):
+                del self.logins[key]
+
+    def handle(self, request):
+        """Run the operation of a request
+        Args:
+            request (dict): The "op", "env" and "args" of the operation
+        Returns:
+            The response, with the "result" of the operation if "ok"
+        """
+        self.last_request = time.time()
+        operation = request.get("op")
+        if operation not in OPERATIONS:
+            return {"ok": False, "error": "unknown operation %s" % operation}
+        env = request.get("env")
+        args = request.get("args") or []
+        try:
+            if operation == "ping":
+                result = os.getpid()
+            elif operation == "login":
+                result = self.login(env, *args)
+            elif operation == "logout":
+                with self.lock:
+                    result = self.logout(env, *args)
+            else:
+                backend, lock = self.backend(env, request.get("user"))
+                with lock:
+                    result = getattr(backend, operation)(*args)
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+        finally:
+            self.last_request = time.time()
+        return {"ok": True, "result": result}
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    """Answer the JSON requests of a connection, one per line"""
+
+    def handle(self):
+        for line in self.rfile:
+            response = self.server.broker.handle(json.loads(line.decode("utf8")))
+            self.wfile.write((json.dumps(response) + "\n").encode("utf8"))
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path, idle_timeout=BROKER_IDLE_TIMEOUT, backend_factory=None):
+    """Serve broker requests on a Unix socket, until idle for idle_timeout seconds
+    Args:
+        path: The path of the Unix socket
+        idle_timeout: Seconds without a request after which to exit
+        backend_factory: Create the backend of an environment, LibraryBackend by default
+    """
+    server = BrokerServer(path, BrokerHandler)
+    server.broker = Broker(backend_factory)
+
+    def watch_idle():
+        while time.time() - server.broker.last_request < idle_timeout:
+            time.sleep(min(1.0, idle_timeout))
+        server.shutdown()
+
+    watcher = threading.Thread(target=watch_idle)
+    watcher.daemon = True
+    watcher.start()
+    try:
+        server.serve_forever(poll_interval=0.2)
+    finally:
+        server.server_close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def start_broker(path, idle_timeout=BROKER_IDLE_TIMEOUT, backend_factory=None):
+    """Start a broker daemon, detached from the module process: it runs in
+    its own session, without the module's stdio and open files, so Ansible
+    doesn't wait for it.
+    """
+    pid = os.fork()
+    if pid:
+        # The first child exits as soon as the daemon is forked
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        # Don't keep the lock of ensure_broker, nor the pipes of Ansible
+        os.closerange(3, 1024)
+        serve(path, idle_timeout, backend_factory)
+    finally:
+        os._exit(0)
+
+
+def request(path, payload, timeout=BROKER_REQUEST_TIMEOUT):
+    """Send one request to the broker
+    Returns:
+        The response of the broker
+    Raises:
+        socket.error if the broker can't be reached
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall((json.dumps(payload) + "\n").encode("utf8"))
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                raise socket.error(errno.ECONNRESET, "the dock-pulp broker closed the connection")
+            data += chunk
+    finally:
+        sock.close()
+    return json.loads(data.decode("utf8"))
+
+
+def ping(path):
+    """Whether a broker is answering on the socket"""
+    try:
+        return request(path, {"op": "ping"}, timeout=1).get("ok", False)
+    except (socket.error, ValueError):
+        return False
+
+
+def ensure_broker(path, idle_timeout=BROKER_IDLE_TIMEOUT, backend_factory=None):
+    """Start a broker on the socket, unless one is already running.
+    Concurrent module processes start a single broker.
+    """
+    if ping(path):
+        return
+    with file_lock(path):
+        if ping(path):
+            return
+        if os.path.exists(path):
+            # Left by a broker which didn't exit cleanly
+            os.unlink(path)
+        start_broker(path, idle_timeout, backend_factory)
+        deadline = time.time() + BROKER_START_TIMEOUT
+        while not ping(path):
+            if time.time() > deadline:
+                raise RuntimeError("The dock-pulp broker did not start on %s" % path)
+            time.sleep(0.01)
+
+
+class BrokerBackend(object):
+    """Run dock-pulp operations in a long-lived local broker process, over
+    a Unix socket. The broker keeps the login and the connections of the
+    dockpulp library between module processes, for up to session_ttl
+    seconds. It's started on first use, and exits once idle for
+    idle_timeout seconds. The operations run as the user of the last login.
+    """
+
+    name = "broker"
+
+    def __init__(
+        self,
+        env,
+        path=None,
+        idle_timeout=BROKER_IDLE_TIMEOUT,
+        backend_factory=None,
+        session_ttl=SESSION_TTL,
+    ):
+        self.env = env
+        self.path = path or broker_path()
+        self.idle_timeout = idle_timeout
+        self.backend_factory = backend_factory
+        self.session_ttl = session_ttl
+        self.dockpulp_user = None
+        ensure_broker(self.path, idle_timeout, backend_factory)
+
+    def call(self, operation, *args):
+        """Run an operation in the broker, starting it again if it exited
+        Returns:
+            The result of the operation
+        """
+        acquire(self.env)
+        METRICS.count("broker_calls")
+        payload = {"op": operation, "env": self.env, "user": self.dockpulp_user, "args": list(args)}
+        try:
+            response = request(self.path, payload)
+        except socket.error as e:
+            if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+                raise RuntimeError("Error calling the dock-pulp broker: %s" % e)
+            ensure_broker(self.path, self.idle_timeout, self.backend_factory)
+            response = request(self.path, payload)
+        if not response.get("ok"):
+            error = response.get("error") or ""
+            if operation != "logout" and is_auth_error(error):
+                # The login of the broker is no longer valid, the next one is made again
+                self.logout(self.dockpulp_user)
+            raise RuntimeError("Error calling the dock-pulp broker: %s" % error)
+        return response["result"]
+
+    def login(self, dockpulp_user, dockpulp_password):
+        self.dockpulp_user = dockpulp_user
+        login_succeed, stdout = self.call(
+            "login", dockpulp_user, dockpulp_password, self.session_ttl or 0
+        )
+        return login_succeed, stdout
+
+    def logout(self, dockpulp_user=None):
+        """Forget the logins of the broker to the environment, of a user or of all users"""
+        self.call("logout", dockpulp_user)
+
+    def get_repo(self, full_repo_name):
+        return self.call("get_repo", full_repo_name)
+
+    def get_repos(self, full_repo_names):
+        return self.call("get_repos", full_repo_names)
+
+    def list_repos(self):
+        return self.call("list_repos")
+
+    def iter_repos(self, page_size):
+        """List all the repos of the environment page by page, see LibraryBackend.iter_repos"""
+        repo_ids = self.call("repo_ids")
+        for start in range(0, len(repo_ids), page_size):
+            end = start + page_size
+            page = repo_ids[start:end]
+            repos = self.get_repos(page)
+            if repos is None:
+                raise RuntimeError("Error listing the repos of %s" % self.env)
+            for repo_id in page:
+                if repo_id in repos:
+                    yield repos[repo_id]
+
+    def create_repo(self, dockpulp_repo):
+        return self.call("create_repo", dockpulp_repo)
+
+    def update_repo(self, full_repo_name, differences):
+        return self.call("update_repo", full_repo_name, differences)
+
+    def delete_repo(self, full_repo_name):
+        return self.call("delete_repo", full_repo_name)
@@ -0,0 +1,380 @@
+import contextlib
+import errno
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+from ansible.module_utils.dockpulp_metrics import METRICS
+
+
+CACHE_DIR_ENV = "DOCKPULP_ANSIBLE_CACHE_DIR"
+
+SESSION_TTL = 8 * 60 * 60
+
+SESSION_STATE = "sessions"
+
+# Seconds the result of a single-flight call is reused by the processes
+# asking for the same thing
+SINGLE_FLIGHT_TTL = 2
+
+# The last time this process deleted the expired single-flight files
+LAST_PRUNE = [0]
+
+
+def get_cache_dir(subdir=None):
+    """Get the user-private directory holding the local state files.
+    The directory is $DOCKPULP_ANSIBLE_CACHE_DIR, or dockpulp-ansible in
+    $XDG_CACHE_HOME (default ~/.cache). It is created with 0700 permissions.
+    Args:
+        subdir: A subdirectory of the cache directory to get instead
+    Returns:
+        The absolute path of the cache directory
+    """
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        cache_dir = os.path.join(cache_home, "dockpulp-ansible")
+    if subdir:
+        cache_dir = os.path.join(cache_dir, subdir)
+    try:
+        os.makedirs(cache_dir, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return cache_dir
+
+
+def state_path(name, suffix=".json"):
+    """Get the path of a state file in the cache directory.
+    Args:
+        name: The name of the state, for example "sessions"
+        suffix: The file extension
+    Returns:
+        The absolute path of the state file
+    """
+    return os.path.join(get_cache_dir(), name + suffix)
+
+
+def read_json(path, default=None):
+    """Read a JSON file, ignoring missing or corrupted files.
+    Args:
+        path: The file to read
+        default: The value returned when the file can't be read
+    Returns:
+        The decoded content of the file
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def write_json(path, data, indent=None):
+    """Atomically replace a JSON file, readable by the current user only.
+    Args:
+        path: The file to write
+        data: The JSON serializable content
+        indent: Indent the content for humans, compact when None
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            if indent:
+                json.dump(data, f, indent=indent, sort_keys=True)
+            else:
+                json.dump(data, f, separators=(",", ":"))
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def file_lock(path, shared=False):
+    """Hold an flock on a lock file next to a state file.
+    The data file itself is replaced on write, so it can't carry the lock.
+    Args:
+        path: The state file to lock
+        shared (bool): take a shared lock for readers instead of an exclusive one
+    """
+    fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def read_state(name):
+    """Read a state file under a shared lock.
+    Args:
+        name: The name of the state
+    Returns:
+        The state dictionary, empty if it doesn't exist yet
+    """
+    path = state_path(name)
+    with file_lock(path, shared=True):
+        return read_json(path, {})
+
+
+@contextlib.contextmanager
+def update_state(name):
+    """Read-modify-write a state file under an exclusive lock.
+    Example:
+        with update_state("sessions") as state:
+            state["key"] = "value"
+    Args:
+        name: The name of the state
+    """
+    path = state_path(name)
+    with file_lock(path):
+        state = read_json(path, {})
+        yield state
+        write_json(path, state)
+
+
+def password_hash(dockpulp_password):
+    """The hash of a password, to recognize it without keeping it"""
+    return hashlib.sha256(dockpulp_password.encode("utf8")).hexdigest()
+
+
+def session_key(env, dockpulp_user):
+    return "%s:%s" % (env, dockpulp_user)
+
+
+def has_session(env, dockpulp_user, ttl=SESSION_TTL):
+    """Check for a login to the environment younger than the ttl.
+    Args:
+        env: The environment logged in to
+        dockpulp_user: The user logged in
+        ttl: Maximum age of the login in seconds, 0 disables the cache
+    Returns:
+        True if a valid session is cached, False otherwise
+    """
+    if not ttl:
+        return False
+    session = read_state(SESSION_STATE).get(session_key(env, dockpulp_user))
+    return bool(session) and time.time() - session["logged_in_at"] < ttl
+
+
+def save_session(env, dockpulp_user):
+    """Remember a successful login to the environment.
+    Args:
+        env: The environment logged in to
+        dockpulp_user: The user logged in
+    """
+    with update_state(SESSION_STATE) as state:
+        state[session_key(env, dockpulp_user)] = {"logged_in_at": time.time()}
+
+
+def invalidate_session(env, dockpulp_user=None):
+    """Forget the cached logins to the environment.
+    Args:
+        env: The environment to forget
+        dockpulp_user: Only forget the login of this user, all users if None
+    """
+    with update_state(SESSION_STATE) as state:
+        for key in list(state):
+            if key == session_key(env, dockpulp_user) or (
+                dockpulp_user is None and key.startswith(env + ":")
+            ):
+                del state[key]
+
+
+def inventory_state(env):
+    return "inventory-%s" % env
+
+
+def read_inventory(env, ttl):
+    """Read the inventory snapshot of an environment.
+    Args:
+        env: The environment of the snapshot
+        ttl: Maximum age of the snapshot in seconds
+    Returns:
+        The repos of the environment by full repo name, None if there is
+        no snapshot younger than the ttl
+    """
+    if not ttl:
+        return None
+    state = read_state(inventory_state(env))
+    if "repos" not in state or time.time() - state["fetched_at"] >= ttl:
+        return None
+    return state["repos"]
+
+
+def write_inventory(env, repos):
+    """Replace the inventory snapshot of an environment.
+    Args:
+        env: The environment of the snapshot
+        repos (dict): All the repos of the environment by full repo name
+    """
+    with update_state(inventory_state(env)) as state:
+        state["fetched_at"] = time.time()
+        state["repos"] = repos
+
+
+def patch_inventory(env, repos):
+    """Merge changed repos into the inventory snapshot of an environment,
+    keeping the changes other processes saved in the meantime.
+    Args:
+        env: The environment of the snapshot
+        repos (dict): The changed repos by full repo name
+    """
+    with update_state(inventory_state(env)) as state:
+        if "repos" in state:
+            state["repos"].update(repos)
+
+
+def fingerprint_state(env):
+    return "fingerprints-%s" % env
+
+
+def repo_fingerprint(env, repo):
+    """Hash the desired values of a repo.
+    Args:
+        env: The environment of the repo
+        repo (dict): The comparable values of the repo
+    Returns:
+        A hex digest, the same for the same env and values
+    """
+    data = json.dumps({"env": env, "repo": repo}, sort_keys=True)
+    return hashlib.sha256(data.encode("utf8")).hexdigest()
+
+
+def read_fingerprints(env, max_age):
+    """Read the fingerprints of the repos applied to an environment.
+    Args:
+        env: The environment of the repos
+        max_age: Maximum age of a fingerprint in seconds
+    Returns:
+        The fingerprints younger than max_age by full repo name
+    """
+    if not max_age:
+        return {}
+    now = time.time()
+    return {
+        full_repo_name: entry["fingerprint"]
+        for full_repo_name, entry in read_state(fingerprint_state(env)).items()
+        if now - entry["applied_at"] < max_age
+    }
+
+
+def write_fingerprints(env, fingerprints):
+    """Record the fingerprints of repos just applied to, or found in line
+    with, an environment.
+    Args:
+        env: The environment of the repos
+        fingerprints (dict): The fingerprints by full repo name
+    """
+    now = time.time()
+    with update_state(fingerprint_state(env)) as state:
+        for full_repo_name, fingerprint in fingerprints.items():
+            state[full_repo_name] = {"fingerprint": fingerprint, "applied_at": now}
+
+
+def flight_path(env, operation, name=""):
+    """Get the result file of the single-flight calls of an operation.
+    Args:
+        env: The environment of the operation
+        operation: The operation, for example "lookup"
+        name: The subject of the operation, for example a full repo name
+    Returns:
+        The absolute path of the result file
+    """
+    key = re.sub(r"[^\w.-]", "_", "%s--%s--%s" % (env, operation, name))
+    return os.path.join(get_cache_dir("flights"), key + ".json")
+
+
+def single_flight(env, operation, name, func, ttl=SINGLE_FLIGHT_TTL):
+    """Call func once for all the processes of the host asking for the same
+    operation at the same time.
+    The first process takes the lock of the operation, calls func, and
+    saves its result. The processes waiting on the lock then reuse that
+    result, as long as it is younger than ttl, instead of calling func again.
+    Example:
+        repo = single_flight("qa", "lookup", name, lambda: get_repo(name))
+    Args:
+        env: The environment of the operation
+        operation: The operation, for example "lookup"
+        name: The subject of the operation, for example a full repo name
+        func: The call, returning a JSON serializable result
+        ttl: Maximum age in seconds of a result reused, 0 always calls func
+    Returns:
+        The result of func, from this process or another one
+    """
+    if not ttl:
+        return func()
+    path = flight_path(env, operation, name)
+    with file_lock(path):
+        flight = read_json(path)
+        if flight and 0 <= time.time() - flight["at"] < ttl:
+            METRICS.count("single_flight_hits")
+            return flight["result"]
+        result = func()
+        write_json(path, {"at": time.time(), "result": result})
+    prune_flights(max(ttl, SINGLE_FLIGHT_TTL))
+    return result
+
+
+def prune_flights(ttl=SINGLE_FLIGHT_TTL):
+    """Delete the result files of the single-flight calls older than ttl,
+    with their lock files, at most once per ttl in a process. The flights
+    in progress keep their files.
+    Args:
+        ttl: Age in seconds above which a result is expired
+    """
+    now = time.time()
+    if now - LAST_PRUNE[0] < ttl:
+        return
+    LAST_PRUNE[0] = now
+    for lock_path in glob.glob(os.path.join(get_cache_dir("flights"), "*.json.lock")):
+        path = lock_path[: -len(".lock")]
+        try:
+            mtime = os.stat(path if os.path.exists(path) else lock_path).st_mtime
+            if now - mtime < ttl:
+                continue
+            fd = os.open(lock_path, os.O_RDWR)
+        except OSError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            unlink(path)
+            unlink(lock_path)
+        except (IOError, OSError):
+            # Locked by a flight in progress
+            pass
+        finally:
+            os.close(fd)
+
+
+def unlink(path):
+    """Delete a file, missing or not"""
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def forget_flights(env, operation, name=None):
+    """Forget the results of the single-flight calls of an operation, after
+    a change making them wrong.
+    Args:
+        env: The environment of the operation
+        operation: The operation, for example "lookup"
+        name: Only forget the calls about this subject, all of them if None
+    """
+    if name is None:
+        prefix = flight_path(env, operation)[: -len(".json")]
+        paths = glob.glob(prefix + "*.json")
+    else:
+        paths = [flight_path(env, operation, name)]
+    for path in paths:
+        unlink(path)
+        unlink(path + ".lock")
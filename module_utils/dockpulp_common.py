@@ -1,3 +1,1692 @@
+import collections
+import fnmatch
+import json
+import re
+import subprocess
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from ansible.module_utils.dockpulp_backend import BACKENDS
+from ansible.module_utils.dockpulp_cache import (
+    SESSION_TTL,
+    SINGLE_FLIGHT_TTL,
+    forget_flights,
+    has_session,
+    invalidate_session,
+    password_hash,
+    patch_inventory,
+    read_fingerprints,
+    read_inventory,
+    repo_fingerprint,
+    save_session,
+    single_flight,
+    write_fingerprints,
+    write_inventory,
+    write_json,
+)
+from ansible.module_utils.dockpulp_http import TASK_FINAL_STATES, TASK_TIMEOUT
+from ansible.module_utils.dockpulp_latency import (
+    CommandTimeout,
+    backoff,
+    check_circuit,
+    command_operation,
+    configure_latency,
+    is_transient_error,
+    policy,
+    record_latency,
+    record_outcome,
+    timeout_for,
+)
+from ansible.module_utils.dockpulp_metrics import METRICS, timed
+from ansible.module_utils.dockpulp_ratelimit import acquire, command_env, configure_rate_limit
+from ansible.module_utils.six import string_types
+
+try:
+    import yaml
+
+    HAS_YAML = True
+except ImportError:
+    HAS_YAML = False
+
+
+DOCK_PULP_TIMEOUT = 120
+
+BATCH_SIZE = 50
+
+ENGINE_CHOICES = ["sync", "asyncio"]
+
+# Characters of a streamed output kept for error messages
+MAX_KEPT_OUTPUT = 64 * 1024
+
+UPDATE_MAP = {
+    "description": "--description",
+    "title": "--title",
+    "docker-id": "--dockerid",
+    "distribution": "--distribution",
+}
+
+# In-process memo of the environments logged in to, in front of the
+# session cache shared by every module process (see dockpulp_cache)
+LOGGED_IN = {
+    "qa": False,
+    "stage": False,
+    "prod": False,
+}
+
+# Output of dock-pulp when its login certificate is missing or no longer valid
+AUTH_ERRORS = (
+    "unauthorized",
+    "authentication failed",
+    "certificate expired",
+    "certificate has expired",
+    "not logged in",
+)
+
+COMPARABLES = ["description", "title", "docker-id", "distribution"]
+
+# In-process index of all the repos of an environment by full repo name,
+# loaded from the inventory snapshot (see load_inventory)
+INVENTORY = {}
+
+# Repos created or updated since the inventory snapshot was loaded
+INVENTORY_CHANGES = {}
+
+# Environments indexed from an exported inventory snapshot file, by path.
+# Their login and lookups only read the file (see load_offline_inventory)
+OFFLINE = {}
+
+# Age in seconds above which an inventory snapshot file gets a warning
+INVENTORY_FILE_MAX_AGE = 24 * 60 * 60
+
+LOG_LEVEL = re.compile(r"^(DEBUG|INFO|WARNING|ERROR|CRITICAL)\s+")
+
+
+@timed("login")
+def login(
+    env, dockpulp_user, dockpulp_password, timeout=DOCK_PULP_TIMEOUT, session_ttl=SESSION_TTL
+):
+    """Login to docker pulp
+    A login younger than session_ttl, from this or any previous module
+    process, is reused instead of running dock-pulp login again.
+    Args:
+        env: The environment to log in to
+        timeout: Maximum number of seconds to wait for a result (default = 120)
+        session_ttl: Maximum age in seconds of a cached login, 0 disables the cache
+    Returns:
+        True if login is successful, False otherwise
+        stdout when the command is executed
+    """
+    command = [
+        "dock-pulp",
+        "-d",
+        "--server",
+        env,
+        "login",
+        "-u",
+        dockpulp_user,
+        "-p",
+        dockpulp_password,
+    ]
+    if LOGGED_IN.get(env) or env in OFFLINE:
+        return True, ""
+    if env in BACKENDS:
+        # The in-process backend keeps its certificate, it can't reuse the session cache
+        LOGGED_IN[env], stdout = BACKENDS[env].login(dockpulp_user, dockpulp_password)
+        return LOGGED_IN[env], stdout
+    if has_session(env, dockpulp_user, session_ttl):
+        LOGGED_IN[env] = True
+        return LOGGED_IN[env], ""
+
+    # Concurrent logins of the same user and password from other processes
+    # share one dock-pulp login, unless the session cache is disabled
+    returncode, stdout = single_flight(
+        env,
+        "login",
+        "%s--%s" % (dockpulp_user, password_hash(dockpulp_password)),
+        lambda: execute_command(command, timeout),
+        SINGLE_FLIGHT_TTL if session_ttl else 0,
+    )
+    if returncode == 0:
+        LOGGED_IN[env] = True
+        if session_ttl:
+            save_session(env, dockpulp_user)
+    return LOGGED_IN.get(env, False), stdout
+
+
+def is_auth_error(output):
+    """Check if a dock-pulp command failed because of the login
+    Args:
+        output (str): The output of the dock-pulp command
+    Returns:
+        True if the output reports an authentication error
+    """
+    output = output.lower()
+    return any(error in output for error in AUTH_ERRORS)
+
+
+def logout(env, dockpulp_user=None):
+    """Forget the login to an environment, in this process, the session cache
+    and the broker
+    Args:
+        env: The environment to forget
+        dockpulp_user: Only forget the login of this user, all users if None
+    """
+    LOGGED_IN[env] = False
+    invalidate_session(env, dockpulp_user)
+    # The login flights are keyed by password hash too, forget the whole env
+    forget_flights(env, "login")
+    if hasattr(BACKENDS.get(env), "logout"):
+        BACKENDS[env].logout(dockpulp_user)
+
+
+def execute_command(command, timeout=DOCK_PULP_TIMEOUT):
+    """Execute a given command using the subprocess module
+    With adaptive timeouts, the timeout is lowered to the one derived from
+    the latency of the operation (see dockpulp_latency.timeout_for).
+    Args:
+        command (list): List of args for a command
+        timeout: Maximum number of seconds to wait for a result
+    Returns:
+        The CompletedProcess object from running the command
+    Raises:
+        RuntimeError if the circuit of the environment is open
+        CommandTimeout, a RuntimeError, if the command timed out, after
+        killing it and counting the failure for the circuit breaker
+    """
+    env = command_env(command)
+    operation = command_operation(command)
+    check_circuit(env)
+    timeout = timeout_for(env, operation, timeout)
+    acquire(env)
+    # Attempting dock-pulp command with args
+    # In python39, we use subprocess.run
+    # To support py27, we use subprocess.Popen
+    start = time.time()
+    result = subprocess.Popen(
+        command,
+        encoding="utf8",
+        stderr=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    try:
+        outs, errs = result.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        result.kill()
+        result.communicate()
+        record_latency(env, operation, time.time() - start)
+        record_outcome(env, False)
+        METRICS.count("commands")
+        raise CommandTimeout(command, timeout)
+    output = outs + errs
+    returncode = result.poll()
+    record_latency(env, operation, time.time() - start)
+    record_outcome(env, returncode == 0 or not is_transient_error(output))
+    METRICS.count("commands")
+    METRICS.count("output_bytes", len(output.encode("utf8")))
+    return returncode, output
+
+
+def read_command(command, timeout=DOCK_PULP_TIMEOUT):
+    """Execute a command which only reads, like execute_command, retrying it
+    when it times out or fails with a transient error, after a jittered
+    exponential backoff (see dockpulp_latency.backoff). The number of
+    retries is the "read_retries" of the environment.
+    Raises:
+        RuntimeError if the circuit of the environment is open
+        CommandTimeout if the last attempt timed out
+    """
+    retries = policy(command_env(command))["retries"]
+    attempt = 0
+    while True:
+        try:
+            returncode, output = execute_command(command, timeout)
+            if returncode == 0 or not is_transient_error(output) or attempt >= retries:
+                return returncode, output
+        except CommandTimeout:
+            if attempt >= retries:
+                raise
+        METRICS.count("read_retries")
+        time.sleep(backoff(attempt))
+        attempt += 1
+
+
+class CommandStream(object):
+    """Execute a command and read its output line by line, without holding
+    the whole output in memory. Only the last max_kept characters of the
+    output are kept for error messages.
+    Example:
+        stream = CommandStream(["dock-pulp", "--server", "qa", "list", "-d"])
+        repos = parse_repos(stream)
+        if stream.returncode != 0:
+            raise RuntimeError(stream.output)
+    """
+
+    def __init__(self, command, timeout=DOCK_PULP_TIMEOUT, max_kept=MAX_KEPT_OUTPUT):
+        self.command = command
+        self.timeout = timeout
+        self.max_kept = max_kept
+        self.returncode = None
+        self.kept = collections.deque()
+        self.kept_size = 0
+
+    @property
+    def output(self):
+        """The last lines of the output"""
+        return "".join(self.kept)
+
+    def keep(self, line):
+        self.kept.append(line)
+        self.kept_size += len(line)
+        while self.kept_size > self.max_kept and len(self.kept) > 1:
+            self.kept_size -= len(self.kept.popleft())
+
+    def __iter__(self):
+        env = command_env(self.command)
+        operation = command_operation(self.command)
+        check_circuit(env)
+        self.timeout = timeout_for(env, operation, self.timeout)
+        acquire(env)
+        start = time.time()
+        process = subprocess.Popen(
+            self.command,
+            encoding="utf8",
+            stderr=subprocess.STDOUT,
+            stdout=subprocess.PIPE,
+        )
+        # readline() can't time out, kill the process instead
+        timer = threading.Timer(self.timeout, process.kill)
+        timer.start()
+        try:
+            METRICS.count("commands")
+            for line in process.stdout:
+                METRICS.count("output_bytes", len(line.encode("utf8")))
+                self.keep(line)
+                yield line
+            self.returncode = process.wait()
+        finally:
+            timed_out = not timer.is_alive()
+            timer.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            # A listing stopped by its reader says nothing of the server
+            if timed_out or self.returncode is not None:
+                record_latency(env, operation, time.time() - start)
+                record_outcome(
+                    env,
+                    not timed_out and (self.returncode == 0 or not is_transient_error(self.output)),
+                )
+        if timed_out:
+            raise CommandTimeout(self.command, self.timeout, self.output)
+
+
+def create_command(env, dockpulp_repo):
+    """Build the command to create the repos based on the
+    current environment.
+    Args:
+        server: The environment to use
+        component (dict): The dockpulp repo to create
+    Returns:
+        The command required to create dock-pulp repository
+    """
+    repo_name = dockpulp_repo.get("repo_name")
+    distribution = dockpulp_repo.get("distribution")
+    description = dockpulp_repo.get("description")
+    namespace = dockpulp_repo.get("namespace")
+    content_url = dockpulp_repo.get("content_url")
+
+    command = [
+        "dock-pulp",
+        "--server",
+        env,
+        "create",
+        namespace,
+        repo_name,
+        content_url,
+        "--description=%s" % description,
+        "--distribution=%s" % distribution,
+    ]
+    return command
+
+
+def update_command(env, full_name, differences):
+    """Build the command to update a given repo
+    based on which fields need to be modified
+    Args:
+        server: Environment to run command on
+        full_name: the full repo name
+        modified (dict): A dictionary of changes
+    Returns:
+        The command to update an existing repository
+    """
+    command = [
+        "dock-pulp",
+        "--server",
+        env,
+        "update",
+        full_name,
+    ]
+    # Modified is in the form [('key', 'current_value', 'new_value')]
+    for key, _, new_value in differences:
+        line = "%s=%s" % (UPDATE_MAP.get(key), new_value)
+        command.append(line)
+    return command
+
+
+def delete_command(env, full_name):
+    """Build the command to delete a given repo
+    Args:
+        env: Environment to run command on
+        full_name: the full repo name
+    Returns:
+        The command to delete an existing repository
+    """
+    return ["dock-pulp", "--server", env, "delete", full_name]
+
+
+def list_command(env, full_repo_names=()):
+    """Build the command to list repos with their details
+    Args:
+        env: Environment to run command on
+        full_repo_names: the full names of the repos to list, all of them by default
+    Returns:
+        The command to list the repos
+    """
+    return ["dock-pulp", "--server", env, "list", "-d"] + list(full_repo_names)
+
+
+def get_comparable_repo(repo):
+    """Get a subset of comparable data from a repo.
+    HB can only change certain values so it's important to only compare those.
+    Args:
+        repo (dict): The repo to pull comparable values from
+    Returns:
+        A subset of the repo dict with only comparable values
+    """
+    if not repo:
+        return repo
+    return {key: value for key, value in repo.items() if key in COMPARABLES}
+
+
+@timed("update_dockpulp_repo")
+def update_dockpulp_repo(env, full_repo_name, differences):
+    if env in BACKENDS:
+        return BACKENDS[env].update_repo(full_repo_name, differences)
+    command = update_command(env, full_repo_name, differences)
+    returncode, stdout = execute_command(command)
+    if returncode != 0 and is_auth_error(stdout):
+        logout(env)
+    return returncode
+
+
+@timed("create_dockpulp_repo")
+def create_dockpulp_repo(env, dockpulp_repo):
+    if env in BACKENDS:
+        return BACKENDS[env].create_repo(dockpulp_repo)
+    command = create_command(env, dockpulp_repo)
+    returncode, stdout = execute_command(command)
+    if returncode != 0 and is_auth_error(stdout):
+        logout(env)
+    return returncode
+
+
+@timed("delete_dockpulp_repo")
+def delete_dockpulp_repo(env, full_repo_name):
+    if env in BACKENDS:
+        return BACKENDS[env].delete_repo(full_repo_name)
+    command = delete_command(env, full_repo_name)
+    returncode, stdout = execute_command(command)
+    if returncode != 0 and is_auth_error(stdout):
+        logout(env)
+    return returncode
+
+
+def iter_repos(lines):
+    """Parse the lines of a dock-pulp list, one repo at a time
+    Every repo starts with a line holding its name, followed by its
+    "key = value" details. Lines logged at another level than INFO are skipped.
+    Args:
+        lines: The lines of the output of the dock-pulp command
+    Yields:
+        The name and the dictionary of every repo parsed
+    """
+    name = None
+    repo = None
+    for line in lines:
+        level = LOG_LEVEL.match(line)
+        if level and level.group(1) != "INFO":
+            continue
+        line = LOG_LEVEL.sub("", line).strip()
+        if " = " in line:
+            key, value = line.split(" = ", 1)
+            if repo is None:
+                repo = {}
+            repo[key] = value
+        elif line.strip("-"):
+            if repo is not None:
+                yield name, repo
+            name = line
+            repo = None
+    if repo is not None:
+        yield name, repo
+
+
+def parse_output(output):
+    """Parse the output of a dock-pulp command
+    Args:
+        output (str): The output of the dock-pulp command
+    Returns:
+        A dictionary with the results parsed, for the first repo of the output
+    Example:
+        {'title': 'repo-name', 'distribution': 'ga'}
+    """
+    for _, repo in iter_repos(output.split("\n")):
+        return repo
+    return {}
+
+
+def parse_repos(output):
+    """Parse the output of a dock-pulp list of several repos
+    Args:
+        output: The output of the dock-pulp command, or an iterable of its
+                lines like a CommandStream
+    Returns:
+        A dictionary of the repos parsed, by full repo name
+    Example:
+        {'redhat-ns-repo': {'title': 'repo-name', 'distribution': 'ga'}}
+    """
+    lines = output.split("\n") if isinstance(output, str) else output
+    return {repo.get("id", name): repo for name, repo in iter_repos(lines)}
+
+
+@timed("list_all_repos")
+def list_all_repos(env, timeout=DOCK_PULP_TIMEOUT):
+    """List all the repos of an environment in one dock-pulp call
+    Args:
+        env: The environment to list
+        timeout: maximum number of seconds allowed for the command to execute
+    Returns:
+        A dictonary of the repos by full repo name, None if the listing failed
+    """
+    if env in BACKENDS:
+        return BACKENDS[env].list_repos()
+
+    command = list_command(env)
+    retries = policy(env)["retries"]
+    attempt = 0
+    while True:
+        # The listing of a whole environment is large, parse it while it's read
+        stream = CommandStream(command, timeout)
+        try:
+            repos = parse_repos(stream)
+            if stream.returncode == 0:
+                return repos
+            if not is_transient_error(stream.output) or attempt >= retries:
+                return None
+        except CommandTimeout:
+            if attempt >= retries:
+                raise
+        METRICS.count("read_retries")
+        time.sleep(backoff(attempt))
+        attempt += 1
+
+
+def iter_all_repos(env, timeout=DOCK_PULP_TIMEOUT, page_size=BATCH_SIZE):
+    """Stream all the repos of an environment, parsing the listing while it's
+    read, so the whole listing is never held in memory. Stopping the
+    iteration stops the listing.
+    Args:
+        env: The environment to list, after logging in
+        timeout: maximum number of seconds allowed for the listing
+        page_size: number of repos listed by one call of the library backend
+    Yields:
+        The full repo name and the dictionary of every repo
+    Raises:
+        RuntimeError if the listing failed
+    """
+    if env in INVENTORY:
+        for full_repo_name, repo in INVENTORY[env].items():
+            if repo is not None:
+                yield full_repo_name, repo
+        return
+    if env in BACKENDS:
+        for repo in BACKENDS[env].iter_repos(page_size):
+            yield repo["id"], repo
+        return
+
+    # The listing is retried like read_command, until it yields a repo
+    retries = policy(env)["retries"]
+    attempt = 0
+    yielded = False
+    while True:
+        stream = CommandStream(list_command(env), timeout)
+        try:
+            for name, repo in iter_repos(stream):
+                yielded = True
+                yield repo.get("id", name), repo
+            if stream.returncode == 0:
+                return
+            if yielded or not is_transient_error(stream.output) or attempt >= retries:
+                raise RuntimeError("Error listing the repos of %s: %s" % (env, stream.output))
+        except CommandTimeout:
+            if yielded or attempt >= retries:
+                raise
+        METRICS.count("read_retries")
+        time.sleep(backoff(attempt))
+        attempt += 1
+
+
+def repo_record(full_repo_name, repo):
+    """The record of a repo returned by dockpulp_repo_info: the values of the
+    repo, with its full_repo_name, and the namespace and repo_name of its docker-id
+    """
+    namespace, _, repo_name = (repo.get("docker-id") or "").partition("/")
+    record = dict(repo)
+    record.update(
+        full_repo_name=full_repo_name,
+        namespace=namespace or None,
+        repo_name=repo_name or None,
+    )
+    return record
+
+
+def match_repo(record, namespace=None, distribution=None, name=None):
+    """Whether a repo record matches all the filters which are set
+    Args:
+        record (dict): The record of the repo, see repo_record
+        namespace: The namespace of the repo
+        distribution: The distribution of the repo
+        name: A shell glob matching the repo_name of the repo
+    """
+    if namespace and record["namespace"] != namespace:
+        return False
+    if distribution and record.get("distribution") != distribution:
+        return False
+    if name and not fnmatch.fnmatchcase(record["repo_name"] or "", name):
+        return False
+    return True
+
+
+@timed("find_dockpulp_repos")
+def find_dockpulp_repos(params):
+    """Find the repos of an environment matching the filters of the module
+    params, one page at a time. The listing of the environment is streamed,
+    and stops once the page is full.
+    Args:
+        params (dict): The env and credentials, the "names" of the repos to
+                       look up instead of listing the environment, the
+                       "namespace", "distribution" and "name" filters, and
+                       the "offset" and "limit" of the page
+    Returns:
+        A list of repo records (see repo_record), in the order of the listing
+        The offset of the next page, None if this is the last one
+    """
+    env = params.get("env")
+    connect(params)
+    names = params.get("names")
+    if names:
+        found = get_existing_repos(
+            names,
+            env,
+            params.get("dockpulp_user"),
+            params.get("dockpulp_password"),
+            batch_size=params.get("batch_size") or BATCH_SIZE,
+        )
+        repos = ((name, found[name]) for name in names if found.get(name))
+    else:
+        repos = iter_all_repos(env, page_size=params.get("batch_size") or BATCH_SIZE)
+
+    offset = params.get("offset") or 0
+    limit = params.get("limit") or 0
+    records = []
+    matched = 0
+    for full_repo_name, repo in repos:
+        record = repo_record(full_repo_name, repo)
+        if not match_repo(
+            record, params.get("namespace"), params.get("distribution"), params.get("name")
+        ):
+            continue
+        matched += 1
+        if matched <= offset:
+            continue
+        if limit and len(records) == limit:
+            # There is a next page, stop the listing here
+            return records, offset + limit
+        records.append(record)
+    return records, None
+
+
+def load_inventory(env, inventory_ttl):
+    """Load the index of all the repos of an environment, which
+    get_existing_repo reads instead of asking the server.
+    The index comes from the inventory snapshot, and the snapshot is
+    refreshed with one listing of the server once older than inventory_ttl.
+    Args:
+        env: The environment to index, after logging in
+        inventory_ttl: Maximum age of the snapshot in seconds, 0 disables the index
+    Returns:
+        True if the index is loaded, False otherwise
+    """
+    if env in INVENTORY or not inventory_ttl:
+        return env in INVENTORY
+    repos = read_inventory(env, inventory_ttl)
+    if repos is None:
+        repos = list_all_repos(env)
+        if repos is None:
+            # Fall back to looking up every repo
+            return False
+        write_inventory(env, repos)
+    INVENTORY[env] = repos
+    INVENTORY_CHANGES[env] = {}
+    return True
+
+
+def load_offline_inventory(env, path, max_age=INVENTORY_FILE_MAX_AGE):
+    """Index the repos of an environment from an exported inventory snapshot,
+    for a check mode without the server. The login and the lookups of the
+    environment then only read the snapshot, without a backend.
+    The snapshot is a JSON file with the repos by full repo name under
+    "repos", and the time they were listed under "fetched_at", like the
+    inventory snapshots of the cache directory.
+    Args:
+        env: The environment of the snapshot
+        path: The path of the snapshot file
+        max_age: Age in seconds above which the snapshot is stale
+    Returns:
+        A warning if the snapshot is stale or of unknown age, None otherwise
+    Raises:
+        ValueError if the file is not an inventory snapshot
+    """
+    with open(path) as f:
+        state = json.load(f)
+    repos = state.get("repos") if isinstance(state, dict) else None
+    if not isinstance(repos, dict):
+        raise ValueError("%s is not an inventory snapshot" % path)
+    INVENTORY[env] = repos
+    INVENTORY_CHANGES[env] = {}
+    OFFLINE[env] = path
+    BACKENDS.pop(env, None)
+
+    fetched_at = state.get("fetched_at")
+    if not fetched_at:
+        return "The age of the inventory snapshot %s is unknown" % path
+    age = time.time() - fetched_at
+    if age > max_age:
+        return "The inventory snapshot %s is %d hours old" % (path, age // 3600)
+    return None
+
+
+def update_inventory(env, full_repo_name, values):
+    """Record our own create or update of a repo in the inventory index
+    Args:
+        env: The environment of the repo
+        full_repo_name: the full name of the repo
+        values (dict): The new values of the repo, None if it was deleted
+    """
+    # The lookups shared before the change are out of date
+    forget_flights(env, "lookup", full_repo_name)
+    if env not in INVENTORY:
+        return
+    if values is None:
+        # Deleted, None is what a lookup of a missing repo returns
+        repo = None
+    else:
+        repo = dict(INVENTORY[env].get(full_repo_name) or {"id": full_repo_name})
+        repo.update(values)
+    INVENTORY[env][full_repo_name] = repo
+    INVENTORY_CHANGES[env][full_repo_name] = repo
+
+
+def save_inventory(env):
+    """Write our creates and updates back to the inventory snapshot
+    Args:
+        env: The environment of the snapshot
+    """
+    changes = INVENTORY_CHANGES.get(env)
+    if changes and env not in OFFLINE:
+        patch_inventory(env, changes)
+        INVENTORY_CHANGES[env] = {}
+
+
+@timed("get_existing_repo")
+def get_existing_repo(
+    full_repo_name, env, dockpulp_user, dockpulp_password, timeout=DOCK_PULP_TIMEOUT
+):
+    """Check that a Docker Pulp repo exists. If it does, return the result.
+    Args:
+        full_repo_name: the full name of the repo to check
+        server: 'stage', 'prod', 'qa'
+        timeout: maximum number of seconds allowed for the command to execute
+    Returns:
+        A dictonary representing the repo or None if it does not exist
+    """
+    return lookup_repo(full_repo_name, env, dockpulp_user, dockpulp_password, timeout)
+
+
+def lookup_repo(full_repo_name, env, dockpulp_user, dockpulp_password, timeout=DOCK_PULP_TIMEOUT):
+    """Look up one repo like get_existing_repo, without a phase of its own
+    in the metrics, for the phases looking up many repos"""
+    login_succeed, stdout = login(env, dockpulp_user, dockpulp_password)
+    if not login_succeed:
+        raise RuntimeError("Error logging into dock-pulp: %s" % stdout)
+
+    if env in INVENTORY:
+        return INVENTORY[env].get(full_repo_name)
+
+    # Concurrent lookups of the same repo from other processes share one call
+    if env in BACKENDS:
+        return single_flight(
+            env, "lookup", full_repo_name, lambda: BACKENDS[env].get_repo(full_repo_name)
+        )
+
+    command = list_command(env, [full_repo_name])
+    returncode, stdout = single_flight(
+        env, "lookup", full_repo_name, lambda: read_command(command, timeout)
+    )
+
+    # The cached login is no longer valid, log in again and retry once
+    if returncode != 0 and is_auth_error(stdout):
+        forget_flights(env, "lookup", full_repo_name)
+        logout(env, dockpulp_user)
+        login_succeed, login_stdout = login(env, dockpulp_user, dockpulp_password)
+        if not login_succeed:
+            raise RuntimeError("Error logging into dock-pulp: %s" % login_stdout)
+        returncode, stdout = read_command(command, timeout)
+
+    if returncode != 0:
+        return None
+
+    return parse_output(stdout)
+
+
+def missing_repos(output, full_repo_names):
+    """Find the repos a failed dock-pulp list reports as missing
+    Args:
+        output (str): The output of the dock-pulp list
+        full_repo_names (list): The full names of the listed repos
+    Returns:
+        The full names of the listed repos named in the output
+    """
+    return [
+        full_repo_name
+        for full_repo_name in full_repo_names
+        if re.search(r"(?<![\w-])%s(?![\w-])" % re.escape(full_repo_name), output)
+    ]
+
+
+def list_batch(env, full_repo_names, timeout=DOCK_PULP_TIMEOUT):
+    """List a batch of repos with one dock-pulp list. dock-pulp fails the
+    whole list when one of the repos doesn't exist, and names it: the
+    missing repos are dropped and the rest of the batch listed again.
+    Args:
+        env: The environment to list
+        full_repo_names (list): The full names of the repos to list
+        timeout: maximum number of seconds allowed for one command to execute
+    Returns:
+        A dictonary of the repos by full repo name, None for the repos which
+        do not exist, or None if a list failed without naming a missing repo
+    """
+    found = {}
+    remaining = list(full_repo_names)
+    while remaining:
+        returncode, stdout = read_command(list_command(env, remaining), timeout)
+        if returncode == 0:
+            found.update(parse_repos(stdout))
+            break
+        missing = missing_repos(stdout, remaining)
+        if not missing:
+            return None
+        found.update((full_repo_name, None) for full_repo_name in missing)
+        remaining = [name for name in remaining if name not in missing]
+    return found
+
+
+@timed("get_existing_repos")
+def get_existing_repos(
+    full_repo_names,
+    env,
+    dockpulp_user,
+    dockpulp_password,
+    batch_size=BATCH_SIZE,
+    timeout=DOCK_PULP_TIMEOUT,
+):
+    """Look up many Docker Pulp repos, batch_size repos per dock-pulp list.
+    Args:
+        full_repo_names (list): the full names of the repos to check
+        env: 'stage', 'prod', 'qa'
+        batch_size: maximum number of repos listed by one dock-pulp call
+        timeout: maximum number of seconds allowed for one command to execute
+    Returns:
+        A dictonary of the repos by full repo name, None for the repos which
+        do not exist
+    """
+    login_succeed, stdout = login(env, dockpulp_user, dockpulp_password)
+    if not login_succeed:
+        raise RuntimeError("Error logging into dock-pulp: %s" % stdout)
+
+    repos = {}
+    for start in range(0, len(full_repo_names), batch_size):
+        end = start + batch_size
+        batch = full_repo_names[start:end]
+        found = None
+        if env in INVENTORY:
+            found = INVENTORY[env]
+        elif env in BACKENDS:
+            found = BACKENDS[env].get_repos(batch)
+        else:
+            found = list_batch(env, batch, timeout)
+
+        # A list failed for another reason, like an expired login, look up
+        # the repos of that batch one by one
+        if found is None:
+            found = {}
+            for full_repo_name in batch:
+                found[full_repo_name] = lookup_repo(
+                    full_repo_name, env, dockpulp_user, dockpulp_password, timeout
+                )
+        for full_repo_name in batch:
+            repos[full_repo_name] = found.get(full_repo_name)
+    return repos
+
+
+def prepare_diff_data(dockpulp_repo, repo):
+    """Prepare diff data for result.
+    Args:
+        dockpulp_repo (dict): dockpulp repo from dockpulp server
+        repo (dict): Repo specified via module params
+    Returns:
+        A dictonary for comparing the existing repo and params
+    """
+    if dockpulp_repo:
+        before_header = dockpulp_repo["docker-id"]
+        after_header = repo["docker-id"]
+    else:
+        before_header = "Not present"
+        after_header = "New container repository %s" % repo["docker-id"]
+
+        # Need to use an empty dict instead of None otherwise
+        # ansible's built-in diff callback will throw errors
+        # trying to call splitlines() on it
+        dockpulp_repo = {}
+
+    return {
+        "before_header": before_header,
+        "after_header": after_header,
+        "before": dockpulp_repo,
+        "after": repo,
+    }
+
+
+def validate_content_url(repo_name, content_url):
+    """Check the content url of a repo spec.
+    Args:
+        repo_name: the label of the repo
+        content_url: the path for content of the repo
+    Returns:
+        An error message if the content url is invalid, None otherwise
+    """
+    # The repos of a manifest may hold numbers or nulls, which never match
+    # the strings dock-pulp reports
+    if not isinstance(repo_name, string_types):
+        return "the repo_name %r needs to be a string" % (repo_name,)
+    if not isinstance(content_url, string_types):
+        return "the content-url of %s needs to be a string" % repo_name
+    if not content_url.startswith("/content"):
+        return "the content-url needs to start with /content"
+    if not content_url.rstrip("/").endswith(repo_name):
+        return "the content-url needs to end with %s" % repo_name
+    return None
+
+
+def build_new_repo(params):
+    """Build the desired repo from module params.
+    Args:
+        params (dict): The dockpulp repo specified via module params
+    Returns:
+        The full repo name and a dictionary with the comparable values
+    """
+    # The only fields that are possible to change are distribution and description
+    # Only way for others to change would be repo name or namepsace change
+    # which would lead to a new repo created anyways
+    repo_name = params.get("repo_name")
+    namespace = params.get("namespace")
+    full_repo_name = "redhat-%s-%s" % (namespace, repo_name)
+    new_repo = {
+        "description": params.get("description"),
+        "title": full_repo_name,
+        "docker-id": "%s/%s" % (namespace, repo_name),
+        "distribution": params.get("distribution"),
+    }
+    return full_repo_name, new_repo
+
+
+def plan_dockpulp_repo(params, old_repo):
+    """Work out what it takes to bring a dockpulp repo in line with the module params.
+    Args:
+        params (dict): The dockpulp repo specified via module params
+        old_repo (dict): The comparable existing repo, None if it does not exist
+    Returns:
+        A dictonary for ansible result
+        The change to apply (see apply_dockpulp_change), None if there is nothing to do
+    """
+    result = {"returncode": 0, "changed": False, "stdout_lines": []}
+    full_repo_name, new_repo = build_new_repo(params)
+    if old_repo:
+        differences = diff_settings(old_repo, new_repo)
+
+    # Repo exists and have same params, no need to update
+    if old_repo and not differences:
+        # Repo for %s already exists - skipping
+        return result, None
+
+    # Dockpulp repo exists but need update
+    if old_repo and differences:
+        result["changed"] = True
+        changes = describe_changes(differences)
+        result["stdout_lines"].extend(changes)
+        result["diff"] = prepare_diff_data(old_repo, new_repo)
+        return result, ("update", full_repo_name, differences)
+
+    # Dockpulp repo doesn't exist, create a new dockpulp repo
+    result["changed"] = True
+    result["stdout_lines"] = ["Created %s" % full_repo_name]
+    result["diff"] = prepare_diff_data(old_repo, new_repo)
+    new_repo_params = {
+        "description": params.get("description"),
+        "repo_name": params.get("repo_name"),
+        "namespace": params.get("namespace"),
+        "content_url": params.get("content_url"),
+        "distribution": params.get("distribution"),
+    }
+    return result, ("create", new_repo_params)
+
+
+def apply_dockpulp_change(env, change):
+    """Apply a change planned by plan_dockpulp_repo
+    Args:
+        env: The environment to run dock-pulp command
+        change (tuple): ("update", full_repo_name, differences), ("create", repo)
+                        or ("delete", full_repo_name)
+    Returns:
+        The returncode of the update, create or delete
+    """
+    if change[0] == "update":
+        full_repo_name, differences = change[1], change[2]
+        returncode = update_dockpulp_repo(env, full_repo_name, differences)
+        values = {key: new_value for key, _, new_value in differences}
+    elif change[0] == "delete":
+        full_repo_name, values = change[1], None
+        returncode = delete_dockpulp_repo(env, full_repo_name)
+    else:
+        full_repo_name, values = build_new_repo(change[1])
+        returncode = create_dockpulp_repo(env, change[1])
+    if returncode == 0:
+        update_inventory(env, full_repo_name, values)
+    return returncode
+
+
+def reconcile_dockpulp_repo(env, params, old_repo, check_mode=True):
+    """Bring an existing dockpulp repo in line with the module params.
+    Args:
+        env: The environment to run dock-pulp command
+        params (dict): The dockpulp repo specified via module params
+        old_repo (dict): The comparable existing repo, None if it does not exist
+        check_mode (bool): describe what would happen, but don't do it.
+    Returns:
+        A dictonary for ansible result
+    """
+    result, change = plan_dockpulp_repo(params, old_repo)
+    if change and not check_mode:
+        result["returncode"] = apply_dockpulp_change(env, change)
+    return result
+
+
+def track_tasks(params, results, full_repo_names=None):
+    """Add the ids of the Pulp tasks spawned by the changes to their results,
+    and poll all the tasks together until they are over, unless "wait" is
+    false. Only the rest backend returns before the tasks of its changes are
+    over, the other backends spawn no task to track.
+    Args:
+        params (dict): The module params, with "wait" and "wait_timeout"
+        results (list): The ansible results of the changes
+        full_repo_names (list): The full repo names of the results, when
+                                they have no "full_repo_name"
+    """
+    env = params.get("env")
+    pop_tasks = getattr(BACKENDS.get(env), "pop_tasks", None)
+    spawned = pop_tasks() if pop_tasks else {}
+    if not spawned:
+        return
+    if full_repo_names is None:
+        full_repo_names = [result["full_repo_name"] for result in results]
+    tracked = []
+    for full_repo_name, result in zip(full_repo_names, results):
+        if full_repo_name in spawned:
+            result["task_ids"] = spawned[full_repo_name]
+            tracked.append((full_repo_name, result))
+    if not params.get("wait", True):
+        return
+
+    task_ids = [task_id for _, result in tracked for task_id in result["task_ids"]]
+    timeout = params.get("wait_timeout") or TASK_TIMEOUT
+    states = BACKENDS[env].wait_tasks(task_ids, timeout)
+    for full_repo_name, result in tracked:
+        for task_id in result["task_ids"]:
+            task = states[task_id]
+            if task["state"] == "finished":
+                continue
+            result["returncode"] = 1
+            # Keep the unconfirmed values out of the inventory snapshot
+            INVENTORY_CHANGES.get(env, {}).pop(full_repo_name, None)
+            if task["state"] not in TASK_FINAL_STATES:
+                result["msg"] = "The task %s of %s is still %s after %d seconds" % (
+                    task_id,
+                    full_repo_name,
+                    task["state"],
+                    timeout,
+                )
+            else:
+                result["msg"] = "The task %s of %s is %s: %s" % (
+                    task_id,
+                    full_repo_name,
+                    task["state"],
+                    task["error"],
+                )
+
+
+def get_tasks(params):
+    """Get the state of the Pulp tasks of the module params, spawned by an
+    earlier run with the rest backend and wait false
+    Args:
+        params (dict): The env, credentials and "task_ids", and with "wait",
+                       the "wait_timeout" to poll the tasks until they are over
+    Returns:
+        A list of the tasks, with their "task_id", "state" and "error", in
+        the order of "task_ids"
+    """
+    env = params.get("env")
+    connect(params)
+    task_ids = params.get("task_ids") or []
+    if params.get("wait"):
+        states = BACKENDS[env].wait_tasks(task_ids, params.get("wait_timeout") or TASK_TIMEOUT)
+    else:
+        states = BACKENDS[env].task_states(task_ids)
+    tasks = []
+    for task_id in task_ids:
+        task = states.get(task_id) or {"state": "missing", "error": "task not found"}
+        tasks.append(dict(task, task_id=task_id))
+    return tasks
+
+
+def run_parallel(func, items, max_workers=1):
+    """Call a function on every item, with up to max_workers threads at once.
+    Args:
+        func: The function to call with every item
+        items (list): The items to process
+        max_workers (int): The maximum number of concurrent calls
+    Returns:
+        The list of return values, in the order of items
+    """
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def connect(params):
+    """Log in to the environment of the module params, and load its
+    inventory index when "inventory_ttl" is set. The dock-pulp calls of the
+    environment are limited to "rate_limit" calls per second from then on,
+    and its latency policy follows "adaptive_timeouts", "read_retries" and "circuit_breaker".
+    Args:
+        params (dict): The module params
+    """
+    env = params.get("env")
+    configure_rate_limit(env, params.get("rate_limit"), params.get("rate_burst"))
+    configure_latency(
+        env,
+        params.get("adaptive_timeouts"),
+        params.get("read_retries"),
+        params.get("circuit_breaker"),
+    )
+    session_ttl = params.get("session_ttl", SESSION_TTL)
+    login_succeed, stdout = login(
+        env, params.get("dockpulp_user"), params.get("dockpulp_password"), session_ttl=session_ttl
+    )
+    if not login_succeed:
+        raise RuntimeError("Error logging into dock-pulp: %s" % stdout)
+    load_inventory(env, params.get("inventory_ttl") or 0)
+
+
+def ensure_dockpulp_repo(params, check_mode=True):
+    """Ensure that this CDN repo exists in the Docker pulp server.
+    A repo applied with the same values less than "fingerprint_max_age"
+    seconds ago is not looked up again, unless "force_refresh" is set.
+    Args:
+        param params({}): The dockpulp repo to create
+        check_mode (bool): describe what would happen, but don't do it.
+    Returns:
+        A dictonary for ansible result
+    """
+    if params.get("engine") == "asyncio":
+        result = ensure_dockpulp_repos(dict(params, repos=[params]), check_mode)[0]
+        del result["repo_name"], result["full_repo_name"]
+        return result
+
+    if fresh_fingerprints(params, [params]):
+        return {"returncode": 0, "changed": False, "stdout_lines": []}
+
+    env = params.get("env")
+    dockpulp_user = params.get("dockpulp_user")
+    dockpulp_password = params.get("dockpulp_password")
+    connect(params)
+
+    full_repo_name, _ = build_new_repo(params)
+    # Get a comparable existing one
+    old_repo = get_comparable_repo(
+        get_existing_repo(full_repo_name, env, dockpulp_user, dockpulp_password)
+    )
+    result = reconcile_dockpulp_repo(env, params, old_repo, check_mode)
+    track_tasks(params, [result], [full_repo_name])
+    save_inventory(env)
+    save_fingerprints(params, [params], [result], check_mode)
+    return result
+
+
+def ensure_dockpulp_repo_envs(params, envs, check_mode=True):
+    """Ensure that this CDN repo exists in several environments at once.
+    Every environment logs in, looks up and reconciles the repo in its own
+    thread, so the run takes about the time of the slowest environment.
+    Args:
+        params (dict): The dockpulp repo to create
+        envs (list): The environments to ensure the repo in
+        check_mode (bool): describe what would happen, but don't do it.
+    Returns:
+        A dictonary of ansible results by environment
+    """
+
+    def ensure(env):
+        try:
+            return ensure_dockpulp_repo(dict(params, env=env), check_mode)
+        except Exception as e:
+            # A failed environment must not abort the others
+            return {"returncode": 1, "changed": False, "stdout_lines": [], "msg": str(e)}
+
+    return dict(zip(envs, run_parallel(ensure, envs, len(envs))))
+
+
+def ensure_dockpulp_repos(params, check_mode=True):
+    """Ensure that a list of CDN repos exists in the Docker pulp server.
+    Login happens once for the environment, and only the repos that differ
+    from the server are created or updated. The repos applied with the same
+    values less than "fingerprint_max_age" seconds ago are not looked up
+    again, unless "force_refresh" is set.
+    Args:
+        params (dict): The env, credentials and the list of "repos" to ensure
+        check_mode (bool): describe what would happen, but don't do it.
+    Returns:
+        A list of ansible results, one per repo and in the order of "repos"
+    """
+    repos = params.get("repos") or []
+    fresh = fresh_fingerprints(params, repos)
+    pending = [repo for repo in repos if build_new_repo(repo)[0] not in fresh]
+
+    pending_results = []
+    if pending and params.get("engine") == "asyncio":
+        # Python 3 only, imported when used
+        from ansible.module_utils.dockpulp_async import ensure_dockpulp_repos_async, run_async
+
+        pending_results = run_async(
+            ensure_dockpulp_repos_async(dict(params, repos=pending), check_mode)
+        )
+    elif pending:
+        pending_results = ensure_dockpulp_repos_sync(dict(params, repos=pending), check_mode)
+    save_fingerprints(params, pending, pending_results, check_mode)
+
+    pending_results = iter(pending_results)
+    results = []
+    for repo in repos:
+        full_repo_name = build_new_repo(repo)[0]
+        if full_repo_name in fresh:
+            results.append(
+                {
+                    "returncode": 0,
+                    "changed": False,
+                    "stdout_lines": [],
+                    "repo_name": repo.get("repo_name"),
+                    "full_repo_name": full_repo_name,
+                }
+            )
+        else:
+            results.append(next(pending_results))
+    return results
+
+
+def ensure_dockpulp_repos_sync(params, check_mode=True):
+    """Ensure a list of CDN repos, looking up the batches one after the other
+    and applying the changes with up to "max_workers" threads.
+    See ensure_dockpulp_repos for the params and results.
+    """
+    env = params.get("env")
+    dockpulp_user = params.get("dockpulp_user")
+    dockpulp_password = params.get("dockpulp_password")
+    connect(params)
+
+    repos = params.get("repos") or []
+    full_repo_names = [build_new_repo(repo)[0] for repo in repos]
+    existing_repos = get_existing_repos(
+        full_repo_names,
+        env,
+        dockpulp_user,
+        dockpulp_password,
+        batch_size=params.get("batch_size") or BATCH_SIZE,
+    )
+
+    results, changes = plan_dockpulp_repos(repos, existing_repos, check_mode)
+    apply_planned_changes(params, changes)
+    save_inventory(env)
+    return results
+
+
+def fresh_fingerprints(params, repos):
+    """Find the repos applied with the same values less than
+    "fingerprint_max_age" seconds ago, which need no lookup.
+    Args:
+        params (dict): The module params
+        repos (list): The dockpulp repos specified via module params
+    Returns:
+        The set of the full names of the fresh repos
+    """
+    max_age = params.get("fingerprint_max_age") or 0
+    if not max_age or params.get("force_refresh"):
+        return set()
+    env = params.get("env")
+    fingerprints = read_fingerprints(env, max_age)
+    fresh = set()
+    for repo in repos:
+        full_repo_name, new_repo = build_new_repo(repo)
+        if fingerprints.get(full_repo_name) == repo_fingerprint(env, new_repo):
+            fresh.add(full_repo_name)
+    METRICS.count("fingerprint_hits", len(fresh))
+    return fresh
+
+
+def save_fingerprints(params, repos, results, check_mode=True):
+    """Record the fingerprints of the repos now in line with the server,
+    when "fingerprint_max_age" is set.
+    Args:
+        params (dict): The module params
+        repos (list): The dockpulp repos specified via module params
+        results (list): Their ansible results, in the same order
+        check_mode (bool): Whether the changes were only described
+    """
+    env = params.get("env")
+    # A snapshot doesn't tell whether the repos are in line with the server
+    if not params.get("fingerprint_max_age") or env in OFFLINE:
+        return
+    fingerprints = {}
+    for repo, result in zip(repos, results):
+        # In check mode, only the repos without changes are in line, and
+        # without wait, the repos with Pulp tasks may not be yet
+        if "task_ids" in result and not params.get("wait", True):
+            continue
+        if result["returncode"] == 0 and not (check_mode and result["changed"]):
+            full_repo_name, new_repo = build_new_repo(repo)
+            fingerprints[full_repo_name] = repo_fingerprint(env, new_repo)
+    if fingerprints:
+        write_fingerprints(env, fingerprints)
+
+
+def plan_dockpulp_repos(repos, existing_repos, check_mode=True):
+    """Work out the changes of a list of repos (see plan_dockpulp_repo).
+    Args:
+        repos (list): The dockpulp repos specified via module params
+        existing_repos (dict): The existing repos by full repo name
+        check_mode (bool): describe what would happen, but don't plan any change.
+    Returns:
+        A list of ansible results, one per repo and in the order of repos
+        A list of (result, change) to apply with apply_planned_change
+    """
+    results = []
+    changes = []
+    for repo in repos:
+        full_repo_name, _ = build_new_repo(repo)
+        old_repo = get_comparable_repo(existing_repos.get(full_repo_name))
+        result, change = plan_dockpulp_repo(repo, old_repo)
+        result["repo_name"] = repo.get("repo_name")
+        result["full_repo_name"] = full_repo_name
+        results.append(result)
+        if change and not check_mode:
+            changes.append((result, change))
+    return results, changes
+
+
+def apply_planned_change(env, planned):
+    """Apply a change of plan_dockpulp_repos, and record its returncode in its result
+    Args:
+        env: The environment to run dock-pulp command
+        planned (tuple): The result and the change to apply
+    """
+    result, change = planned
+    # A failed repo must not abort the others
+    try:
+        result["returncode"] = apply_dockpulp_change(env, change)
+    except Exception as e:
+        result["returncode"] = 1
+        result["msg"] = str(e)
+
+
+def apply_planned_changes(params, changes):
+    """Apply the changes of plan_dockpulp_repos or plan_reconcile, with the
+    engine of the module params.
+    The Pulp tasks spawned by the changes are tracked, see track_tasks.
+    Args:
+        params (dict): The module params
+        changes (list): The (result, change) to apply
+    """
+    if params.get("engine") == "asyncio":
+        from ansible.module_utils.dockpulp_async import apply_planned_changes_async, run_async
+
+        run_async(apply_planned_changes_async(params, changes))
+        track_tasks(params, [result for result, _ in changes])
+        return
+    env = params.get("env")
+    run_parallel(
+        lambda planned: apply_planned_change(env, planned),
+        changes,
+        params.get("max_workers") or 1,
+    )
+    track_tasks(params, [result for result, _ in changes])
+
+
+def load_manifest(path):
+    """Load the desired repos of a manifest file.
+    The manifest holds a list of repos with the fields of the dockpulp_repo
+    module, or a mapping with that list under "repos". Files ending in .json
+    are read as JSON, the others as YAML.
+    Args:
+        path: The path of the manifest file
+    Returns:
+        The list of repos
+    Raises:
+        ValueError if the file is not a valid manifest
+    """
+    with open(path) as f:
+        if path.endswith(".json"):
+            manifest = json.load(f)
+        else:
+            try:
+                manifest = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError(str(e))
+    if isinstance(manifest, dict):
+        manifest = manifest.get("repos")
+    if not isinstance(manifest, list) or not all(isinstance(repo, dict) for repo in manifest):
+        raise ValueError("%s is not a list of repos" % path)
+    return manifest
+
+
+def plan_reconcile(repos, live_repos, prune=False, check_mode=True):
+    """Work out the changes bringing the live repos of an environment in line
+    with the desired repos, matching them by docker-id in a single pass.
+    Args:
+        repos (list): The desired repos, with the fields of the module params
+        live_repos (dict): All the live repos of the environment, by full repo name
+        prune (bool): Also delete the live repos which are not desired, in the
+                      namespaces of the desired repos only
+        check_mode (bool): describe what would happen, but don't plan any change.
+    Returns:
+        A list of ansible results, one per desired repo in the order of repos,
+        followed by one per pruned repo
+        A list of (result, change) to apply with apply_planned_change
+    """
+    live_by_docker_id = {}
+    for full_repo_name, repo in live_repos.items():
+        if repo and repo.get("docker-id"):
+            live_by_docker_id[repo["docker-id"]] = (full_repo_name, repo)
+
+    results = []
+    changes = []
+    desired = set()
+    namespaces = set()
+    for repo in repos:
+        full_repo_name, new_repo = build_new_repo(repo)
+        desired.add(new_repo["docker-id"])
+        namespaces.add(repo.get("namespace"))
+        full_repo_name, live_repo = live_by_docker_id.get(
+            new_repo["docker-id"], (full_repo_name, None)
+        )
+        result, change = plan_dockpulp_repo(repo, get_comparable_repo(live_repo))
+        if change and change[0] == "update":
+            # Update the live repo of that docker-id, whatever its name
+            change = ("update", full_repo_name, change[2])
+        result["repo_name"] = repo.get("repo_name")
+        result["full_repo_name"] = full_repo_name
+        results.append(result)
+        if change and not check_mode:
+            changes.append((result, change))
+
+    if not prune:
+        return results, changes
+    for docker_id in sorted(live_by_docker_id):
+        namespace, _, repo_name = docker_id.partition("/")
+        if docker_id in desired or namespace not in namespaces:
+            continue
+        full_repo_name, live_repo = live_by_docker_id[docker_id]
+        result = {
+            "returncode": 0,
+            "changed": True,
+            "stdout_lines": ["Deleted %s" % full_repo_name],
+            "diff": {
+                "before_header": docker_id,
+                "after_header": "Deleted",
+                "before": get_comparable_repo(live_repo),
+                "after": {},
+            },
+            "repo_name": repo_name,
+            "full_repo_name": full_repo_name,
+        }
+        results.append(result)
+        if not check_mode:
+            changes.append((result, ("delete", full_repo_name)))
+    return results, changes
+
+
+def get_live_repos(env):
+    """All the live repos of an environment, from its inventory index when
+    loaded, or one listing of the server, after logging in
+    Returns:
+        A dictonary of the repos by full repo name
+    """
+    live_repos = INVENTORY.get(env)
+    if live_repos is None:
+        live_repos = list_all_repos(env)
+        if live_repos is None:
+            raise RuntimeError("Error listing the repos of %s" % env)
+    return live_repos
+
+
+def reconcile_dockpulp_repos(params, check_mode=True):
+    """Bring all the repos of an environment in line with a list of desired
+    repos: create and update the repos which differ and, with "prune", delete
+    the repos of the same namespaces which are not desired.
+    The live repos come from one listing of the environment, or from its
+    inventory index when "inventory_ttl" is set.
+    Args:
+        params (dict): The env, credentials, the list of "repos" and "prune"
+        check_mode (bool): describe what would happen, but don't do it.
+    Returns:
+        A list of ansible results, see plan_reconcile
+    """
+    env = params.get("env")
+    connect(params)
+    live_repos = get_live_repos(env)
+
+    results, changes = plan_reconcile(
+        params.get("repos") or [], live_repos, params.get("prune"), check_mode
+    )
+    apply_planned_changes(params, changes)
+    save_inventory(env)
+    return results
+
+
+def export_plan(params):
+    """Look up the repos of the module params like check mode, and write
+    the changes they need to "plan_file" for apply_plan.
+    Every repo of the plan has its action (create, update, delete or noop),
+    the values of the repo observed on the server ("remote"), and its
+    stdout_lines and diff. Creates keep the repo to create ("repo"), and
+    updates the differences to apply ("differences").
+    With "manifest" or "prune", the repos are planned like
+    reconcile_dockpulp_repos, otherwise like ensure_dockpulp_repos.
+    Args:
+        params (dict): The module params
+    Returns:
+        A list of ansible results, like check mode
+    """
+    env = params.get("env")
+    repos = params.get("repos") or []
+    connect(params)
+    if params.get("manifest") or params.get("prune"):
+        live_repos = get_live_repos(env)
+        results, changes = plan_reconcile(repos, live_repos, params.get("prune"), False)
+    else:
+        live_repos = get_existing_repos(
+            [build_new_repo(repo)[0] for repo in repos],
+            env,
+            params.get("dockpulp_user"),
+            params.get("dockpulp_password"),
+            batch_size=params.get("batch_size") or BATCH_SIZE,
+        )
+        results, changes = plan_dockpulp_repos(repos, live_repos, False)
+
+    planned = dict((id(result), change) for result, change in changes)
+    entries = []
+    for result in results:
+        change = planned.get(id(result))
+        full_repo_name = result["full_repo_name"]
+        entry = {
+            "action": change[0] if change else "noop",
+            "repo_name": result["repo_name"],
+            "full_repo_name": full_repo_name,
+            "remote": get_comparable_repo(live_repos.get(full_repo_name)),
+            "stdout_lines": result["stdout_lines"],
+        }
+        if "diff" in result:
+            entry["diff"] = result["diff"]
+        if entry["action"] == "create":
+            entry["repo"] = change[1]
+        elif entry["action"] == "update":
+            entry["differences"] = change[2]
+        entries.append(entry)
+
+    plan = {"env": env, "created_at": time.time(), "changes": entries}
+    write_json(params.get("plan_file"), plan, indent=2)
+    return results
+
+
+def load_plan(path):
+    """Load a plan written by export_plan
+    Args:
+        path: The path of the plan file
+    Returns:
+        The plan
+    Raises:
+        ValueError if the file is not a plan
+    """
+    with open(path) as f:
+        plan = json.load(f)
+    if not isinstance(plan, dict) or not isinstance(plan.get("changes"), list):
+        raise ValueError("%s is not a plan" % path)
+    return plan
+
+
+def planned_values(entry):
+    """The comparable values of the repo of a plan entry once applied,
+    None for a repo which won't exist"""
+    if entry["action"] == "delete":
+        return None
+    if entry["action"] == "create":
+        return build_new_repo(entry["repo"])[1]
+    values = dict(entry["remote"])
+    values.update((key, new_value) for key, _, new_value in entry.get("differences", []))
+    return values
+
+
+def apply_plan(params):
+    """Apply the changes of the plan of "plan_file", without looking up
+    the repos which need no change.
+    The repos to change are read again first. A repo which changed on the
+    server since the plan was made fails, without being changed, and a
+    repo already in its planned state is left as it is.
+    Args:
+        params (dict): The module params
+    Returns:
+        A list of ansible results, one per repo of the plan
+    Raises:
+        ValueError if the plan is not valid for the environment
+    """
+    env = params.get("env")
+    plan = load_plan(params.get("plan_file"))
+    if plan.get("env") != env:
+        raise ValueError("The plan is for the %s env, not %s" % (plan.get("env"), env))
+
+    entries = plan["changes"]
+    touched = [entry["full_repo_name"] for entry in entries if entry["action"] != "noop"]
+    current_repos = {}
+    if touched:
+        connect(params)
+        current_repos = get_existing_repos(
+            touched,
+            env,
+            params.get("dockpulp_user"),
+            params.get("dockpulp_password"),
+            batch_size=params.get("batch_size") or BATCH_SIZE,
+        )
+
+    results = []
+    changes = []
+    for entry in entries:
+        full_repo_name = entry["full_repo_name"]
+        result = {
+            "returncode": 0,
+            "changed": False,
+            "stdout_lines": [],
+            "repo_name": entry.get("repo_name"),
+            "full_repo_name": full_repo_name,
+        }
+        results.append(result)
+        if entry["action"] == "noop":
+            continue
+        current = get_comparable_repo(current_repos.get(full_repo_name))
+        if current == planned_values(entry):
+            continue
+        if current != entry["remote"]:
+            result["returncode"] = 1
+            result["msg"] = "%s changed on the server since the plan was made" % full_repo_name
+            continue
+        result["changed"] = True
+        result["stdout_lines"] = entry["stdout_lines"]
+        if "diff" in entry:
+            result["diff"] = entry["diff"]
+        if entry["action"] == "update":
+            differences = [tuple(difference) for difference in entry["differences"]]
+            changes.append((result, ("update", full_repo_name, differences)))
+        elif entry["action"] == "create":
+            changes.append((result, ("create", entry["repo"])))
+        else:
+            changes.append((result, ("delete", full_repo_name)))
+
+    apply_planned_changes(params, changes)
+    save_inventory(env)
+    return results
+
+
 def diff_settings(settings, params):
     """Diff the "live" settings against our Ansible parameters.
     Args:
@@ -0,0 +1,435 @@
+import copy
+import json
+import threading
+import time
+
+try:
+    import configparser
+except ImportError:  # PY2
+    import ConfigParser as configparser
+
+from ansible.module_utils.dockpulp_metrics import METRICS
+from ansible.module_utils.dockpulp_ratelimit import acquire
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    HAS_REQUESTS = True
+except ImportError:
+    HAS_REQUESTS = False
+
+
+DOCKPULP_CONF = "/etc/dockpulp.conf"
+
+# The definitions of the distributors named in the [distributors] section
+# of the dockpulp configuration
+DISTRIBUTORS_CONF = "/etc/dockpulpdistributors.json"
+
+API = "/pulp/api/v2"
+
+DISTRIBUTOR_ID = "docker_web_distributor_name_cli"
+
+# The types of the importer and distributor of the docker repos, required to create them
+IMPORTER_TYPE_ID = "docker_importer"
+DISTRIBUTOR_TYPE_ID = "docker_distributor_web"
+
+# Connections kept open to a Pulp server, and the most requests to it at once
+POOL_SIZE = 10
+
+HTTP_TIMEOUT = 120
+
+# Seconds allowed for the Pulp tasks of a module run to finish
+TASK_TIMEOUT = 600
+
+# Seconds between two polls of the running tasks, doubled after every poll
+TASK_POLL_INTERVAL = 0.1
+TASK_POLL_MAX_INTERVAL = 5
+
+# Maximum number of tasks polled by one search
+TASK_BATCH_SIZE = 100
+
+# The states of a Pulp task which is over, or which was not found
+TASK_FINAL_STATES = ("finished", "error", "canceled", "skipped", "missing")
+
+# The pooled HTTP sessions of the module process, by Pulp URL and settings,
+# shared by every environment and thread calling the same server
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
+
+def read_dockpulp_conf(env, conf=DOCKPULP_CONF):
+    """Read the Pulp URL of an environment, and whether to verify its
+    certificate, from the dockpulp configuration
+    Returns:
+        The URL and the verify flag
+    Raises:
+        RuntimeError if the environment is not configured
+    """
+    parser = configparser.ConfigParser()
+    parser.read(conf)
+    if not parser.has_option("pulps", env):
+        raise RuntimeError("No Pulp server for %s in %s" % (env, conf))
+    verify = True
+    if parser.has_option("verify", env):
+        verify = parser.getboolean("verify", env)
+    return parser.get("pulps", env), verify
+
+
+def read_dockpulp_distributors(env, conf=DOCKPULP_CONF, distributors_conf=DISTRIBUTORS_CONF):
+    """Read the distributors dock-pulp create attaches to the repos of an
+    environment: the names listed for it in the [distributors] section of
+    the dockpulp configuration, defined in the distributors configuration
+    Returns:
+        The list of distributors, None if the environment lists none
+    Raises:
+        RuntimeError if the distributors configuration can't be read, or
+        misses a distributor
+    """
+    parser = configparser.ConfigParser()
+    parser.read(conf)
+    if not parser.has_option("distributors", env):
+        return None
+    names = [name.strip() for name in parser.get("distributors", env).split(",") if name.strip()]
+    try:
+        with open(distributors_conf) as f:
+            definitions = json.load(f)
+    except (IOError, ValueError) as e:
+        raise RuntimeError("Error reading %s: %s" % (distributors_conf, e))
+    distributors = []
+    for name in names:
+        if name not in definitions:
+            raise RuntimeError("No distributor %s in %s" % (name, distributors_conf))
+        distributor = dict(definitions[name])
+        distributor.setdefault("distributor_id", name)
+        distributors.append(distributor)
+    return distributors
+
+
+def repo_distributors(dockpulp_repo, distributors=None):
+    """Build the distributors of a new repo, like dock-pulp create: the
+    distributors of its environment, or the docker web distributor alone.
+    The web distributors get the registry id and the redirect url of the repo.
+    Args:
+        dockpulp_repo (dict): The repo, with the arguments of dock-pulp create
+        distributors (list): The distributors of the environment, see
+                             read_dockpulp_distributors
+    Returns:
+        The distributors of the body of the create request
+    """
+    if not distributors:
+        distributors = [
+            {
+                "distributor_type_id": DISTRIBUTOR_TYPE_ID,
+                "distributor_id": DISTRIBUTOR_ID,
+                "auto_publish": True,
+            }
+        ]
+    distributors = copy.deepcopy(distributors)
+    for distributor in distributors:
+        config = distributor.setdefault("distributor_config", {})
+        if distributor.get("distributor_type_id") == DISTRIBUTOR_TYPE_ID:
+            config["repo-registry-id"] = "%s/%s" % (
+                dockpulp_repo.get("namespace"),
+                dockpulp_repo.get("repo_name"),
+            )
+            config["redirect-url"] = dockpulp_repo.get("content_url")
+    return distributors
+
+
+def get_session(url, pool_size=POOL_SIZE, keepalive=True):
+    """Get the pooled HTTP session of a Pulp server, created on first use.
+    The connections, their TLS sessions and the auth context are reused by
+    every call of the module process to that server.
+    Args:
+        url: The URL of the Pulp server
+        pool_size: Connections kept open to the server, calls over it wait
+                   for a free connection
+        keepalive: Keep the connections open between calls
+    Returns:
+        A requests.Session
+    """
+    key = (url, pool_size, keepalive)
+    with SESSIONS_LOCK:
+        if key not in SESSIONS:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+            session.mount(url, adapter)
+            if not keepalive:
+                session.headers["Connection"] = "close"
+            SESSIONS[key] = session
+        return SESSIONS[key]
+
+
+def to_dockpulp(repo):
+    """Convert a repo of the Pulp API to the dictionary of a dock-pulp list,
+    with the config of its docker web distributor"""
+    config = {}
+    for distributor in repo.get("distributors") or []:
+        # The API returns the distributor_id of the create request as id
+        if DISTRIBUTOR_ID in (distributor.get("id"), distributor.get("distributor_id")):
+            config = distributor.get("config") or {}
+    return {
+        "id": repo["id"],
+        "title": repo.get("display_name"),
+        "description": repo.get("description"),
+        "distribution": (repo.get("notes") or {}).get("distribution"),
+        "docker-id": config.get("repo-registry-id"),
+        "redirect": config.get("redirect-url"),
+        "protected": config.get("protected"),
+    }
+
+
+class RestBackend(object):
+    """Run dock-pulp operations in-process against the Pulp v2 REST API,
+    over a pooled HTTP session kept alive for the lifetime of the module
+    process (see get_session).
+    Updates and deletes return once their Pulp task is submitted, the ids
+    of the tasks are collected for wait_tasks (see pop_tasks).
+    """
+
+    name = "rest"
+
+    def __init__(
+        self, env, url=None, pool_size=POOL_SIZE, keepalive=True, timeout=HTTP_TIMEOUT, verify=None
+    ):
+        self.env = env
+        conf_verify = True
+        if not url:
+            url, conf_verify = read_dockpulp_conf(env)
+        self.url = url.rstrip("/")
+        self.verify = conf_verify if verify is None else verify
+        self.timeout = timeout
+        self.auth = None
+        self.session = get_session(self.url, pool_size or POOL_SIZE, keepalive)
+        self.distributors = read_dockpulp_distributors(env)
+        self.tasks = {}
+        self.tasks_lock = threading.Lock()
+
+    def call(self, method, path, body=None):
+        """Send a request to the Pulp API
+        Returns:
+            The status and the decoded body of the response
+        Raises:
+            RuntimeError if the server can't be reached
+        """
+        acquire(self.env)
+        METRICS.count("http_requests")
+        try:
+            response = self.session.request(
+                method,
+                self.url + API + path,
+                json=body,
+                auth=self.auth,
+                timeout=self.timeout,
+                verify=self.verify,
+            )
+        except requests.RequestException as e:
+            raise RuntimeError("Error calling %s: %s" % (self.url, e))
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        return response.status_code, data
+
+    def login(self, dockpulp_user, dockpulp_password):
+        """Login to docker pulp
+        Returns:
+            True if login is successful, False otherwise
+            the error message if the login failed
+        """
+        self.auth = (dockpulp_user, dockpulp_password)
+        status, data = self.call("POST", "/actions/login/", {})
+        if status != 200:
+            self.auth = None
+            return False, "%d %s" % (status, (data or {}).get("error", "login failed"))
+        return True, ""
+
+    def spawned(self, full_repo_name, report):
+        """Collect the ids of the tasks spawned by a change of a repo"""
+        task_ids = [task["task_id"] for task in (report or {}).get("spawned_tasks") or []]
+        if task_ids:
+            with self.tasks_lock:
+                self.tasks.setdefault(full_repo_name, []).extend(task_ids)
+
+    def pop_tasks(self):
+        """Get the ids of the tasks spawned since the last call
+        Returns:
+            A dictonary of the task ids by full repo name
+        """
+        with self.tasks_lock:
+            tasks, self.tasks = self.tasks, {}
+        return tasks
+
+    def task_states(self, task_ids):
+        """Get the state of many tasks, with one search per TASK_BATCH_SIZE tasks
+        Returns:
+            A dictonary of the tasks by task id, with their "state" and "error",
+            without the tasks which do not exist
+        Raises:
+            RuntimeError if a search failed
+        """
+        states = {}
+        for start in range(0, len(task_ids), TASK_BATCH_SIZE):
+            end = start + TASK_BATCH_SIZE
+            criteria = {"filters": {"task_id": {"$in": task_ids[start:end]}}}
+            status, tasks = self.call("POST", "/tasks/search/", {"criteria": criteria})
+            if status != 200:
+                raise RuntimeError(
+                    "Error polling the tasks of %s: %d %s" % (self.env, status, tasks)
+                )
+            for task in tasks:
+                states[task["task_id"]] = {"state": task.get("state"), "error": task.get("error")}
+        return states
+
+    def wait_tasks(self, task_ids, timeout=TASK_TIMEOUT):
+        """Poll tasks until they are all over, or for timeout seconds. The
+        poll interval starts at TASK_POLL_INTERVAL seconds and doubles up to
+        TASK_POLL_MAX_INTERVAL, and only the tasks still running are polled.
+        Returns:
+            A dictonary of the tasks by task id, see task_states. The tasks
+            still running at the timeout keep their last state, and the tasks
+            not found are "missing".
+        """
+        deadline = time.time() + timeout
+        interval = TASK_POLL_INTERVAL
+        states = {}
+        running = list(task_ids)
+        with METRICS.timer("wait_tasks"):
+            while running:
+                METRICS.count("task_polls")
+                states.update(self.task_states(running))
+                for task_id in running:
+                    states.setdefault(task_id, {"state": "missing", "error": "task not found"})
+                running = [
+                    task_id
+                    for task_id in running
+                    if states[task_id]["state"] not in TASK_FINAL_STATES
+                ]
+                if not running or time.time() + interval > deadline:
+                    break
+                time.sleep(interval)
+                interval = min(interval * 2, TASK_POLL_MAX_INTERVAL)
+        return states
+
+    def search(self, criteria):
+        """Search the repos, with their distributors, which hold the docker-id
+        and the redirect of the repos and are left out by default"""
+        body = {"criteria": criteria, "distributors": True}
+        status, repos = self.call("POST", "/repositories/search/", body)
+        if status != 200:
+            raise RuntimeError("Error listing the repos of %s: %d %s" % (self.env, status, repos))
+        return repos
+
+    def get_repo(self, full_repo_name):
+        """Get a Docker Pulp repo
+        Returns:
+            A dictonary representing the repo or None if it does not exist
+        """
+        status, repo = self.call("GET", "/repositories/%s/?details=true" % full_repo_name)
+        return to_dockpulp(repo) if status == 200 else None
+
+    def get_repos(self, full_repo_names):
+        """Get many Docker Pulp repos with one search
+        Returns:
+            A dictonary of the repos by full repo name, without the repos which
+            do not exist, None if the search failed
+        """
+        try:
+            repos = self.search({"filters": {"id": {"$in": full_repo_names}}})
+        except RuntimeError:
+            return None
+        return {repo["id"]: to_dockpulp(repo) for repo in repos}
+
+    def list_repos(self):
+        """List all the repos of the environment
+        Returns:
+            A dictonary of the repos by full repo name, None if the listing failed
+        """
+        status, repos = self.call("GET", "/repositories/?details=true")
+        if status != 200:
+            return None
+        return {repo["id"]: to_dockpulp(repo) for repo in repos}
+
+    def repo_ids(self):
+        """List the ids of all the repos of the environment
+        Raises:
+            RuntimeError if the listing failed
+        """
+        return [repo["id"] for repo in self.search({"fields": ["id"]})]
+
+    def iter_repos(self, page_size):
+        """List all the repos of the environment, with one search per page_size
+        repos, without holding the details of all the repos at once
+        Yields:
+            Every repo of the environment
+        Raises:
+            RuntimeError if the listing failed
+        """
+        skip = 0
+        while True:
+            criteria = {"sort": [["id", "ascending"]], "skip": skip, "limit": page_size}
+            repos = self.search(criteria)
+            for repo in repos:
+                yield to_dockpulp(repo)
+            if len(repos) < page_size:
+                return
+            skip += page_size
+
+    def create_repo(self, dockpulp_repo):
+        """Create a repo, with the same arguments as dock-pulp create
+        Returns:
+            0 if the repo was created, 1 otherwise
+        """
+        namespace = dockpulp_repo.get("namespace")
+        repo_name = dockpulp_repo.get("repo_name")
+        repo_id = "redhat-%s-%s" % (namespace, repo_name)
+        body = {
+            "id": repo_id,
+            "display_name": repo_id,
+            "description": dockpulp_repo.get("description"),
+            "notes": {
+                "_repo-type": "docker-repo",
+                "distribution": dockpulp_repo.get("distribution"),
+            },
+            "importer_type_id": IMPORTER_TYPE_ID,
+            "importer_config": {},
+            "distributors": repo_distributors(dockpulp_repo, self.distributors),
+        }
+        status, _ = self.call("POST", "/repositories/", body)
+        return 0 if status in (200, 201) else 1
+
+    def update_repo(self, full_repo_name, differences):
+        """Update the fields of a repo
+        Args:
+            differences: list of ('key', 'current_value', 'new_value')
+        Returns:
+            0 if the repo was updated, 1 otherwise
+        """
+        update = {key: new_value for key, _, new_value in differences}
+        delta = {}
+        if "title" in update:
+            delta["display_name"] = update["title"]
+        if "description" in update:
+            delta["description"] = update["description"]
+        if "distribution" in update:
+            delta["notes"] = {"distribution": update["distribution"]}
+        body = {"delta": delta}
+        if "docker-id" in update:
+            body["distributor_configs"] = {
+                DISTRIBUTOR_ID: {"repo-registry-id": update["docker-id"]}
+            }
+        status, report = self.call("PUT", "/repositories/%s/" % full_repo_name, body)
+        if status == 202:
+            self.spawned(full_repo_name, report)
+        return 0 if status in (200, 202) else 1
+
+    def delete_repo(self, full_repo_name):
+        """Delete a repo
+        Returns:
+            0 if the repo was deleted, 1 otherwise
+        """
+        status, report = self.call("DELETE", "/repositories/%s/" % full_repo_name)
+        if status == 202:
+            self.spawned(full_repo_name, report)
+        return 0 if status in (200, 202) else 1
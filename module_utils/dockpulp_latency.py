@@ -0,0 +1,217 @@
+import random
+import time
+
+from ansible.module_utils.dockpulp_cache import read_state, update_state
+from ansible.module_utils.dockpulp_metrics import METRICS
+
+# Upper bounds in seconds of the buckets of the latency histograms, the
+# last bucket holds the slower calls
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+
+# Weight kept by the past samples at every new sample, so the histogram
+# follows about the last hundred calls of an operation
+LATENCY_DECAY = 0.99
+
+# Weight of samples needed before the timeouts follow the histogram
+MIN_SAMPLES = 20
+
+# Timeouts are the p99 latency times TIMEOUT_FACTOR, and at least MIN_TIMEOUT seconds
+TIMEOUT_FACTOR = 3
+MIN_TIMEOUT = 10
+
+# First and maximum backoff in seconds between two retries of a read
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10
+
+# Seconds an open circuit refuses the calls of its environment
+CIRCUIT_COOLDOWN = 30
+
+# The latency policy of every configured environment: whether its timeouts
+# follow its histograms, its read retries, and its circuit breaker threshold
+POLICIES = {}
+
+# Output of dock-pulp when a call failed on the way to the server, and may
+# succeed when made again
+TRANSIENT_ERRORS = (
+    "connection refused",
+    "connection reset",
+    "connection aborted",
+    "timed out",
+    "502 bad gateway",
+    "503 service unavailable",
+    "504 gateway timeout",
+)
+
+
+class CommandTimeout(RuntimeError):
+    """A dock-pulp command killed at its timeout. It's a RuntimeError, so the
+    modules report it like the other failures of dock-pulp."""
+
+    def __init__(self, command, timeout, output=""):
+        super(CommandTimeout, self).__init__(
+            "Timed out after %s seconds: %s" % (timeout, " ".join(hide_password(command)))
+        )
+        self.command = command
+        self.timeout = timeout
+        self.output = output
+
+
+def hide_password(command):
+    """The args of a command, with the password of a dock-pulp login hidden"""
+    return [
+        "********" if position and command[position - 1] == "-p" else arg
+        for position, arg in enumerate(command)
+    ]
+
+
+def latency_state(env):
+    """The name of the state file holding the latency histograms of an environment"""
+    return "latency-%s" % env
+
+
+def circuit_state(env):
+    """The name of the state file holding the circuit breaker of an environment"""
+    return "circuit-%s" % env
+
+
+def configure_latency(env, adaptive=False, retries=0, threshold=0):
+    """Set the latency policy of the dock-pulp calls of an environment
+    Args:
+        env: The environment of the calls
+        adaptive: Record the latency of every call, and derive the timeouts
+                  from the latency histograms of the operations
+        retries: Number of retries of the reads timing out or failing with a
+                 transient error
+        threshold: Consecutive failures opening the circuit of the environment,
+                   0 disables the circuit breaker
+    """
+    POLICIES[env] = {
+        "adaptive": bool(adaptive),
+        "retries": retries or 0,
+        "threshold": threshold or 0,
+    }
+
+
+def policy(env):
+    return POLICIES.get(env) or {"adaptive": False, "retries": 0, "threshold": 0}
+
+
+def command_operation(command):
+    """The operation of a dock-pulp command: "lookup" for the lists of some
+    repos, "list" for the listing of a whole environment, else the dock-pulp
+    subcommand. None for other commands.
+    """
+    if "--server" not in command[:-2]:
+        return None
+    position = command.index("--server") + 2
+    name = command[position]
+    if name != "list":
+        return name
+    first_arg = position + 1
+    if any(not arg.startswith("-") for arg in command[first_arg:]):
+        return "lookup"
+    return "list"
+
+
+def is_transient_error(output):
+    """Check if a dock-pulp command failed on the way to the server
+    Args:
+        output (str): The output of the dock-pulp command
+    Returns:
+        True if the output reports an error worth retrying
+    """
+    output = output.lower()
+    return any(error in output for error in TRANSIENT_ERRORS)
+
+
+def record_latency(env, operation, seconds):
+    """Add the duration of a call to the histogram of its operation, shared
+    by all the processes of the host through a locked state file"""
+    if not policy(env)["adaptive"] or operation is None:
+        return
+    with update_state(latency_state(env)) as state:
+        histogram = state.get(operation) or {"counts": [0] * (len(LATENCY_BUCKETS) + 1)}
+        counts = [count * LATENCY_DECAY for count in histogram["counts"]]
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        counts[bucket] += 1
+        state[operation] = {"counts": counts, "updated_at": time.time()}
+
+
+def latency_percentile(env, operation, fraction=0.99):
+    """The latency of an operation under which fraction of its calls ran
+    Returns:
+        The upper bound in seconds of the bucket of the percentile, None
+        without enough samples, or when it's in the last bucket
+    """
+    counts = (read_state(latency_state(env)).get(operation) or {}).get("counts")
+    if not counts or sum(counts) < MIN_SAMPLES:
+        return None
+    threshold = fraction * sum(counts)
+    seen = 0
+    for bucket, count in enumerate(counts[:-1]):
+        seen += count
+        if seen >= threshold:
+            return LATENCY_BUCKETS[bucket]
+    return None
+
+
+def timeout_for(env, operation, default):
+    """The timeout of a call: the p99 latency of its operation times
+    TIMEOUT_FACTOR, at least MIN_TIMEOUT seconds, and at most default
+    Args:
+        env: The environment of the call
+        operation: The operation of the call, see command_operation
+        default: The timeout without adaptive timeouts or enough samples
+    """
+    if not policy(env)["adaptive"] or operation is None:
+        return default
+    p99 = latency_percentile(env, operation)
+    if p99 is None:
+        return default
+    return min(default, max(MIN_TIMEOUT, p99 * TIMEOUT_FACTOR))
+
+
+def backoff(attempt):
+    """The jittered wait before a retry: a random time up to BACKOFF_BASE
+    seconds doubled at every attempt, at most BACKOFF_MAX"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def check_circuit(env):
+    """Refuse a call while the circuit of its environment is open: after
+    threshold consecutive failures, for CIRCUIT_COOLDOWN seconds. A call
+    after the cooldown closes the circuit on success, and opens it again
+    on failure.
+    Raises:
+        RuntimeError if the circuit is open
+    """
+    threshold = policy(env)["threshold"]
+    if not threshold:
+        return
+    state = read_state(circuit_state(env))
+    failures = state.get("failures", 0)
+    remaining = state.get("opened_at", 0) + CIRCUIT_COOLDOWN - time.time()
+    if failures >= threshold and remaining > 0:
+        METRICS.count("circuit_rejections")
+        raise RuntimeError(
+            "The circuit of %s is open after %d consecutive failures, for %d more seconds"
+            % (env, failures, remaining)
+        )
+
+
+def record_outcome(env, succeeded):
+    """Count the consecutive failures of the calls of an environment, see check_circuit"""
+    threshold = policy(env)["threshold"]
+    if not threshold:
+        return
+    if succeeded and not read_state(circuit_state(env)).get("failures"):
+        return
+    with update_state(circuit_state(env)) as state:
+        if succeeded:
+            state.clear()
+            return
+        state["failures"] = state.get("failures", 0) + 1
+        if state["failures"] >= threshold:
+            state["opened_at"] = time.time()
@@ -0,0 +1,78 @@
+import contextlib
+import functools
+import threading
+import time
+
+
+class Metrics(object):
+    """Wall time of the phases of a module run, and counters of its
+    dock-pulp commands. Nothing is recorded until enabled.
+    Example:
+        METRICS.enable()
+        with METRICS.timer("login"):
+            ...
+        METRICS.count("commands")
+        result["metrics"] = METRICS.as_dict()
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counters = {}
+
+    def enable(self):
+        self.enabled = True
+        self.phases = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """Add the wall time of the block to a phase"""
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                metric = self.phases.setdefault(phase, {"count": 0, "seconds": 0.0})
+                metric["count"] += 1
+                metric["seconds"] += elapsed
+
+    def count(self, name, value=1):
+        """Increase a counter"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        """The metrics for the module result"""
+        with self.lock:
+            phases = {
+                phase: {"count": metric["count"], "seconds": round(metric["seconds"], 6)}
+                for phase, metric in self.phases.items()
+            }
+            metrics = {"phases": phases}
+            metrics.update(self.counters)
+        return metrics
+
+
+METRICS = Metrics()
+
+
+def timed(phase):
+    """Decorator adding the wall time of every call to a phase of METRICS"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with METRICS.timer(phase):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
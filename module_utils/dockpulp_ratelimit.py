@@ -0,0 +1,71 @@
+import math
+import time
+
+from ansible.module_utils.dockpulp_cache import update_state
+from ansible.module_utils.dockpulp_metrics import METRICS
+
+# The rate limit of every limited environment: (calls per second, burst)
+LIMITS = {}
+
+
+def rate_limit_state(env):
+    """The name of the state file holding the token bucket of an environment"""
+    return "ratelimit-%s" % env
+
+
+def configure_rate_limit(env, rate, burst=None):
+    """Limit the dock-pulp calls of an environment, from all the module
+    processes of the host, to rate calls per second on average.
+    Args:
+        env: The environment to limit
+        rate: Calls per second, 0 or None removes the limit
+        burst: Calls allowed at once after an idle time, at least one, and
+               the rate rounded up by default
+    """
+    if not rate:
+        LIMITS.pop(env, None)
+        return
+    LIMITS[env] = (float(rate), max(1, burst or int(math.ceil(rate))))
+
+
+def command_env(command):
+    """The environment of a dock-pulp command, None for other commands"""
+    if "--server" in command[:-1]:
+        return command[command.index("--server") + 1]
+    return None
+
+
+def reserve(env):
+    """Take a token from the bucket of an environment, shared by all the
+    processes of the host through a locked state file.
+    When the bucket is empty the token is taken anyway, and the caller
+    waits for it to be refilled, so every caller is served in order
+    without polling the bucket.
+    Args:
+        env: The environment of the call
+    Returns:
+        The number of seconds to wait before the call, 0 without a limit
+    """
+    if env not in LIMITS:
+        return 0
+    rate, burst = LIMITS[env]
+    with update_state(rate_limit_state(env)) as state:
+        now = time.time()
+        tokens = state.get("tokens", burst)
+        elapsed = max(0.0, now - state.get("updated_at", now))
+        tokens = min(burst, tokens + elapsed * rate) - 1
+        state["tokens"] = tokens
+        state["updated_at"] = now
+    wait = -tokens / rate if tokens < 0 else 0
+    if wait:
+        METRICS.count("rate_limit_waits")
+    return wait
+
+
+def acquire(env):
+    """Wait for the rate limit of an environment before a dock-pulp call,
+    adding the wait time to the "rate_limit" phase of METRICS"""
+    wait = reserve(env)
+    if wait:
+        with METRICS.timer("rate_limit"):
+            time.sleep(wait)
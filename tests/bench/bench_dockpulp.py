@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""Benchmark the modules against the fake dock-pulp CLI of this directory.
+
+Every scenario ensures N repos twice: a "create" pass against an empty
+server, then a "noop" pass re-asserting the same repos.
+
+    ensure  one ensure_dockpulp_repo call per repo
+    module  one dockpulp_repo module run per repo
+    bulk    one dockpulp_repos module run for all the repos
+
+The in-process state (logins, inventory index, backends) is reset before
+every call of the ensure and module scenarios, like Ansible starts a new
+module process for every task.
+
+Example:
+    python tests/bench/bench_dockpulp.py --repos 10 100 1000 --latency 0.05
+    python tests/bench/bench_dockpulp.py --json results.json
+    python tests/bench/bench_dockpulp.py --baseline results.json --tolerance 0.2
+    python tests/bench/bench_dockpulp.py --server --latency 0.01 --seed-repos 20000
+    python tests/bench/bench_dockpulp.py --server --latency 0.01 --param backend='"rest"'
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from os.path import abspath, dirname, join
+
+BENCH_DIR = dirname(abspath(__file__))
+TESTS_DIR = dirname(BENCH_DIR)
+TOP_DIR = dirname(TESTS_DIR)
+
+sys.path[:0] = [join(TOP_DIR, "library"), TESTS_DIR, BENCH_DIR]
+
+import ansible.module_utils  # noqa E402
+
+ansible.module_utils.__path__.append(join(TOP_DIR, "module_utils"))
+
+import dockpulp_repo  # noqa E402
+import dockpulp_repos  # noqa E402
+from ansible.module_utils import dockpulp_backend, dockpulp_common  # noqa E402
+from fake_pulp_server import FakePulpServer  # noqa E402
+from utils import AnsibleExitJson, AnsibleFailJson, exit_json, fail_json  # noqa E402
+from utils import set_module_args  # noqa E402
+
+SCENARIOS = ["ensure", "module", "bulk"]
+
+PARAMS = {
+    "env": "qa",
+    "dockpulp_user": "bench",
+    "dockpulp_password": "bench",
+    "backend": "cli",
+}
+
+
+def repo_specs(count, description="benchmark repo"):
+    return [
+        {
+            "repo_name": "repo-%05d" % i,
+            "namespace": "bench",
+            "content_url": "/content/bench/redhat-bench-repo-%05d" % i,
+            "description": description,
+            "distribution": "ga",
+        }
+        for i in range(count)
+    ]
+
+
+def reset_process():
+    """Forget the in-process state, like a new module process"""
+    dockpulp_common.LOGGED_IN.clear()
+    dockpulp_common.INVENTORY.clear()
+    dockpulp_common.INVENTORY_CHANGES.clear()
+    dockpulp_common.OFFLINE.clear()
+    dockpulp_backend.BACKENDS.clear()
+
+
+def run_module(module, args):
+    set_module_args(dict(args))
+    try:
+        module.main()
+    except (AnsibleExitJson, AnsibleFailJson) as e:
+        result = e.args[0]
+    if result.get("failed"):
+        raise RuntimeError("%s failed: %s" % (module.__name__, result.get("msg")))
+    return result
+
+
+def run_pass(scenario, specs, extra_params):
+    """Ensure the repos once, returning the latency of every repo"""
+    latencies = []
+    if scenario == "bulk":
+        reset_process()
+        start = time.time()
+        run_module(dockpulp_repos, dict(PARAMS, repos=specs, **extra_params))
+        # Every repo waits for the whole run
+        return [time.time() - start] * len(specs)
+
+    for spec in specs:
+        reset_process()
+        params = dict(PARAMS, **spec)
+        params.update(extra_params)
+        start = time.time()
+        if scenario == "ensure":
+            result = dockpulp_common.ensure_dockpulp_repo(params, check_mode=False)
+            if result["returncode"] != 0:
+                raise RuntimeError("ensure_dockpulp_repo failed for %s" % spec["repo_name"])
+        else:
+            run_module(dockpulp_repo, params)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_benchmark(
+    scenario,
+    count,
+    latency=0.0,
+    output_size=0,
+    extra_params=None,
+    trace=False,
+    server=None,
+):
+    """Run one scenario for count repos against a fresh fake dock-pulp.
+    With server, a dict of FakePulpServer arguments, the fake dock-pulp keeps
+    its repos in a fake Pulp server, and the latency is added to every
+    request of the server instead of every command.
+    Returns:
+        A list with the results of the create and the noop passes
+    """
+    workdir = tempfile.mkdtemp(prefix="bench-dockpulp-")
+    environ = dict(os.environ)
+    os.environ.update(
+        {
+            "PATH": BENCH_DIR + os.pathsep + os.environ.get("PATH", ""),
+            "FAKE_DOCK_PULP_STATE": join(workdir, "state.json"),
+            "FAKE_DOCK_PULP_LATENCY": str(0 if server is not None else latency),
+            "FAKE_DOCK_PULP_OUTPUT_SIZE": str(output_size),
+            "DOCKPULP_ANSIBLE_CACHE_DIR": join(workdir, "cache"),
+        }
+    )
+    pulp_server = None
+    if server is not None:
+        pulp_server = FakePulpServer(latency=latency, **server).start()
+        os.environ["FAKE_DOCK_PULP_SERVER"] = pulp_server.url
+        if (extra_params or {}).get("backend") == "rest":
+            # The rest backend calls the fake Pulp directly
+            http = dict(extra_params.get("http") or {}, url=pulp_server.url)
+            extra_params = dict(extra_params, http=http)
+    module_exits = dockpulp_repo.AnsibleModule.exit_json, dockpulp_repo.AnsibleModule.fail_json
+    dockpulp_repo.AnsibleModule.exit_json = exit_json
+    dockpulp_repo.AnsibleModule.fail_json = fail_json
+    results = []
+    try:
+        specs = repo_specs(count)
+        for name in ("create", "noop"):
+            if trace:
+                tracemalloc.start()
+            start = time.time()
+            latencies = run_pass(scenario, specs, extra_params or {})
+            elapsed = time.time() - start
+            result = {
+                "scenario": scenario,
+                "pass": name,
+                "repos": count,
+                "seconds": round(elapsed, 3),
+                "repos_per_second": round(count / elapsed, 2),
+                "p50": round(percentile(latencies, 0.5), 4),
+                "p99": round(percentile(latencies, 0.99), 4),
+                "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "children_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            }
+            if pulp_server:
+                result["server"] = pulp_server.stats
+            if trace:
+                result["python_peak_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+                tracemalloc.stop()
+            results.append(result)
+    finally:
+        if pulp_server:
+            pulp_server.stop()
+        os.environ.clear()
+        os.environ.update(environ)
+        dockpulp_repo.AnsibleModule.exit_json, dockpulp_repo.AnsibleModule.fail_json = module_exits
+        reset_process()
+        shutil.rmtree(workdir)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """List the results slower than the baseline by more than tolerance"""
+    expected = {(r["scenario"], r["pass"], r["repos"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        base = expected.get((result["scenario"], result["pass"], result["repos"]))
+        if base and result["repos_per_second"] < base["repos_per_second"] * (1 - tolerance):
+            regressions.append((result, base))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scenario", choices=SCENARIOS, nargs="+", default=SCENARIOS)
+    parser.add_argument("--repos", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per dock-pulp call")
+    parser.add_argument("--output-size", type=int, default=0, help="debug bytes per -d call")
+    parser.add_argument(
+        "--param", action="append", default=[], help="extra module param, as key=json-value"
+    )
+    parser.add_argument("--server", action="store_true", help="keep the repos in a fake Pulp")
+    parser.add_argument("--seed-repos", type=int, default=0, help="repos seeded in the fake Pulp")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="failed fake Pulp requests")
+    parser.add_argument("--trace-memory", action="store_true", help="trace Python allocations")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="fail if slower than the results of this file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    extra_params = {}
+    for param in args.param:
+        key, value = param.split("=", 1)
+        extra_params[key] = json.loads(value)
+
+    server = None
+    if args.server:
+        server = {"repos": args.seed_repos, "error_rate": args.error_rate}
+
+    results = []
+    header = "%-8s %-6s %7s %9s %10s %8s %8s %12s"
+    print(header % ("scenario", "pass", "repos", "seconds", "repos/s", "p50", "p99", "peak_rss_kb"))
+    for scenario in args.scenario:
+        for count in args.repos:
+            for result in run_benchmark(
+                scenario,
+                count,
+                args.latency,
+                args.output_size,
+                extra_params,
+                args.trace_memory,
+                server,
+            ):
+                results.append(result)
+                print(
+                    "%-8s %-6s %7d %9.3f %10.2f %8.4f %8.4f %12d"
+                    % tuple(
+                        result[key]
+                        for key in (
+                            "scenario",
+                            "pass",
+                            "repos",
+                            "seconds",
+                            "repos_per_second",
+                            "p50",
+                            "p99",
+                            "peak_rss_kb",
+                        )
+                    )
+                )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for result, base in regressions:
+            print(
+                "REGRESSION %s %s %d repos: %.2f repos/s, baseline %.2f"
+                % (
+                    result["scenario"],
+                    result["pass"],
+                    result["repos"],
+                    result["repos_per_second"],
+                    base["repos_per_second"],
+                )
+            )
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
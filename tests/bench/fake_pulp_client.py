@@ -0,0 +1,129 @@
+"""The fake dock-pulp CLI side of fake_pulp_server.py.
+
+ServerState keeps the repos of the fake dock-pulp in a fake Pulp server.
+It speaks HTTP over a plain socket, as importing http.client would double
+the start time of every command.
+"""
+import base64
+import json
+import socket
+
+API = "/pulp/api/v2"
+
+DISTRIBUTOR_ID = "docker_web_distributor_name_cli"
+
+IMPORTER_TYPE_ID = "docker_importer"
+
+DISTRIBUTOR_TYPE_ID = "docker_distributor_web"
+
+
+def web_distributor(repo):
+    """The docker web distributor of a Pulp repo"""
+    return next(d for d in repo["distributors"] if d["id"] == DISTRIBUTOR_ID)
+
+
+def to_dockpulp(repo):
+    """Convert a Pulp repo to the dictionary of a dock-pulp list"""
+    config = web_distributor(repo)["config"]
+    return {
+        "id": repo["id"],
+        "title": repo["display_name"],
+        "description": repo["description"],
+        "distribution": repo["notes"].get("distribution"),
+        "docker-id": config.get("repo-registry-id"),
+        "redirect": config.get("redirect-url"),
+    }
+
+
+class ServerState(object):
+    """The state of the fake dock-pulp CLI, kept by a fake Pulp server"""
+
+    def __init__(self, url, user="dock-pulp", password="dock-pulp"):
+        host, port = url.split("//", 1)[1].rstrip("/").rsplit(":", 1)
+        self.address = (host, int(port))
+        self.set_auth(user, password)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def set_auth(self, user, password):
+        credentials = ("%s:%s" % (user, password)).encode("utf8")
+        self.auth = "Basic " + base64.b64encode(credentials).decode("ascii")
+
+    def call(self, method, path, body=None):
+        """Send a request to the server
+        Returns:
+            The status and the decoded body of the response
+        """
+        data = json.dumps(body).encode("utf8") if body is not None else b""
+        head = (
+            "%s %s HTTP/1.1\r\nHost: %s:%d\r\nAuthorization: %s\r\n"
+            "Content-Type: application/json\r\nContent-Length: %d\r\n"
+            "Connection: close\r\n\r\n"
+            % ((method, API + path) + self.address + (self.auth, len(data)))
+        )
+        chunks = []
+        with socket.create_connection(self.address) as sock:
+            sock.sendall(head.encode("ascii") + data)
+            chunk = sock.recv(65536)
+            while chunk:
+                chunks.append(chunk)
+                chunk = sock.recv(65536)
+        head, _, data = b"".join(chunks).partition(b"\r\n\r\n")
+        return int(head.split(None, 2)[1]), json.loads(data.decode("utf8"))
+
+    def login(self, user, password):
+        self.set_auth(user, password)
+        return self.call("POST", "/actions/login/", {})[0] == 200
+
+    def list(self, repo_ids):
+        criteria = {"filters": {"id": {"$in": repo_ids}}} if repo_ids else {}
+        body = {"criteria": criteria, "distributors": True}
+        status, repos = self.call("POST", "/repositories/search/", body)
+        found = {repo["id"]: to_dockpulp(repo) for repo in repos} if status == 200 else {}
+        if not repo_ids:
+            return list(found.values())
+        return [found.get(repo_id) for repo_id in repo_ids]
+
+    def create(self, repo):
+        body = {
+            "id": repo["id"],
+            "display_name": repo["title"],
+            "description": repo["description"],
+            "notes": {"_repo-type": "docker-repo", "distribution": repo["distribution"]},
+            "importer_type_id": IMPORTER_TYPE_ID,
+            "importer_config": {},
+            "distributors": [
+                {
+                    "distributor_type_id": DISTRIBUTOR_TYPE_ID,
+                    "distributor_id": DISTRIBUTOR_ID,
+                    "auto_publish": True,
+                    "distributor_config": {
+                        "repo-registry-id": repo["docker-id"],
+                        "redirect-url": repo["redirect"],
+                    },
+                }
+            ],
+        }
+        return self.call("POST", "/repositories/", body)[0] == 201
+
+    def update(self, repo_id, values):
+        delta = {}
+        if "title" in values:
+            delta["display_name"] = values["title"]
+        if "description" in values:
+            delta["description"] = values["description"]
+        if "distribution" in values:
+            delta["notes"] = {"distribution": values["distribution"]}
+        body = {"delta": delta}
+        if "docker-id" in values:
+            body["distributor_configs"] = {
+                DISTRIBUTOR_ID: {"repo-registry-id": values["docker-id"]}
+            }
+        return self.call("PUT", "/repositories/%s/" % repo_id, body)[0] == 202
+
+    def delete(self, repo_id):
+        return self.call("DELETE", "/repositories/%s/" % repo_id)[0] == 202
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""A local stand-in for the Docker Pulp (Pulp 2) REST API, for tests and benchmarks.
+
+It serves the endpoints dock-pulp uses to log in, list, search, create,
+update and delete repos, and the tasks spawned by updates and deletes.
+Every request needs HTTP basic auth. The server can add latency, fail a
+share of the requests, refuse requests over a concurrency limit, and be
+seeded with tens of thousands of repos.
+
+Example:
+    python tests/bench/fake_pulp_server.py --port 8080 --repos 20000 --latency 0.05
+
+    with FakePulpServer(latency=0.01) as server:
+        urlopen(server.url + "/pulp/api/v2/repositories/")
+"""
+import argparse
+import base64
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from fake_pulp_client import (
+    API,
+    DISTRIBUTOR_ID,
+    DISTRIBUTOR_TYPE_ID,
+    IMPORTER_TYPE_ID,
+    web_distributor,
+)
+
+# The types of the distributors a docker repo can be created with
+DISTRIBUTOR_TYPE_IDS = (DISTRIBUTOR_TYPE_ID, "docker_distributor_export")
+
+
+def make_repo(repo_id, docker_id, description=None, distribution=None, redirect=None):
+    """A docker repo in the shape the Pulp API returns it"""
+    return {
+        "id": repo_id,
+        "display_name": repo_id,
+        "description": description,
+        "notes": {"_repo-type": "docker-repo", "distribution": distribution},
+        "distributors": [
+            {
+                "id": DISTRIBUTOR_ID,
+                "config": {"repo-registry-id": docker_id, "redirect-url": redirect},
+            }
+        ],
+    }
+
+
+def public(repo, details=False):
+    """A repo as the API returns it: like Pulp, without its distributors
+    unless the request asks for the details"""
+    if details:
+        return repo
+    return {key: value for key, value in repo.items() if key != "distributors"}
+
+
+def asked(query, *names):
+    """Check if a query string asks for one of the flags"""
+    return any(query.get(name, [""])[0].lower() == "true" for name in names)
+
+
+class PulpState(object):
+    """The repos and tasks of the server"""
+
+    def __init__(self, repos=0, task_duration=0.0):
+        self.lock = threading.Lock()
+        self.repos = {}
+        self.tasks = {}
+        self.task_ids = itertools.count(1)
+        self.task_duration = task_duration
+        for i in range(repos):
+            repo_id = "redhat-seed-repo-%06d" % i
+            self.repos[repo_id] = make_repo(
+                repo_id, "seed/repo-%06d" % i, "seeded repo", "ga", "/content/" + repo_id
+            )
+
+    def spawn_task(self, error=None):
+        task_id = "task-%d" % next(self.task_ids)
+        self.tasks[task_id] = {"finish_at": time.time() + self.task_duration, "error": error}
+        return {"spawned_tasks": [{"task_id": task_id}], "result": None, "error": None}
+
+    def task(self, task_id):
+        task = self.tasks.get(task_id)
+        if task is None:
+            return None
+        if time.time() < task["finish_at"]:
+            state = "running"
+        else:
+            state = "error" if task["error"] else "finished"
+        return {"task_id": task_id, "state": state, "error": task["error"]}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.stats_lock:
+            self.server.stats["connections"] += 1
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def reply(self, code, body=None):
+        data = json.dumps(body).encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length).decode("utf8")) if length else {}
+
+    def authenticated(self):
+        auth = self.headers.get("Authorization", "")
+        if not auth.startswith("Basic "):
+            return False
+        user, _, password = base64.b64decode(auth[6:]).decode("utf8").partition(":")
+        return self.server.users.get(user, password) == password
+
+    def handle_request(self, method):
+        server = self.server
+        body = self.read_body()
+        with server.stats_lock:
+            server.stats["requests"] += 1
+            server.in_flight += 1
+            server.stats["max_in_flight"] = max(server.stats["max_in_flight"], server.in_flight)
+            over_limit = server.max_concurrency and server.in_flight > server.max_concurrency
+        try:
+            if self.path == "/fake/stats":
+                with server.stats_lock:
+                    return self.reply(200, dict(server.stats, repos=len(self.state.repos)))
+            if over_limit:
+                return self.reply(429, {"error": "too many requests"})
+            time.sleep(server.latency)
+            if server.error_rate and random.random() < server.error_rate:
+                return self.reply(500, {"error": "injected error"})
+            if not self.authenticated():
+                return self.reply(401, {"error": "unauthorized"})
+            path, _, query = self.path.partition("?")
+            code, reply = self.route(method, path, body, parse_qs(query))
+            return self.reply(code, reply)
+        finally:
+            with server.stats_lock:
+                server.in_flight -= 1
+
+    def route(self, method, path, body, query):
+        state = self.state
+        if method == "POST" and path == API + "/actions/login/":
+            return 200, {"key": "fake-key", "certificate": "fake-certificate"}
+
+        if method == "GET" and path == API + "/repositories/":
+            details = asked(query, "details", "distributors")
+            with state.lock:
+                return 200, [public(repo, details) for repo in state.repos.values()]
+
+        if method == "POST" and path == API + "/repositories/search/":
+            criteria = body.get("criteria", {})
+            ids = criteria.get("filters", {}).get("id", {}).get("$in")
+            with state.lock:
+                if ids is None:
+                    repos = [state.repos[repo_id] for repo_id in sorted(state.repos)]
+                else:
+                    repos = [state.repos[repo_id] for repo_id in ids if repo_id in state.repos]
+            skip = criteria.get("skip") or 0
+            end = skip + criteria["limit"] if criteria.get("limit") else None
+            details = body.get("details") or body.get("distributors")
+            return 200, [public(repo, details) for repo in repos[skip:end]]
+
+        if method == "POST" and path == API + "/repositories/":
+            if body.get("importer_type_id") != IMPORTER_TYPE_ID or any(
+                distributor.get("distributor_type_id") not in DISTRIBUTOR_TYPE_IDS
+                for distributor in body.get("distributors", [])
+            ):
+                return 400, {"error": "missing or unknown importer or distributor type"}
+            repo = make_repo(
+                body["id"],
+                None,
+                body.get("description"),
+                body.get("notes", {}).get("distribution"),
+            )
+            repo["display_name"] = body.get("display_name") or body["id"]
+            repo["distributors"] = [
+                {
+                    "id": distributor.get("distributor_id"),
+                    "distributor_type_id": distributor["distributor_type_id"],
+                    "config": distributor.get("distributor_config", {}),
+                }
+                for distributor in body.get("distributors", [])
+            ]
+            with state.lock:
+                if body["id"] in state.repos:
+                    return 409, {"error": "repository %s already exists" % body["id"]}
+                state.repos[body["id"]] = repo
+            return 201, repo
+
+        if path.startswith(API + "/repositories/"):
+            repo_id = path.split("/repositories/", 1)[1].strip("/")
+            with state.lock:
+                repo = state.repos.get(repo_id)
+                if repo is None:
+                    return 404, {"error": "repository %s not found" % repo_id}
+                if method == "GET":
+                    return 200, public(repo, asked(query, "details", "distributors"))
+                if method == "DELETE":
+                    del state.repos[repo_id]
+                    return 202, state.spawn_task()
+                if method == "PUT":
+                    delta = body.get("delta", {})
+                    for key in ("display_name", "description"):
+                        if key in delta:
+                            repo[key] = delta[key]
+                    repo["notes"].update(delta.get("notes", {}))
+                    config = body.get("distributor_configs", {}).get(DISTRIBUTOR_ID, {})
+                    web_distributor(repo)["config"].update(config)
+                    return 202, state.spawn_task()
+
+        if method == "GET" and path.startswith(API + "/tasks/"):
+            task_id = path.split("/tasks/", 1)[1].strip("/")
+            with state.lock:
+                task = state.task(task_id)
+            if task is None:
+                return 404, {"error": "task %s not found" % task_id}
+            return 200, task
+
+        if method == "POST" and path == API + "/tasks/search/":
+            ids = body.get("criteria", {}).get("filters", {}).get("task_id", {}).get("$in", [])
+            with state.lock:
+                tasks = [state.task(task_id) for task_id in ids]
+            return 200, [task for task in tasks if task]
+
+        return 404, {"error": "%s %s not found" % (method, path)}
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+
+class FakePulpServer(object):
+    """Run the fake Pulp server in a background thread
+    Args:
+        port: The port to listen on, 0 for any free port
+        latency: Seconds added to every request
+        error_rate: Share of the requests failing with a 500 error
+        max_concurrency: Requests over this number of requests in flight get a 429 error
+        repos: Number of repos to seed the server with
+        task_duration: Seconds the spawned tasks stay running
+        users: The accepted users and their passwords, any user when None
+    """
+
+    def __init__(
+        self,
+        port=0,
+        latency=0.0,
+        error_rate=0.0,
+        max_concurrency=0,
+        repos=0,
+        task_duration=0.0,
+        users=None,
+    ):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = PulpState(repos, task_duration)
+        self.httpd.latency = latency
+        self.httpd.error_rate = error_rate
+        self.httpd.max_concurrency = max_concurrency
+        self.httpd.users = AnyUser() if users is None else users
+        self.httpd.stats_lock = threading.Lock()
+        self.httpd.stats = {"requests": 0, "connections": 0, "max_in_flight": 0}
+        self.httpd.in_flight = 0
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.httpd.server_address
+
+    @property
+    def state(self):
+        return self.httpd.state
+
+    @property
+    def stats(self):
+        with self.httpd.stats_lock:
+            return dict(self.httpd.stats)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class AnyUser(dict):
+    """Accept any user with any password"""
+
+    def get(self, user, password=None):
+        return password
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--max-concurrency", type=int, default=0)
+    parser.add_argument("--repos", type=int, default=0)
+    parser.add_argument("--task-duration", type=float, default=0.0)
+    args = parser.parse_args(argv)
+    server = FakePulpServer(
+        args.port,
+        args.latency,
+        args.error_rate,
+        args.max_concurrency,
+        args.repos,
+        args.task_duration,
+    )
+    print("Serving fake Pulp on %s" % server.url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 import sys
 from os.path import abspath, dirname, join
 
-from ansible.module_utils.six import PY2, PY3
+import pytest
 
 
 def pytest_sessionstart(session):
@@ -14,7 +14,9 @@ def pytest_sessionstart(session):
     of the ``library`` directory, so we can import modules during testing.
 
     ansible-playbook will also import files from the "module_utils" directory
-    into the "ansible.module_utils.*" namespace
+    into the "ansible.module_utils.*" namespace. We extend the package path of
+    ``ansible.module_utils`` so every file there (and the imports between
+    them) resolve the same way.
     """
     working_directory = dirname(abspath((__file__)))
     library_path = join(dirname(working_directory), "library")
@@ -23,25 +25,15 @@ def pytest_sessionstart(session):
 
     module_utils_path = join(dirname(working_directory), "module_utils")
 
-    dockpulp_location = join(module_utils_path, "dockpulp_common.py")
-    dockpulp_module_name = "ansible.module_utils.dockpulp_common"
-
-    if PY3:
-        # Python 3.5+
-        import importlib.util
-
-        dockpulp_spec = importlib.util.spec_from_file_location(
-            dockpulp_module_name, dockpulp_location
-        )
-        dockpulp_module = importlib.util.module_from_spec(dockpulp_spec)
-        dockpulp_spec.loader.exec_module(dockpulp_module)
-    if PY2:
-        import imp
-
-        dockpulp_module = imp.load_source(dockpulp_module_name, dockpulp_location)
+    import ansible.module_utils
 
-    sys.modules[dockpulp_module_name] = dockpulp_module
+    if module_utils_path not in ansible.module_utils.__path__:
+        ansible.module_utils.__path__.append(module_utils_path)
 
-    import ansible.module_utils
 
-    ansible.module_utils.dockpulp_common = dockpulp_module
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keep the local state files (sessions, caches) of every test apart."""
+    path = str(tmp_path / "cache")
+    monkeypatch.setenv("DOCKPULP_ANSIBLE_CACHE_DIR", path)
+    return path
@@ -0,0 +1,183 @@
+import importlib.util
+from os.path import abspath, dirname, join
+
+import pytest
+from utils import MagicMock
+
+from ansible.parsing.dataloader import DataLoader
+from ansible.playbook.play_context import PlayContext
+from ansible.playbook.task import Task
+from ansible.plugins.loader import module_loader
+from ansible.template import Templar
+
+try:
+    from ansible.plugins.loader import init_plugin_loader
+except ImportError:  # ansible < 2.15 loads its plugins on import
+    init_plugin_loader = None
+
+TOP_DIR = dirname(dirname(abspath(__file__)))
+
+spec = importlib.util.spec_from_file_location(
+    "action_dockpulp_repo", join(TOP_DIR, "action_plugins", "dockpulp_repo.py")
+)
+action_dockpulp_repo = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(action_dockpulp_repo)
+
+if init_plugin_loader is not None:
+    init_plugin_loader()
+module_loader.add_directory(join(TOP_DIR, "library"))
+
+REPOS = [
+    {"name": "repo1", "description": "first"},
+    {"name": "repo2", "description": "second"},
+    {"name": "repo3", "description": "third"},
+]
+
+TASK = {
+    "dockpulp_repo": {
+        "env": "qa",
+        "dockpulp_user": "user",
+        "dockpulp_password": "password",
+        "repo_name": "{{ item.name }}",
+        "namespace": "ns",
+        "content_url": "/content/redhat-ns-{{ item.name }}",
+        "description": "{{ item.description }}",
+        "distribution": "ga",
+    },
+    "loop": "{{ repos }}",
+}
+
+
+@pytest.fixture(autouse=True)
+def batches():
+    yield action_dockpulp_repo.BATCHES
+    action_dockpulp_repo.BATCHES.clear()
+
+
+def run_loop(task_ds, execute_module, task_vars=None):
+    """Run a task like the TaskExecutor runs a loop: one action plugin per item
+    Returns:
+        The result of every item
+    """
+    task = Task.load(task_ds)
+    task_vars = dict(task_vars or {}, repos=REPOS, inventory_hostname="localhost")
+    loader = DataLoader()
+    results = []
+    for item in Templar(loader, variables=task_vars).template(task.loop):
+        item_vars = dict(task_vars, item=item, ansible_loop_var="item")
+        templar = Templar(loader, variables=item_vars)
+        if task.when and not task.evaluate_conditional(templar, item_vars):
+            continue
+        item_task = task.copy(exclude_parent=True, exclude_tasks=True)
+        item_task.post_validate(templar)
+        action = action_dockpulp_repo.ActionModule(
+            item_task, MagicMock(), PlayContext(), loader, templar, None
+        )
+        action._execute_module = execute_module
+        results.append(action.run(task_vars=item_vars))
+    return results
+
+
+def test_loop_is_batched():
+    """test a loop runs one dockpulp_repos module, and every item gets its result"""
+    execute_module = MagicMock()
+    execute_module.return_value = {
+        "changed": True,
+        "backend": "cli",
+        "results": [
+            {"changed": True, "returncode": 0, "repo_name": "repo1", "full_repo_name": "a"},
+            {"changed": False, "returncode": 0, "repo_name": "repo2", "full_repo_name": "b"},
+            {"changed": True, "returncode": 1, "repo_name": "repo3", "full_repo_name": "c"},
+        ],
+    }
+    results = run_loop(TASK, execute_module)
+    execute_module.assert_called_once()
+    kwargs = execute_module.call_args[1]
+    assert kwargs["module_name"] == "dockpulp_repos"
+    assert kwargs["module_args"]["env"] == "qa"
+    assert kwargs["module_args"]["max_workers"] == 1
+    assert kwargs["module_args"]["repos"] == [
+        {
+            "repo_name": repo["name"],
+            "namespace": "ns",
+            "content_url": "/content/redhat-ns-%s" % repo["name"],
+            "description": repo["description"],
+            "distribution": "ga",
+        }
+        for repo in REPOS
+    ]
+    assert results == [
+        {"changed": True, "returncode": 0, "backend": "cli"},
+        {"changed": False, "returncode": 0, "backend": "cli"},
+        {"changed": True, "returncode": 1, "backend": "cli", "failed": True},
+    ]
+
+
+def test_loop_when_skips_items():
+    """test the items skipped by "when" are left out of the batch"""
+    execute_module = MagicMock()
+    execute_module.return_value = {
+        "changed": False,
+        "results": [{"changed": False, "returncode": 0}, {"changed": False, "returncode": 0}],
+    }
+    results = run_loop(dict(TASK, when="item.name != 'repo2'"), execute_module)
+    execute_module.assert_called_once()
+    repos = execute_module.call_args[1]["module_args"]["repos"]
+    assert [repo["repo_name"] for repo in repos] == ["repo1", "repo3"]
+    assert len(results) == 2
+
+
+def test_loop_invalid_item():
+    """test an item with an invalid content url runs alone, and fails alone"""
+
+    def execute_module(module_name="dockpulp_repo", module_args=None, **kwargs):
+        if module_name == "dockpulp_repos":
+            return {"changed": True, "results": [{"changed": True, "returncode": 0}] * 2}
+        return {"failed": True, "msg": "the content-url needs to start with /content"}
+
+    task = dict(
+        TASK,
+        dockpulp_repo=dict(
+            TASK["dockpulp_repo"],
+            content_url="{{ '/dist' if item.name == 'repo2' else '/content' }}/{{ item.name }}",
+        ),
+    )
+    execute_module = MagicMock(side_effect=execute_module)
+    results = run_loop(task, execute_module)
+    assert execute_module.call_count == 2
+    repos = execute_module.call_args_list[0][1]["module_args"]["repos"]
+    assert [repo["repo_name"] for repo in repos] == ["repo1", "repo3"]
+    assert results == [
+        {"changed": True, "returncode": 0},
+        {"failed": True, "msg": "the content-url needs to start with /content"},
+        {"changed": True, "returncode": 0},
+    ]
+
+
+def test_batch_failed():
+    """test a failed batch fails every item"""
+    execute_module = MagicMock()
+    execute_module.return_value = {"failed": True, "msg": "login failed", "invocation": {}}
+    results = run_loop(TASK, execute_module)
+    assert results == [{"failed": True, "msg": "login failed"}] * 3
+
+
+def test_loop_envs_not_batched():
+    """test a loop over a list of envs runs one dockpulp_repo module per item"""
+    execute_module = MagicMock(return_value={"changed": False})
+    task = dict(TASK, dockpulp_repo=dict(TASK["dockpulp_repo"], env=["qa", "stage"]))
+    results = run_loop(task, execute_module)
+    assert execute_module.call_count == 3
+    assert "module_name" not in execute_module.call_args[1]
+    assert results == [{"changed": False}] * 3
+
+
+def test_no_loop():
+    """test a task outside of a loop runs the dockpulp_repo module"""
+    task = Task.load({"dockpulp_repo": dict(TASK["dockpulp_repo"], repo_name="repo")})
+    action = action_dockpulp_repo.ActionModule(
+        task, MagicMock(), PlayContext(), DataLoader(), Templar(DataLoader()), None
+    )
+    action._execute_module = MagicMock(return_value={"changed": False})
+    assert action.run(task_vars={}) == {"changed": False}
+    action._execute_module.assert_called_once_with(task_vars={}, wrap_async=0)
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench"))
+
+import bench_dockpulp  # noqa E402
+
+
+@pytest.mark.parametrize("scenario", bench_dockpulp.SCENARIOS)
+def test_run_benchmark(scenario):
+    """test every benchmark scenario runs against the fake dock-pulp"""
+    results = bench_dockpulp.run_benchmark(scenario, 3)
+    assert [(r["pass"], r["repos"]) for r in results] == [("create", 3), ("noop", 3)]
+    assert all(r["repos_per_second"] > 0 for r in results)
+
+
+def test_compare():
+    """test compare reports the results slower than the baseline"""
+    baseline = [{"scenario": "bulk", "pass": "noop", "repos": 10, "repos_per_second": 100}]
+    slow = [{"scenario": "bulk", "pass": "noop", "repos": 10, "repos_per_second": 70}]
+    fast = [{"scenario": "bulk", "pass": "noop", "repos": 10, "repos_per_second": 90}]
+    assert bench_dockpulp.compare(slow, baseline, 0.2) == [(slow[0], baseline[0])]
+    assert bench_dockpulp.compare(fast, baseline, 0.2) == []
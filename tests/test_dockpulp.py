@@ -1,8 +1,12 @@
+import json
+import subprocess
+import time
 from unittest import TestCase
 from utils import patch
 
 import pytest
 import dockpulp_repo
+from ansible.module_utils import dockpulp_common, dockpulp_latency
 from utils import AnsibleExitJson, AnsibleFailJson, exit_json, fail_json, set_module_args
 
 
@@ -19,18 +23,46 @@ class TestSetupDockpulp(TestCase):
             "dockpulp_password": "dockpulp_Passw0rd",
         }
         self.out = "FIRST LINE\nINFO     property = value\nINFO     oh = wow\n"
-        dockpulp_repo.LOGGED_IN["qa"] = False
+        dockpulp_common.LOGGED_IN["qa"] = False
 
     @pytest.fixture(autouse=True)
     def fake_exits(self, monkeypatch):
         monkeypatch.setattr(dockpulp_repo.AnsibleModule, "exit_json", exit_json)
         monkeypatch.setattr(dockpulp_repo.AnsibleModule, "fail_json", fail_json)
 
-    @patch("dockpulp_repo.execute_command")
+    @pytest.fixture
+    def snapshot(self, tmp_path):
+        """Write an inventory snapshot of the repo, listed age seconds ago"""
+
+        def write(age, description="old description"):
+            path = str(tmp_path / "inventory-qa.json")
+            repo = {
+                "description": description,
+                "title": "redhat-namespace-test-virt-artifacts-server-rhel8",
+                "docker-id": "namespace-test/virt-artifacts-server-rhel8",
+                "distribution": "ga",
+            }
+            with open(path, "w") as f:
+                json.dump(
+                    {
+                        "fetched_at": time.time() - age,
+                        "repos": {"redhat-namespace-test-virt-artifacts-server-rhel8": repo},
+                    },
+                    f,
+                )
+            return path
+
+        self.write_snapshot = write
+        yield write
+        dockpulp_common.OFFLINE.clear()
+        dockpulp_common.INVENTORY.clear()
+        dockpulp_common.INVENTORY_CHANGES.clear()
+
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
     def test_login_ok(self, mock_ec):
         """Test login function"""
         mock_ec.return_value = (0, "logged in")
-        dockpulp_repo.login("qa", "dockpulp_user", "dockpulp_Passw0rd", 120)
+        dockpulp_common.login("qa", "dockpulp_user", "dockpulp_Passw0rd", 120)
         mock_ec.assert_called_once_with(
             [
                 "dock-pulp",
@@ -46,58 +78,115 @@ class TestSetupDockpulp(TestCase):
             120,
         )
 
-    @patch("dockpulp_repo.execute_command")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
     def test_login_unsuccessful(self, mock_ec):
         """Test failed login function"""
         mock_ec.return_value = (-1, "failed")
-        result = dockpulp_repo.login("qa", "dockpulp_user", "dockpulp_Passw0rd")[0]
+        result = dockpulp_common.login("qa", "dockpulp_user", "dockpulp_Passw0rd")[0]
         self.assertEqual(result, False)
 
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
+    def test_login_other_password(self, mock_ec):
+        """Test a login with another password doesn't reuse a failed login"""
+        mock_ec.side_effect = [(-1, "failed"), (0, "logged in")]
+        assert dockpulp_common.login("qa", "dockpulp_user", "wrong")[0] is False
+        assert dockpulp_common.login("qa", "dockpulp_user", "dockpulp_Passw0rd")[0] is True
+        assert mock_ec.call_count == 2
+
     def test_login_already(self):
         """Test if login has already happened"""
-        dockpulp_repo.LOGGED_IN["qa"] = True
-        result = dockpulp_repo.login("qa", "dockpulp_user", "dockpulp_Passw0rd")[0]
+        dockpulp_common.LOGGED_IN["qa"] = True
+        result = dockpulp_common.login("qa", "dockpulp_user", "dockpulp_Passw0rd")[0]
         self.assertEqual(result, True)
 
-    @patch("dockpulp_repo.subprocess.Popen")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
+    def test_login_session_cache(self, mock_ec):
+        """Test a login is reused by a later module process"""
+        mock_ec.return_value = (0, "logged in")
+        dockpulp_common.login("qa", "dockpulp_user", "dockpulp_Passw0rd")
+        # A new module process starts without the in-process memo
+        dockpulp_common.LOGGED_IN["qa"] = False
+        result = dockpulp_common.login("qa", "dockpulp_user", "dockpulp_Passw0rd")[0]
+        self.assertEqual(result, True)
+        mock_ec.assert_called_once()
+
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
+    def test_existing_repo_single_flight(self, mock_ec):
+        """Test lookups of the same repo share one dock-pulp list until it changes"""
+        dockpulp_common.LOGGED_IN["qa"] = True
+        mock_ec.return_value = (0, self.out)
+        for _ in range(2):
+            dockpulp_common.get_existing_repo("repo", "qa", "dockpulp_user", "dockpulp_Passw0rd")
+        mock_ec.assert_called_once()
+        dockpulp_common.update_inventory("qa", "repo", {"description": "new"})
+        dockpulp_common.get_existing_repo("repo", "qa", "dockpulp_user", "dockpulp_Passw0rd")
+        self.assertEqual(mock_ec.call_count, 2)
+
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
+    def test_login_session_cache_disabled(self, mock_ec):
+        """Test a session_ttl of 0 always logs in"""
+        mock_ec.return_value = (0, "logged in")
+        dockpulp_common.login("qa", "dockpulp_user", "dockpulp_Passw0rd", session_ttl=0)
+        dockpulp_common.LOGGED_IN["qa"] = False
+        dockpulp_common.login("qa", "dockpulp_user", "dockpulp_Passw0rd", session_ttl=0)
+        self.assertEqual(mock_ec.call_count, 2)
+
+    @patch("ansible.module_utils.dockpulp_common.subprocess.Popen")
     def test_execute_command(self, mock_run):
         """Test execute_command"""
         mock_run.return_value.communicate.return_value = ("succeed", "")
         mock_run.return_value.poll.return_value = 0
-        result, _ = dockpulp_repo.execute_command(["fake", "command"], 120)
+        result, _ = dockpulp_common.execute_command(["fake", "command"], 120)
         self.assertEqual(result, 0)
 
     def test_parse_output(self):
         """Test parse_output properly parses output"""
         expected = {"property": "value", "oh": "wow"}
-        result = dockpulp_repo.parse_output(self.out)
+        result = dockpulp_common.parse_output(self.out)
         self.assertDictEqual(result, expected)
 
-    @patch("dockpulp_repo.execute_command")
-    @patch("dockpulp_repo.parse_output")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
+    @patch("ansible.module_utils.dockpulp_common.parse_output")
     def test_existing_repo(self, mock_parse_output, mock_ec):
         """Test existing_repo finds existing repo"""
-        dockpulp_repo.LOGGED_IN["qa"] = True
+        dockpulp_common.LOGGED_IN["qa"] = True
         mock_ec.return_value = (0, "found one repo")
-        dockpulp_repo.get_existing_repo("repo", "qa", "dockpulp_user", "dockpulp_Passw0rd")
+        dockpulp_common.get_existing_repo("repo", "qa", "dockpulp_user", "dockpulp_Passw0rd")
         mock_parse_output.assert_called()
 
-    @patch("dockpulp_repo.execute_command")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
     def test_existing_repo_nologin(self, mock_ec):
         """Test existing_repo with failed login"""
         mock_ec.return_value = (-1, "not logged in")
         with pytest.raises(RuntimeError):
-            dockpulp_repo.get_existing_repo("repo", "qa", "dockpulp_user", "dockpulp_passw0rd")
+            dockpulp_common.get_existing_repo("repo", "qa", "dockpulp_user", "dockpulp_passw0rd")
 
-    @patch("dockpulp_repo.execute_command")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
     def test_existing_repo_notfound(self, mock_ec):
         """Test existing_repo handles non-existent repo"""
-        dockpulp_repo.LOGGED_IN["qa"] = True
+        dockpulp_common.LOGGED_IN["qa"] = True
         mock_ec.return_value = (-1, "not found")
-        result = dockpulp_repo.get_existing_repo("repo", "qa", "dockpulp_user", "dockpulp_passw0rd")
+        result = dockpulp_common.get_existing_repo(
+            "repo", "qa", "dockpulp_user", "dockpulp_passw0rd"
+        )
         expected = None
         self.assertEqual(result, expected)
 
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
+    def test_existing_repo_auth_error(self, mock_ec):
+        """Test existing_repo logs in again when the cached login is rejected"""
+        dockpulp_common.LOGGED_IN["qa"] = True
+        mock_ec.side_effect = [
+            (1, "401 Client Error: Unauthorized"),
+            (0, "logged in"),
+            (0, "INFO     id = repo\n"),
+        ]
+        result = dockpulp_common.get_existing_repo(
+            "repo", "qa", "dockpulp_user", "dockpulp_passw0rd"
+        )
+        self.assertEqual(result, {"id": "repo"})
+        self.assertEqual(mock_ec.call_args_list[1][0][0][4], "login")
+
     def test_create_commmand(self):
         """Test that create_command assembles command correctly"""
         env = "qa"
@@ -119,7 +208,7 @@ class TestSetupDockpulp(TestCase):
             "--description=fake description",
             "--distribution=tech-preview",
         ]
-        result = dockpulp_repo.create_command(env, repo)
+        result = dockpulp_common.create_command(env, repo)
         self.assertEqual(result, expected_command)
 
     def test_update_commmand(self):
@@ -143,7 +232,7 @@ class TestSetupDockpulp(TestCase):
             "--distribution=new_distribution",
             "--dockerid=new_id",
         ]
-        result = dockpulp_repo.update_command(server, repo_name, modified)
+        result = dockpulp_common.update_command(server, repo_name, modified)
         self.assertEqual(result, expected_command)
 
     def test_get_comparable_repo(self):
@@ -163,19 +252,19 @@ class TestSetupDockpulp(TestCase):
             "title": "title",
             "distribution": "dist",
         }
-        result = dockpulp_repo.get_comparable_repo(repo)
+        result = dockpulp_common.get_comparable_repo(repo)
         self.assertEqual(result, expected)
 
     def test_get_comparable_repo_none(self):
         """Test get_comparable_repo handles None repo"""
-        self.assertEqual(dockpulp_repo.get_comparable_repo(None), None)
+        self.assertEqual(dockpulp_common.get_comparable_repo(None), None)
 
-    @patch("dockpulp_repo.execute_command")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
     def test_ensure_dockpulp_repo_nologin(self, mock_ec):
         """Test ensure_dockpulp_repo with failed login"""
         mock_ec.return_value = (-1, "not logged in")
         with pytest.raises(RuntimeError):
-            dockpulp_repo.ensure_dockpulp_repo(self.dockpulp_repo_params, True)
+            dockpulp_common.ensure_dockpulp_repo(self.dockpulp_repo_params, True)
 
     def test_prepare_diff_data(self):
         """test prepare_diff_data"""
@@ -207,7 +296,7 @@ class TestSetupDockpulp(TestCase):
                 "distribution": "dist",
             },
         }
-        result = dockpulp_repo.prepare_diff_data(dock_repo, repo)
+        result = dockpulp_common.prepare_diff_data(dock_repo, repo)
         self.assertEqual(result, expected)
 
     def test_prepare_diff_data_none(self):
@@ -230,20 +319,20 @@ class TestSetupDockpulp(TestCase):
                 "distribution": "dist",
             },
         }
-        result = dockpulp_repo.prepare_diff_data(None, repo)
+        result = dockpulp_common.prepare_diff_data(None, repo)
         self.assertEqual(result, expected)
 
-    @patch("dockpulp_repo.execute_command")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
     def test_update_dockpulp_repo(self, mock_ec):
         """test update_dockpulp_repo can update repo"""
         stdout = "INFO    updating repo redhat-namespace-test-virt"
         mock_ec.return_value = (0, stdout)
-        result = dockpulp_repo.update_dockpulp_repo(
+        result = dockpulp_common.update_dockpulp_repo(
             "qa", "redhat-namespace-test-virt", [("description", "before_change", "after_change")]
         )
         assert result == 0
 
-    @patch("dockpulp_repo.execute_command")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
     def test_create_dockpulp_repo(self, mock_ec):
         """test create_dockpulp_repo can create repo"""
         repo = {
@@ -253,14 +342,14 @@ class TestSetupDockpulp(TestCase):
             "distribution": "dist",
         }
         mock_ec.return_value = (0, "created")
-        result = dockpulp_repo.create_dockpulp_repo("qa", repo)
+        result = dockpulp_common.create_dockpulp_repo("qa", repo)
         assert result == 0
 
-    @patch("dockpulp_repo.get_comparable_repo")
-    @patch("dockpulp_repo.execute_command")
+    @patch("ansible.module_utils.dockpulp_common.get_comparable_repo")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
     def test_ensure_dockpulp_repo_unchanged_run(self, mock_ec, mock_cmp_repo):
         """Test ensure_dockpulp_repo without repo change"""
-        dockpulp_repo.LOGGED_IN["qa"] = True
+        dockpulp_common.LOGGED_IN["qa"] = True
         mock_ec.return_value = (0, "no change")
         mock_cmp_repo.return_value = {
             "description": "virt-artifacts-server contains different builds of virtctl.",
@@ -269,15 +358,50 @@ class TestSetupDockpulp(TestCase):
             "distribution": "ga",
         }
         check_mode = False
-        result = dockpulp_repo.ensure_dockpulp_repo(self.dockpulp_repo_params, check_mode)
+        result = dockpulp_common.ensure_dockpulp_repo(self.dockpulp_repo_params, check_mode)
+        assert result == {"returncode": 0, "changed": False, "stdout_lines": []}
+
+    @patch("ansible.module_utils.dockpulp_common.get_existing_repo")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
+    def test_ensure_dockpulp_repo_fingerprint(self, mock_ec, mock_ger):
+        """Test ensure_dockpulp_repo skips the lookup of a repo applied with the same values"""
+        mock_ec.return_value = (0, "logged in")
+        mock_ger.return_value = None
+        params = dict(self.dockpulp_repo_params, fingerprint_max_age=3600)
+        with patch("ansible.module_utils.dockpulp_common.create_dockpulp_repo") as mock_cdp:
+            mock_cdp.return_value = 0
+            assert dockpulp_common.ensure_dockpulp_repo(params, False)["changed"]
+
+        dockpulp_common.LOGGED_IN["qa"] = False
+        mock_ec.reset_mock()
+        result = dockpulp_common.ensure_dockpulp_repo(params, False)
         assert result == {"returncode": 0, "changed": False, "stdout_lines": []}
+        mock_ger.assert_called_once()
+        mock_ec.assert_not_called()
+
+        # Another description, or force_refresh, looks the repo up again
+        params["description"] = "new"
+        dockpulp_common.ensure_dockpulp_repo(params, True)
+        params["description"] = self.dockpulp_repo_params["description"]
+        dockpulp_common.ensure_dockpulp_repo(dict(params, force_refresh=True), True)
+        assert mock_ger.call_count == 3
+
+    @patch("ansible.module_utils.dockpulp_common.get_existing_repo")
+    def test_ensure_dockpulp_repo_fingerprint_check_mode(self, mock_ger):
+        """Test check mode doesn't record the fingerprint of a repo it would change"""
+        dockpulp_common.LOGGED_IN["qa"] = True
+        mock_ger.return_value = None
+        params = dict(self.dockpulp_repo_params, fingerprint_max_age=3600)
+        dockpulp_common.ensure_dockpulp_repo(params, True)
+        dockpulp_common.ensure_dockpulp_repo(params, True)
+        assert mock_ger.call_count == 2
 
-    @patch("dockpulp_repo.get_comparable_repo")
-    @patch("dockpulp_repo.update_dockpulp_repo")
-    @patch("dockpulp_repo.execute_command")
+    @patch("ansible.module_utils.dockpulp_common.get_comparable_repo")
+    @patch("ansible.module_utils.dockpulp_common.update_dockpulp_repo")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
     def test_ensure_dockpulp_repo_update(self, mock_ec, mock_update_dockpulp_repo, mock_cmp_repo):
         """Test ensure_dockpulp_repo when updating an existing repo"""
-        dockpulp_repo.LOGGED_IN["qa"] = True
+        dockpulp_common.LOGGED_IN["qa"] = True
         mock_ec.return_value = (0, "succeed")
         mock_update_dockpulp_repo.return_value = 0
         mock_cmp_repo.return_value = {
@@ -286,7 +410,7 @@ class TestSetupDockpulp(TestCase):
             "docker-id": "namespace-test/virt-artifacts-server-rhel8",
         }
         check_mode = False
-        result = dockpulp_repo.ensure_dockpulp_repo(self.dockpulp_repo_params, check_mode)
+        result = dockpulp_common.ensure_dockpulp_repo(self.dockpulp_repo_params, check_mode)
         expected = {
             "returncode": 0,
             "changed": True,
@@ -316,17 +440,17 @@ class TestSetupDockpulp(TestCase):
         assert result["diff"] == expected["diff"]
         assert result["stdout_lines"].sort() == expected["stdout_lines"].sort()
 
-    @patch("dockpulp_repo.create_dockpulp_repo")
-    @patch("dockpulp_repo.get_comparable_repo")
-    @patch("dockpulp_repo.execute_command")
+    @patch("ansible.module_utils.dockpulp_common.create_dockpulp_repo")
+    @patch("ansible.module_utils.dockpulp_common.get_comparable_repo")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
     def test_ensure_dockpulp_repo_new(self, mock_ec, mock_cmp_repo, mock_cdp):
         """Test ensure_dockpulp_repo when creating new repo"""
-        dockpulp_repo.LOGGED_IN["qa"] = True
+        dockpulp_common.LOGGED_IN["qa"] = True
         mock_cmp_repo.return_value = None
         mock_ec.return_value = (0, "succeed")
         mock_cdp.return_value = 0
         check_mode = False
-        result = dockpulp_repo.ensure_dockpulp_repo(self.dockpulp_repo_params, check_mode)
+        result = dockpulp_common.ensure_dockpulp_repo(self.dockpulp_repo_params, check_mode)
         expected = {
             "returncode": 0,
             "changed": True,
@@ -355,13 +479,145 @@ class TestSetupDockpulp(TestCase):
             dockpulp_repo.main()
         result = ex.value.args[0]
         assert result["changed"] is True
+        assert result["backend"] == "cli"
+
+    @patch("ansible.module_utils.dockpulp_common.get_existing_repo")
+    @patch("ansible.module_utils.dockpulp_common.subprocess.Popen")
+    def test_main_metrics(self, mock_run, mock_ger):
+        """Test dockpulp_repo module returns metrics"""
+        self.dockpulp_repo_params["metrics"] = True
+        set_module_args(self.dockpulp_repo_params)
+        mock_run.return_value.communicate.return_value = ("logged in", "")
+        mock_run.return_value.poll.return_value = 0
+        mock_ger.return_value = {
+            "description": "virt-artifacts-server contains different builds of virtctl.",
+            "title": "redhat-namespace-test-virt-artifacts-server-rhel8",
+            "docker-id": "namespace-test/virt-artifacts-server-rhel8",
+            "distribution": "ga",
+        }
+        with pytest.raises(AnsibleExitJson) as ex:
+            dockpulp_repo.main()
+        metrics = ex.value.args[0]["metrics"]
+        assert metrics["phases"]["login"]["count"] == 1
+        # The retries and the circuit breaker are opt-in
+        assert dockpulp_latency.policy("qa") == {"adaptive": False, "retries": 0, "threshold": 0}
+        assert metrics["commands"] == 1
+        assert metrics["output_bytes"] == len("logged in")
+
+    @patch("ansible.module_utils.dockpulp_common.subprocess.Popen")
+    def test_main_timeout(self, mock_run):
+        """Test dockpulp_repo module fails when dock-pulp times out"""
+        set_module_args(self.dockpulp_repo_params)
+        mock_run.return_value.communicate.side_effect = [
+            subprocess.TimeoutExpired("dock-pulp", 120),
+            ("", ""),
+        ]
+        with pytest.raises(AnsibleFailJson) as ex:
+            dockpulp_repo.main()
+        msg = ex.value.args[0]["msg"]
+        assert msg.startswith("Timed out after 120 seconds: dock-pulp -d --server qa login")
+        assert "dockpulp_Passw0rd" not in msg
+        mock_run.return_value.kill.assert_called_once_with()
+
+    @pytest.mark.usefixtures("snapshot")
+    @patch("dockpulp_repo.select_backend")
+    @patch("dockpulp_repo.AnsibleModule.warn")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
+    def test_main_inventory_file(self, mock_ec, mock_warn, mock_sb):
+        """Test dockpulp_repo check mode against an inventory snapshot, without a backend"""
+        self.dockpulp_repo_params["inventory_file"] = self.write_snapshot(60)
+        self.dockpulp_repo_params["backend"] = "rest"
+        self.dockpulp_repo_params["_ansible_check_mode"] = True
+        set_module_args(self.dockpulp_repo_params)
+        with pytest.raises(AnsibleExitJson) as ex:
+            dockpulp_repo.main()
+        result = ex.value.args[0]
+        mock_ec.assert_not_called()
+        mock_warn.assert_not_called()
+        mock_sb.assert_not_called()
+        assert result["backend"] is None
+        assert result["changed"] is True
+        assert result["stdout_lines"] == [
+            "changing description from old description to "
+            "virt-artifacts-server contains different builds of virtctl."
+        ]
+        assert result["diff"]["before"]["description"] == "old description"
+
+    @pytest.mark.usefixtures("snapshot")
+    @patch("dockpulp_repo.AnsibleModule.warn")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
+    def test_main_inventory_file_stale(self, mock_ec, mock_warn):
+        """Test dockpulp_repo warns about a stale inventory snapshot"""
+        path = self.write_snapshot(3 * 24 * 60 * 60)
+        self.dockpulp_repo_params["inventory_file"] = path
+        self.dockpulp_repo_params["_ansible_check_mode"] = True
+        set_module_args(self.dockpulp_repo_params)
+        with pytest.raises(AnsibleExitJson):
+            dockpulp_repo.main()
+        mock_ec.assert_not_called()
+        mock_warn.assert_called_once_with("The inventory snapshot %s is 72 hours old" % path)
+
+    @pytest.mark.usefixtures("snapshot")
+    def test_main_inventory_file_not_check_mode(self):
+        """Test dockpulp_repo refuses an inventory snapshot outside of check mode"""
+        self.dockpulp_repo_params["inventory_file"] = self.write_snapshot(60)
+        set_module_args(self.dockpulp_repo_params)
+        with pytest.raises(AnsibleFailJson) as ex:
+            dockpulp_repo.main()
+        assert ex.value.args[0]["msg"] == "inventory_file is only supported in check mode"
+
+    @patch("ansible.module_utils.dockpulp_common.ensure_dockpulp_repo")
+    def test_main_envs(self, mock_edr):
+        """Test dockpulp_repo ensures the repo in every env of a list"""
+
+        def ensure(params, check_mode):
+            if params["env"] == "prod":
+                raise RuntimeError("Error logging into dock-pulp: failed")
+            return {
+                "returncode": 0,
+                "changed": params["env"] == "stage",
+                "stdout_lines": [],
+                "diff": {"before_header": "ns/repo", "after_header": "ns/repo"},
+            }
+
+        mock_edr.side_effect = ensure
+        self.dockpulp_repo_params["env"] = ["qa", "stage", "qa"]
+        set_module_args(self.dockpulp_repo_params)
+        with pytest.raises(AnsibleExitJson) as ex:
+            dockpulp_repo.main()
+        result = ex.value.args[0]
+        assert sorted(call[0][0]["env"] for call in mock_edr.call_args_list) == ["qa", "stage"]
+        assert result["changed"] is True
+        assert [(env, r["changed"]) for env, r in result["envs"].items()] == [
+            ("qa", False),
+            ("stage", True),
+        ]
+        assert result["envs"]["qa"]["backend"] == "cli"
+        assert [d["before_header"] for d in result["diff"]] == ["qa: ns/repo", "stage: ns/repo"]
+
+        self.dockpulp_repo_params["env"] = ["qa", "prod"]
+        set_module_args(self.dockpulp_repo_params)
+        with pytest.raises(AnsibleFailJson) as ex:
+            dockpulp_repo.main()
+        result = ex.value.args[0]
+        assert result["msg"] == "Error ensuring the repo in: prod"
+        assert result["envs"]["prod"]["msg"] == "Error logging into dock-pulp: failed"
+
+    def test_main_library_missing(self):
+        """Test dockpulp_repo module when the library backend isn't installed"""
+        self.dockpulp_repo_params["backend"] = "library"
+        set_module_args(self.dockpulp_repo_params)
+        with pytest.raises(AnsibleFailJson) as ex:
+            dockpulp_repo.main()
+        result = ex.value.args[0]
+        assert "dockpulp" in result["msg"]
 
-    @patch("dockpulp_repo.execute_command")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
     def test_main_fail(self, mock_ec):
         """Test dockpulp_repo module when it fails"""
         mock_ec.return_value = (-1, "failed")
         set_module_args(self.dockpulp_repo_params)
-        dockpulp_repo.LOGGED_IN["qa"] = False
+        dockpulp_common.LOGGED_IN["qa"] = False
         with pytest.raises(AnsibleFailJson) as ex:
             dockpulp_repo.main()
         result = ex.value.args[0]
@@ -0,0 +1,102 @@
+import os
+import time
+
+import pytest
+
+from ansible.module_utils import dockpulp_async, dockpulp_common
+from ansible.module_utils.dockpulp_metrics import METRICS
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench")
+
+PARAMS = {
+    "env": "qa",
+    "dockpulp_user": "user",
+    "dockpulp_password": "password",
+    "engine": "asyncio",
+    "session_ttl": 0,
+}
+
+
+def repo_spec(name, description="d"):
+    return {
+        "repo_name": name,
+        "namespace": "ns",
+        "content_url": "/content/redhat-ns-%s" % name,
+        "description": description,
+        "distribution": "ga",
+    }
+
+
+@pytest.fixture
+def fake_dock_pulp(tmp_path, monkeypatch):
+    """Run the fake dock-pulp CLI of the benchmarks"""
+    monkeypatch.setenv("PATH", BENCH_DIR + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_DOCK_PULP_STATE", str(tmp_path / "state.json"))
+    dockpulp_common.LOGGED_IN["qa"] = False
+    yield monkeypatch
+    dockpulp_common.LOGGED_IN["qa"] = False
+
+
+def test_execute_command():
+    """test the async execute_command returns the returncode and the output"""
+    command = ["sh", "-c", "echo out; echo err >&2; exit 3"]
+    assert dockpulp_async.run_async(dockpulp_async.execute_command(command)) == (3, "out\nerr\n")
+
+
+def test_execute_command_timeout():
+    """test the async execute_command kills the command after its timeout, and counts it"""
+    METRICS.enable()
+    try:
+        with pytest.raises(RuntimeError, match="Timed out after 0.1 seconds: sleep 10"):
+            dockpulp_async.run_async(dockpulp_async.execute_command(["sleep", "10"], 0.1))
+        assert METRICS.as_dict()["commands"] == 1
+    finally:
+        METRICS.enabled = False
+
+
+def test_ensure_dockpulp_repos(fake_dock_pulp):
+    """test the asyncio engine creates, then leaves, the repos"""
+    params = dict(PARAMS, repos=[repo_spec("repo1"), repo_spec("repo2")])
+    results = dockpulp_common.ensure_dockpulp_repos(params, check_mode=False)
+    assert [(r["full_repo_name"], r["changed"], r["returncode"]) for r in results] == [
+        ("redhat-ns-repo1", True, 0),
+        ("redhat-ns-repo2", True, 0),
+    ]
+
+    params["repos"] = [repo_spec("repo1", "new"), repo_spec("repo2")]
+    results = dockpulp_common.ensure_dockpulp_repos(params, check_mode=False)
+    assert [(r["changed"], r["returncode"]) for r in results] == [(True, 0), (False, 0)]
+    assert results[0]["stdout_lines"] == ["changing description from d to new"]
+
+
+def test_ensure_dockpulp_repo(fake_dock_pulp):
+    """test ensure_dockpulp_repo through the asyncio engine"""
+    params = dict(PARAMS, **repo_spec("repo1"))
+    result = dockpulp_common.ensure_dockpulp_repo(params, check_mode=False)
+    assert result == {
+        "changed": True,
+        "returncode": 0,
+        "stdout_lines": ["Created redhat-ns-repo1"],
+        "diff": result["diff"],
+    }
+
+
+def test_operations_overlap(fake_dock_pulp):
+    """test the dock-pulp commands of the asyncio engine run at the same time"""
+    fake_dock_pulp.setenv("FAKE_DOCK_PULP_LATENCY", "0.5")
+    params = dict(PARAMS, max_workers=8, repos=[repo_spec("repo%d" % i) for i in range(8)])
+    start = time.time()
+    results = dockpulp_common.ensure_dockpulp_repos(params, check_mode=False)
+    # login, 8 lists of the new repos and 8 creates take 9 seconds one after the
+    # other, the lists run in 3 rounds
+    assert time.time() - start < 5
+    assert all(r["returncode"] == 0 for r in results)
+
+
+def test_operation_timeout(fake_dock_pulp):
+    """test an operation fails after its own timeout"""
+    fake_dock_pulp.setenv("FAKE_DOCK_PULP_LATENCY", "0.5")
+    params = dict(PARAMS, timeouts={"create": 0.1, "login": None}, repos=[repo_spec("repo1")])
+    results = dockpulp_common.ensure_dockpulp_repos(params, check_mode=False)
+    assert results[0]["returncode"] == 1
+    assert results[0]["msg"] == "Timed out after 0.1 seconds"
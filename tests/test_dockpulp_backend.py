@@ -0,0 +1,136 @@
+import pytest
+from utils import MagicMock, patch
+
+from ansible.module_utils import dockpulp_backend, dockpulp_common
+
+
+class FakeDockPulpError(Exception):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def reset_backends():
+    dockpulp_common.LOGGED_IN["qa"] = False
+    yield
+    dockpulp_backend.BACKENDS.clear()
+
+
+@pytest.fixture
+def pulp():
+    """A mocked dockpulp library, selected as the backend of qa"""
+    dockpulp = MagicMock()
+    with patch.object(dockpulp_backend, "HAS_DOCKPULP", True), patch.object(
+        dockpulp_backend, "dockpulp", dockpulp, create=True
+    ), patch.object(dockpulp_backend, "DockPulpError", FakeDockPulpError, create=True):
+        assert dockpulp_backend.select_backend("qa", "auto") == "library"
+        yield dockpulp.Pulp.return_value
+
+
+def test_select_backend_auto_without_library():
+    """test auto falls back to the dock-pulp CLI"""
+    assert dockpulp_backend.select_backend("qa", "auto") == "cli"
+    assert "qa" not in dockpulp_backend.BACKENDS
+
+
+def test_select_backend_library_missing():
+    """test the library backend requires dockpulp"""
+    with pytest.raises(RuntimeError):
+        dockpulp_backend.select_backend("qa", "library")
+
+
+@patch("ansible.module_utils.dockpulp_common.execute_command")
+def test_library_login(mock_ec, pulp):
+    """test login goes through the library"""
+    result = dockpulp_common.login("qa", "dockpulp_user", "dockpulp_Passw0rd")
+    assert result == (True, "")
+    pulp.login.assert_called_once_with("dockpulp_user", "dockpulp_Passw0rd")
+    mock_ec.assert_not_called()
+
+
+def test_library_login_failed(pulp):
+    """test a failed login through the library"""
+    pulp.login.side_effect = FakeDockPulpError("bad password")
+    result = dockpulp_common.login("qa", "dockpulp_user", "dockpulp_Passw0rd")
+    assert result == (False, "bad password")
+
+
+def test_library_get_existing_repo(pulp):
+    """test get_existing_repo lists the repo through the library"""
+    dockpulp_common.LOGGED_IN["qa"] = True
+    pulp.listRepos.return_value = [{"id": "redhat-ns-repo", "distribution": "ga"}]
+    result = dockpulp_common.get_existing_repo("redhat-ns-repo", "qa", "user", "password")
+    assert result == {"id": "redhat-ns-repo", "distribution": "ga"}
+    pulp.listRepos.assert_called_once_with(repos=["redhat-ns-repo"], content=False)
+
+
+def test_library_get_existing_repo_notfound(pulp):
+    """test get_existing_repo handles a missing repo through the library"""
+    dockpulp_common.LOGGED_IN["qa"] = True
+    pulp.listRepos.side_effect = FakeDockPulpError("not found")
+    result = dockpulp_common.get_existing_repo("redhat-ns-repo", "qa", "user", "password")
+    assert result is None
+
+
+def test_library_create_repo(pulp):
+    """test create_dockpulp_repo through the library"""
+    repo = {
+        "repo_name": "repo",
+        "namespace": "ns",
+        "content_url": "/content/redhat-ns-repo",
+        "description": "d",
+        "distribution": "ga",
+    }
+    assert dockpulp_common.create_dockpulp_repo("qa", repo) == 0
+    pulp.createRepo.assert_called_once_with(
+        "ns-repo", "/content/redhat-ns-repo", desc="d", productline="ns", distribution="ga"
+    )
+
+
+def test_library_update_repo(pulp):
+    """test update_dockpulp_repo through the library"""
+    differences = [("description", "before", "after")]
+    assert dockpulp_common.update_dockpulp_repo("qa", "redhat-ns-repo", differences) == 0
+    pulp.updateRepo.assert_called_once_with("redhat-ns-repo", {"description": "after"})
+    pulp.updateRepo.side_effect = FakeDockPulpError("failed")
+    assert dockpulp_common.update_dockpulp_repo("qa", "redhat-ns-repo", differences) == 1
+
+
+def test_library_update_repo_keys(pulp):
+    """test the title and docker-id are passed to dockpulp like dock-pulp update does"""
+    differences = [
+        ("title", "before", "after"),
+        ("docker-id", "ns/before", "ns/after"),
+        ("distribution", "beta", "ga"),
+    ]
+    assert dockpulp_common.update_dockpulp_repo("qa", "redhat-ns-repo", differences) == 0
+    pulp.updateRepo.assert_called_once_with(
+        "redhat-ns-repo",
+        {"display_name": "after", "repo-registry-id": "ns/after", "distribution": "ga"},
+    )
+
+
+def test_library_get_existing_repos(pulp):
+    """test get_existing_repos lists a batch of repos with one library call"""
+    dockpulp_common.LOGGED_IN["qa"] = True
+    pulp.listRepos.return_value = [{"id": "redhat-ns-repo1"}]
+    names = ["redhat-ns-repo1", "redhat-ns-repo2"]
+    result = dockpulp_common.get_existing_repos(names, "qa", "user", "password")
+    assert result == {"redhat-ns-repo1": {"id": "redhat-ns-repo1"}, "redhat-ns-repo2": None}
+    pulp.listRepos.assert_called_once_with(repos=names, content=False)
+
+
+def test_library_iter_repos(pulp):
+    """test the library backend lists the details of the repos page by page"""
+    pulp.getAllRepoIDs.return_value = ["repo-%d" % i for i in range(5)]
+    pulp.listRepos.side_effect = lambda repos, content: [{"id": name} for name in repos]
+    repos = list(dockpulp_backend.BACKENDS["qa"].iter_repos(2))
+    assert [repo["id"] for repo in repos] == ["repo-%d" % i for i in range(5)]
+    assert [c[1]["repos"] for c in pulp.listRepos.call_args_list] == [
+        ["repo-0", "repo-1"],
+        ["repo-2", "repo-3"],
+        ["repo-4"],
+    ]
+
+    pulp.getAllRepoIDs.side_effect = FakeDockPulpError("no server")
+    with pytest.raises(RuntimeError):
+        list(dockpulp_backend.BACKENDS["qa"].iter_repos(2))
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+
+import pytest
+
+from ansible.module_utils import dockpulp_broker
+from ansible.module_utils.dockpulp_metrics import METRICS
+
+
+class FakeBackend(object):
+    """A backend of the broker, with two repos"""
+
+    name = "library"
+    logins = []
+
+    def __init__(self, env):
+        self.env = env
+        self.repos = {
+            "%s-rhceph-4" % env: {"id": "%s-rhceph-4" % env},
+            "%s-rhceph-5" % env: {"id": "%s-rhceph-5" % env},
+        }
+
+    def login(self, dockpulp_user, dockpulp_password):
+        self.logins.append((self.env, dockpulp_user))
+        return dockpulp_password == "secret", ""
+
+    def get_repo(self, full_repo_name):
+        return self.repos.get(full_repo_name)
+
+    def get_repos(self, full_repo_names):
+        return {name: self.repos[name] for name in full_repo_names if name in self.repos}
+
+    def repo_ids(self):
+        return sorted(self.repos)
+
+    def delete_repo(self, full_repo_name):
+        raise ValueError("delete is not allowed")
+
+    def list_repos(self):
+        raise ValueError("401 Unauthorized")
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    yield
+    FakeBackend.logins = []
+    METRICS.enabled = False
+
+
+@pytest.fixture
+def broker(cache_dir):
+    """A broker served by a thread of the test process"""
+    path = dockpulp_broker.broker_path()
+    thread = threading.Thread(target=dockpulp_broker.serve, args=(path, 0.5, FakeBackend))
+    thread.start()
+    deadline = time.time() + 5
+    while not dockpulp_broker.ping(path):
+        assert time.time() < deadline
+        time.sleep(0.01)
+    yield path
+    thread.join()
+
+
+def test_broker_backend(broker):
+    """test the broker backend runs the operations in the broker"""
+    METRICS.enable()
+    backend = dockpulp_broker.BrokerBackend("qa", broker)
+    assert backend.get_repo("qa-rhceph-4") == {"id": "qa-rhceph-4"}
+    assert backend.get_repo("qa-missing") is None
+    assert list(backend.iter_repos(1)) == [{"id": "qa-rhceph-4"}, {"id": "qa-rhceph-5"}]
+    with pytest.raises(RuntimeError, match="delete is not allowed"):
+        backend.delete_repo("qa-rhceph-4")
+    assert METRICS.as_dict()["broker_calls"] == 6
+
+
+def test_broker_login_once(broker):
+    """test the broker logs in once per env, user and password, for all the processes"""
+    assert dockpulp_broker.BrokerBackend("qa", broker).login("user", "secret") == (True, "")
+    assert dockpulp_broker.BrokerBackend("qa", broker).login("user", "secret") == (True, "")
+    assert dockpulp_broker.BrokerBackend("qa", broker).login("other", "wrong") == (False, "")
+    assert dockpulp_broker.BrokerBackend("stage", broker).login("user", "secret") == (True, "")
+    assert FakeBackend.logins == [("qa", "user"), ("qa", "other"), ("stage", "user")]
+
+    # Another password is checked again, and forgets the previous login
+    assert dockpulp_broker.BrokerBackend("qa", broker).login("user", "rotated") == (False, "")
+    assert dockpulp_broker.BrokerBackend("qa", broker).login("user", "secret") == (True, "")
+    assert len(FakeBackend.logins) == 5
+
+
+def test_broker_login_expiry(broker):
+    """test the broker logs in again after session_ttl, a logout or an auth error"""
+    backend = dockpulp_broker.BrokerBackend("qa", broker, session_ttl=0)
+    assert backend.login("user", "secret") == (True, "")
+    assert backend.login("user", "secret") == (True, "")
+    assert len(FakeBackend.logins) == 2
+
+    # The last login is reused while it's younger than the session_ttl
+    backend = dockpulp_broker.BrokerBackend("qa", broker)
+    backend.login("user", "secret")
+    assert len(FakeBackend.logins) == 2
+    backend.logout("user")
+    backend.login("user", "secret")
+    assert len(FakeBackend.logins) == 3
+
+    with pytest.raises(RuntimeError, match="401 Unauthorized"):
+        backend.list_repos()
+    backend.login("user", "secret")
+    assert len(FakeBackend.logins) == 4
+
+
+def test_broker_unknown_operation(broker):
+    """test the broker rejects the operations of no backend"""
+    response = dockpulp_broker.request(broker, {"op": "__init__", "env": "qa"})
+    assert response == {"ok": False, "error": "unknown operation __init__"}
+
+
+def test_broker_idle_shutdown(broker):
+    """test the broker exits and removes its socket once idle"""
+    deadline = time.time() + 5
+    while os.path.exists(broker):
+        assert time.time() < deadline
+        time.sleep(0.05)
+    assert not dockpulp_broker.ping(broker)
+
+
+def test_broker_auto_start(cache_dir):
+    """test the first broker backend starts a broker daemon, which is shared"""
+    path = dockpulp_broker.broker_path()
+    backend = dockpulp_broker.BrokerBackend("qa", idle_timeout=1, backend_factory=FakeBackend)
+    pid = dockpulp_broker.request(path, {"op": "ping"})["result"]
+    assert pid != os.getpid()
+    assert backend.get_repos(["qa-rhceph-5"]) == {"qa-rhceph-5": {"id": "qa-rhceph-5"}}
+    dockpulp_broker.BrokerBackend("qa", idle_timeout=1, backend_factory=FakeBackend)
+    assert dockpulp_broker.request(path, {"op": "ping"})["result"] == pid
+
+    # Started again after it exited
+    deadline = time.time() + 5
+    while os.path.exists(path):
+        assert time.time() < deadline
+        time.sleep(0.05)
+    assert backend.get_repo("qa-rhceph-4") == {"id": "qa-rhceph-4"}
+    assert dockpulp_broker.request(path, {"op": "ping"})["result"] != pid
@@ -0,0 +1,121 @@
+import os
+import stat
+import threading
+import time
+
+from ansible.module_utils import dockpulp_cache
+
+
+def test_get_cache_dir_private(cache_dir):
+    """test get_cache_dir creates a user-private directory"""
+    assert dockpulp_cache.get_cache_dir() == cache_dir
+    assert stat.S_IMODE(os.stat(cache_dir).st_mode) == 0o700
+
+
+def test_update_state():
+    """test update_state writes the state back"""
+    with dockpulp_cache.update_state("test") as state:
+        state["key"] = "value"
+    assert dockpulp_cache.read_state("test") == {"key": "value"}
+
+
+def test_read_state_corrupted():
+    """test read_state ignores a corrupted state file"""
+    with open(dockpulp_cache.state_path("test"), "w") as f:
+        f.write("{not json")
+    assert dockpulp_cache.read_state("test") == {}
+
+
+def test_session():
+    """test a saved session is found until invalidated"""
+    assert not dockpulp_cache.has_session("qa", "user")
+    dockpulp_cache.save_session("qa", "user")
+    assert dockpulp_cache.has_session("qa", "user")
+    assert not dockpulp_cache.has_session("qa", "other-user")
+    assert not dockpulp_cache.has_session("qa", "user", ttl=0)
+    dockpulp_cache.invalidate_session("qa")
+    assert not dockpulp_cache.has_session("qa", "user")
+
+
+def test_session_expired():
+    """test a session older than the ttl is ignored"""
+    with dockpulp_cache.update_state(dockpulp_cache.SESSION_STATE) as state:
+        state["qa:user"] = {"logged_in_at": time.time() - 100}
+    assert not dockpulp_cache.has_session("qa", "user", ttl=60)
+    assert dockpulp_cache.has_session("qa", "user", ttl=600)
+
+
+def test_fingerprints(monkeypatch):
+    """test fingerprints are read back until older than max_age"""
+    fingerprint = dockpulp_cache.repo_fingerprint("qa", {"description": "d"})
+    assert fingerprint != dockpulp_cache.repo_fingerprint("prod", {"description": "d"})
+    assert dockpulp_cache.read_fingerprints("qa", 60) == {}
+    dockpulp_cache.write_fingerprints("qa", {"redhat-ns-repo": fingerprint})
+    assert dockpulp_cache.read_fingerprints("qa", 60) == {"redhat-ns-repo": fingerprint}
+    assert dockpulp_cache.read_fingerprints("qa", 0) == {}
+    now = time.time()
+    monkeypatch.setattr(dockpulp_cache.time, "time", lambda: now + 61)
+    assert dockpulp_cache.read_fingerprints("qa", 60) == {}
+
+
+def test_single_flight():
+    """test concurrent single_flight calls share the result of one call"""
+    calls = []
+
+    def lookup():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"id": "repo"}
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(
+                dockpulp_cache.single_flight("qa", "lookup", "repo", lookup)
+            )
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [{"id": "repo"}] * 4
+
+    # Another operation, or a forgotten result, calls again
+    dockpulp_cache.single_flight("qa", "lookup", "other", lookup)
+    dockpulp_cache.forget_flights("qa", "lookup", "repo")
+    dockpulp_cache.single_flight("qa", "lookup", "repo", lookup)
+    assert len(calls) == 3
+    dockpulp_cache.forget_flights("qa", "lookup")
+    dockpulp_cache.single_flight("qa", "lookup", "other", lookup)
+    assert len(calls) == 4
+
+
+def test_single_flight_expired(monkeypatch):
+    """test single_flight calls again once the shared result is older than the ttl"""
+    calls = []
+    dockpulp_cache.single_flight("qa", "login", "user", lambda: calls.append(1), ttl=2)
+    now = time.time()
+    monkeypatch.setattr(dockpulp_cache.time, "time", lambda: now + 3)
+    dockpulp_cache.single_flight("qa", "login", "user", lambda: calls.append(1), ttl=2)
+    assert len(calls) == 2
+
+
+def test_single_flight_pruned(monkeypatch):
+    """test the files of the expired single-flight calls are deleted"""
+    flights = dockpulp_cache.get_cache_dir("flights")
+    monkeypatch.setattr(dockpulp_cache, "LAST_PRUNE", [0])
+    dockpulp_cache.single_flight("qa", "lookup", "repo1", lambda: None)
+    dockpulp_cache.single_flight("qa", "lookup", "repo2", lambda: None)
+    assert len(os.listdir(flights)) == 4
+
+    for name in os.listdir(flights):
+        os.utime(os.path.join(flights, name), (time.time() - 3, time.time() - 3))
+    monkeypatch.setattr(dockpulp_cache, "LAST_PRUNE", [0])
+    dockpulp_cache.single_flight("qa", "lookup", "repo3", lambda: None)
+    assert sorted(os.listdir(flights)) == ["qa--lookup--repo3.json", "qa--lookup--repo3.json.lock"]
+
+    dockpulp_cache.forget_flights("qa", "lookup", "repo3")
+    assert os.listdir(flights) == []
@@ -1,5 +1,21 @@
+import collections
+import json
+import os
+import sys
+import time
+
+import pytest
+from utils import patch
+
+from ansible.module_utils import dockpulp_common
+from ansible.module_utils.dockpulp_cache import read_inventory, write_inventory
+from ansible.module_utils.dockpulp_common import CommandStream
 from ansible.module_utils.dockpulp_common import diff_settings
 from ansible.module_utils.dockpulp_common import describe_changes
+from ansible.module_utils.dockpulp_common import run_parallel
+from ansible.module_utils.dockpulp_metrics import METRICS
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench")
 
 
 def test_diff_settings():
@@ -23,3 +39,340 @@ def test_describe_changes():
     differences = [("description", "before_change", "after_change")]
     result = describe_changes(differences)
     assert result == ["changing description from before_change to after_change"]
+
+
+def test_validate_content_url():
+    """test the content urls are checked, numbers and nulls rejected"""
+    validate = dockpulp_common.validate_content_url
+    assert validate("repo", "/content/redhat-ns-repo/") is None
+    assert validate(8, "/content/redhat-ns-8") == "the repo_name 8 needs to be a string"
+    assert validate("repo", 8) == "the content-url of repo needs to be a string"
+    assert validate("repo", None) == "the content-url of repo needs to be a string"
+    assert validate("repo", "/content/other") == "the content-url needs to end with repo"
+
+
+def test_run_parallel():
+    """test run_parallel keeps the order of the items"""
+    items = list(range(20))
+    assert run_parallel(lambda item: item * 2, items, max_workers=8) == [i * 2 for i in items]
+    assert run_parallel(lambda item: item * 2, items) == [i * 2 for i in items]
+
+
+LISTING = """DEBUG    Starting new HTTPS connection (1): pulp.example.com
+INFO     redhat-ns-repo1
+INFO     --------------
+INFO     description = first = repo
+INFO     distribution = ga
+INFO     docker-id = ns/repo1
+INFO     redhat-ns-repo2
+INFO     --------------
+INFO     distribution = beta
+INFO     id = redhat-ns-repo2
+"""
+
+
+def fake_stream(output, returncode=0):
+    """A CommandStream of a command printing output"""
+    command = ["sh", "-c", 'printf "%s" "$0"; exit $1', output, str(returncode)]
+    return CommandStream(command)
+
+
+@pytest.fixture
+def inventory():
+    dockpulp_common.LOGGED_IN["qa"] = True
+    yield dockpulp_common.INVENTORY
+    dockpulp_common.INVENTORY.clear()
+    dockpulp_common.INVENTORY_CHANGES.clear()
+    dockpulp_common.OFFLINE.clear()
+
+
+def test_parse_repos():
+    """test parse_repos splits the repos of a listing"""
+    assert dockpulp_common.parse_repos(LISTING) == {
+        "redhat-ns-repo1": {
+            "description": "first = repo",
+            "distribution": "ga",
+            "docker-id": "ns/repo1",
+        },
+        "redhat-ns-repo2": {"distribution": "beta", "id": "redhat-ns-repo2"},
+    }
+
+
+def test_list_command():
+    """test list_command lists the details of the repos"""
+    command = ["dock-pulp", "--server", "qa", "list", "-d"]
+    assert dockpulp_common.list_command("qa", ["a"]) == command + ["a"]
+    assert dockpulp_common.list_command("qa") == command
+
+
+@patch("ansible.module_utils.dockpulp_common.execute_command")
+def test_update_dockpulp_repo_returncode(mock_ec):
+    """test update_dockpulp_repo reports the exit status of dock-pulp update"""
+    mock_ec.return_value = (1, "INFO     updating repo redhat-ns-repo\nERROR    failed")
+    assert dockpulp_common.update_dockpulp_repo("qa", "redhat-ns-repo", [("title", "a", "b")]) == 1
+    mock_ec.return_value = (0, "")
+    assert dockpulp_common.update_dockpulp_repo("qa", "redhat-ns-repo", [("title", "a", "b")]) == 0
+
+
+@patch("ansible.module_utils.dockpulp_common.CommandStream")
+def test_load_inventory(mock_stream, inventory):
+    """test load_inventory lists the server once and saves a snapshot"""
+    mock_stream.return_value = fake_stream(LISTING)
+    assert dockpulp_common.load_inventory("qa", 60)
+    mock_stream.assert_called_once_with(["dock-pulp", "--server", "qa", "list", "-d"], 120)
+    repo = dockpulp_common.get_existing_repo("redhat-ns-repo2", "qa", "user", "password")
+    assert repo == {"distribution": "beta", "id": "redhat-ns-repo2"}
+    assert dockpulp_common.get_existing_repo("redhat-ns-repo3", "qa", "user", "password") is None
+
+    # A later module process reads the snapshot
+    inventory.clear()
+    assert dockpulp_common.load_inventory("qa", 60)
+    assert mock_stream.call_count == 1
+    assert sorted(inventory["qa"]) == ["redhat-ns-repo1", "redhat-ns-repo2"]
+
+
+@patch("ansible.module_utils.dockpulp_common.CommandStream")
+def test_load_inventory_failed(mock_stream, inventory):
+    """test load_inventory falls back to looking up every repo"""
+    mock_stream.return_value = fake_stream("ERROR    failed", 1)
+    assert not dockpulp_common.load_inventory("qa", 60)
+    assert not dockpulp_common.load_inventory("qa", 0)
+    assert "qa" not in inventory
+
+
+@patch("ansible.module_utils.dockpulp_common.update_dockpulp_repo")
+@patch("ansible.module_utils.dockpulp_common.create_dockpulp_repo")
+def test_apply_dockpulp_change_refreshes_inventory(mock_cdp, mock_udr, inventory):
+    """test our own creates and updates are saved in the snapshot"""
+    write_inventory("qa", {"redhat-ns-repo1": {"id": "redhat-ns-repo1", "distribution": "ga"}})
+    assert dockpulp_common.load_inventory("qa", 60)
+    mock_cdp.return_value = 0
+    mock_udr.return_value = 0
+    repo = {"repo_name": "repo2", "namespace": "ns", "distribution": "ga", "description": "d"}
+    dockpulp_common.apply_dockpulp_change("qa", ("create", repo))
+    dockpulp_common.apply_dockpulp_change(
+        "qa", ("update", "redhat-ns-repo1", [("distribution", "ga", "beta")])
+    )
+    dockpulp_common.save_inventory("qa")
+
+    repos = read_inventory("qa", 60)
+    assert repos["redhat-ns-repo1"] == {"id": "redhat-ns-repo1", "distribution": "beta"}
+    assert repos["redhat-ns-repo2"]["docker-id"] == "ns/repo2"
+
+
+def test_parse_output_first_repo():
+    """test parse_output doesn't mix the keys of a second repo"""
+    assert dockpulp_common.parse_output(LISTING) == {
+        "description": "first = repo",
+        "distribution": "ga",
+        "docker-id": "ns/repo1",
+    }
+
+
+@patch("ansible.module_utils.dockpulp_common.execute_command")
+def test_get_existing_repos(mock_ec, inventory):
+    """test get_existing_repos lists a batch of repos per dock-pulp call"""
+    mock_ec.side_effect = [
+        (0, LISTING),
+        (0, "INFO     redhat-ns-repo3\nINFO     distribution = ga\n"),
+    ]
+    names = ["redhat-ns-repo1", "redhat-ns-repo2", "redhat-ns-repo3"]
+    repos = dockpulp_common.get_existing_repos(names, "qa", "user", "password", batch_size=2)
+    assert sorted(repos) == names
+    assert repos["redhat-ns-repo3"] == {"distribution": "ga"}
+    assert mock_ec.call_count == 2
+    assert mock_ec.call_args_list[0][0][0][-2:] == names[:2]
+
+
+@patch("ansible.module_utils.dockpulp_common.execute_command")
+def test_get_existing_repos_missing(mock_ec, inventory):
+    """test get_existing_repos looks up a failed batch one repo at a time"""
+    mock_ec.side_effect = [
+        (1, "repo not found"),
+        (0, "INFO     redhat-ns-repo1\nINFO     distribution = ga\n"),
+        (1, "repo not found"),
+    ]
+    names = ["redhat-ns-repo1", "redhat-ns-repo2"]
+    METRICS.enable()
+    try:
+        repos = dockpulp_common.get_existing_repos(names, "qa", "user", "password")
+        phases = METRICS.as_dict()["phases"]
+    finally:
+        METRICS.enabled = False
+    assert repos == {"redhat-ns-repo1": {"distribution": "ga"}, "redhat-ns-repo2": None}
+    # The lookups are part of the get_existing_repos phase only
+    assert phases["get_existing_repos"]["count"] == 1
+    assert "get_existing_repo" not in phases
+
+
+@patch("ansible.module_utils.dockpulp_common.execute_command")
+def test_get_existing_repos_drops_missing(mock_ec, inventory):
+    """test the missing repos named by dock-pulp are dropped from their batch"""
+    mock_ec.side_effect = [
+        (1, "ERROR    repo redhat-ns-repo2 not found\n"),
+        (1, "ERROR    repo redhat-ns-repo4 not found\n"),
+        (0, "INFO     redhat-ns-repo1\nINFO     distribution = ga\nINFO     redhat-ns-repo3\n"),
+    ]
+    names = ["redhat-ns-repo1", "redhat-ns-repo2", "redhat-ns-repo4", "redhat-ns-repo3"]
+    repos = dockpulp_common.get_existing_repos(names, "qa", "user", "password")
+    assert repos["redhat-ns-repo2"] is None
+    assert repos["redhat-ns-repo4"] is None
+    assert repos["redhat-ns-repo1"] == {"distribution": "ga"}
+    assert mock_ec.call_count == 3
+    assert mock_ec.call_args_list[2][0][0][-2:] == ["redhat-ns-repo1", "redhat-ns-repo3"]
+
+
+def test_get_existing_repos_new(inventory, tmp_path, monkeypatch):
+    """test looking up new repos takes one dock-pulp list per repo, without lookups"""
+    monkeypatch.setenv("PATH", BENCH_DIR + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_DOCK_PULP_STATE", str(tmp_path / "state.json"))
+    names = ["redhat-ns-repo%d" % i for i in range(10)]
+    execute_command = dockpulp_common.execute_command
+    with patch.object(dockpulp_common, "execute_command", wraps=execute_command) as mock_ec:
+        repos = dockpulp_common.get_existing_repos(names, "qa", "user", "password", batch_size=5)
+    assert repos == dict.fromkeys(names)
+    assert mock_ec.call_count == 10
+
+
+@patch("ansible.module_utils.dockpulp_common.ensure_dockpulp_repo")
+def test_ensure_dockpulp_repo_envs_error(mock_edr):
+    """test an env failing with any exception keeps the results of the others"""
+
+    def ensure(params, check_mode):
+        if params["env"] == "prod":
+            raise OSError("dock-pulp not found")
+        return {"returncode": 0, "changed": False, "stdout_lines": []}
+
+    mock_edr.side_effect = ensure
+    results = dockpulp_common.ensure_dockpulp_repo_envs({}, ["qa", "prod"], True)
+    assert results["qa"]["returncode"] == 0
+    assert results["prod"]["returncode"] == 1
+    assert results["prod"]["msg"] == "dock-pulp not found"
+
+
+def test_command_stream():
+    """test CommandStream yields the lines and keeps the end of the output"""
+    command = [sys.executable, "-c", "import sys\nfor i in range(1000): print(i)\nsys.exit(3)"]
+    stream = dockpulp_common.CommandStream(command, max_kept=10)
+    lines = list(stream)
+    assert len(lines) == 1000
+    assert lines[0] == "0\n"
+    assert stream.returncode == 3
+    assert stream.output == "998\n999\n"
+
+
+def test_command_stream_timeout():
+    """test CommandStream kills a command running for too long"""
+    command = [sys.executable, "-c", "import time; print('started', flush=True); time.sleep(30)"]
+    stream = dockpulp_common.CommandStream(command, timeout=0.5)
+    with pytest.raises(dockpulp_common.CommandTimeout) as ex:
+        list(stream)
+    assert ex.value.output == "started\n"
+
+
+@patch("ansible.module_utils.dockpulp_common.CommandStream")
+def test_list_all_repos_streams(mock_stream, inventory):
+    """test list_all_repos parses the listing while it's read"""
+    mock_stream.return_value = fake_stream(LISTING)
+    repos = dockpulp_common.list_all_repos("qa")
+    assert sorted(repos) == ["redhat-ns-repo1", "redhat-ns-repo2"]
+    mock_stream.assert_called_once_with(["dock-pulp", "--server", "qa", "list", "-d"], 120)
+
+
+def reconcile_repo(namespace, name, description="d"):
+    return {
+        "repo_name": name,
+        "namespace": namespace,
+        "content_url": "/content/redhat-%s-%s" % (namespace, name),
+        "description": description,
+        "distribution": "ga",
+    }
+
+
+def live_repo(namespace, name, description="d"):
+    full_repo_name = "redhat-%s-%s" % (namespace, name)
+    return {
+        "id": full_repo_name,
+        "title": full_repo_name,
+        "docker-id": "%s/%s" % (namespace, name),
+        "description": description,
+        "distribution": "ga",
+    }
+
+
+def test_plan_reconcile():
+    """test plan_reconcile matches the repos by docker-id"""
+    repos = [reconcile_repo("ns", "same"), reconcile_repo("ns", "new"), reconcile_repo("ns", "up")]
+    live_repos = {
+        "redhat-ns-same": live_repo("ns", "same"),
+        # Named otherwise, but the same docker-id
+        "legacy-up": dict(live_repo("ns", "up", "old"), title="redhat-ns-up"),
+        "redhat-ns-gone": live_repo("ns", "gone"),
+        "redhat-other-repo": live_repo("other", "repo"),
+    }
+    results, changes = dockpulp_common.plan_reconcile(repos, live_repos, check_mode=False)
+    assert [(r["full_repo_name"], r["changed"]) for r in results] == [
+        ("redhat-ns-same", False),
+        ("redhat-ns-new", True),
+        ("legacy-up", True),
+    ]
+    assert [change for _, change in changes][1] == (
+        "update",
+        "legacy-up",
+        [("description", "old", "d")],
+    )
+
+    results, changes = dockpulp_common.plan_reconcile(repos, live_repos, prune=True)
+    assert [r["full_repo_name"] for r in results][3:] == ["redhat-ns-gone"]
+    assert changes == []
+
+
+def test_plan_reconcile_many():
+    """test plan_reconcile diffs 20000 repos in well under a second"""
+    count = 20000
+    repos = [reconcile_repo("ns", "repo%05d" % i) for i in range(count)]
+    live_repos = {}
+    for i in range(0, count, 2):
+        repo = live_repo("ns", "repo%05d" % i, "old" if i % 4 else "d")
+        live_repos[repo["id"]] = repo
+    start = time.time()
+    results, changes = dockpulp_common.plan_reconcile(repos, live_repos, True, False)
+    assert time.time() - start < 1
+    assert len(results) == count
+    assert collections.Counter(change[0] for _, change in changes) == {
+        "create": count // 2,
+        "update": count // 4,
+    }
+
+
+def test_load_manifest(tmp_path):
+    """test load_manifest reads a list of repos from YAML, or under "repos" from JSON"""
+    path = tmp_path / "manifest.yaml"
+    path.write_text("- repo_name: repo\n  namespace: ns\n")
+    assert dockpulp_common.load_manifest(str(path)) == [{"repo_name": "repo", "namespace": "ns"}]
+    path = tmp_path / "manifest.json"
+    path.write_text('{"repos": [{"repo_name": "repo"}]}')
+    assert dockpulp_common.load_manifest(str(path)) == [{"repo_name": "repo"}]
+    path.write_text('{"repos": {"repo_name": "repo"}}')
+    with pytest.raises(ValueError):
+        dockpulp_common.load_manifest(str(path))
+
+
+def test_load_offline_inventory(inventory, tmp_path, monkeypatch):
+    """test load_offline_inventory looks up repos in a snapshot without the server"""
+    path = tmp_path / "snapshot.json"
+    path.write_text(json.dumps({"repos": {"redhat-ns-repo1": {"docker-id": "ns/repo1"}}}))
+    dockpulp_common.LOGGED_IN.clear()
+    monkeypatch.setattr(dockpulp_common, "execute_command", None)
+
+    warning = dockpulp_common.load_offline_inventory("qa", str(path))
+    assert warning == "The age of the inventory snapshot %s is unknown" % path
+    assert dockpulp_common.login("qa", "user", "password") == (True, "")
+    assert dockpulp_common.get_existing_repo("redhat-ns-repo1", "qa", "u", "p") == {
+        "docker-id": "ns/repo1"
+    }
+    assert dockpulp_common.get_existing_repo("redhat-ns-repo2", "qa", "u", "p") is None
+
+    path.write_text(json.dumps([]))
+    with pytest.raises(ValueError):
+        dockpulp_common.load_offline_inventory("qa", str(path))
@@ -0,0 +1,232 @@
+import os
+import sys
+
+import pytest
+from utils import AnsibleExitJson, exit_json, fail_json, set_module_args
+
+from ansible.module_utils import dockpulp_backend, dockpulp_common, dockpulp_http
+from ansible.module_utils.dockpulp_metrics import METRICS
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench"))
+
+import dockpulp_repos  # noqa E402
+from fake_pulp_server import FakePulpServer  # noqa E402
+
+REPO = {
+    "repo_name": "repo",
+    "namespace": "ns",
+    "content_url": "/content/redhat-ns-repo",
+    "description": "d",
+    "distribution": "ga",
+}
+
+
+@pytest.fixture(autouse=True)
+def reset_sessions():
+    yield
+    dockpulp_http.SESSIONS.clear()
+    dockpulp_backend.BACKENDS.clear()
+    dockpulp_common.LOGGED_IN["qa"] = False
+
+
+@pytest.fixture
+def server():
+    with FakePulpServer(repos=3) as server:
+        yield server
+
+
+def test_rest_backend(server):
+    """test the rest backend runs every operation over one kept-alive connection"""
+    backend = dockpulp_http.RestBackend("qa", server.url)
+    assert backend.login("user", "password") == (True, "")
+    assert backend.create_repo(REPO) == 0
+    assert backend.create_repo(REPO) == 1
+    repo = {
+        "id": "redhat-ns-repo",
+        "title": "redhat-ns-repo",
+        "description": "d",
+        "distribution": "ga",
+        "docker-id": "ns/repo",
+        "redirect": "/content/redhat-ns-repo",
+        "protected": None,
+    }
+    assert backend.get_repo("redhat-ns-repo") == repo
+    assert backend.get_repo("missing") is None
+    assert backend.get_repos(["redhat-ns-repo", "missing"]) == {"redhat-ns-repo": repo}
+    differences = [("description", "d", "new"), ("docker-id", "ns/repo", "ns/other")]
+    assert backend.update_repo("redhat-ns-repo", differences) == 0
+    assert backend.get_repo("redhat-ns-repo")["docker-id"] == "ns/other"
+    assert len(backend.repo_ids()) == 4
+    assert [r["id"] for r in backend.iter_repos(3)] == sorted(backend.list_repos())
+    assert backend.delete_repo("redhat-ns-repo") == 0
+    assert backend.delete_repo("redhat-ns-repo") == 1
+    assert server.stats["connections"] == 1
+
+
+def test_rest_backend_without_keepalive(server):
+    """test every call opens a new connection without keepalive"""
+    backend = dockpulp_http.RestBackend("qa", server.url, keepalive=False)
+    backend.login("user", "password")
+    backend.get_repo("redhat-seed-repo-000001")
+    backend.get_repo("redhat-seed-repo-000002")
+    assert server.stats["connections"] == 3
+
+
+def test_rest_backend_shares_sessions(server):
+    """test the environments of the same server share a session"""
+    qa = dockpulp_http.RestBackend("qa", server.url)
+    stage = dockpulp_http.RestBackend("stage", server.url + "/")
+    assert qa.session is stage.session
+    qa.login("user", "password")
+    stage.login("other", "password")
+    assert server.stats["connections"] == 1
+
+
+def test_rest_login_failed():
+    """test a wrong password fails the login"""
+    with FakePulpServer(users={"user": "password"}) as server:
+        backend = dockpulp_http.RestBackend("qa", server.url)
+        assert backend.login("user", "wrong") == (False, "401 unauthorized")
+        assert backend.get_repos(["redhat-seed-repo-000001"]) is None
+
+
+def test_rest_unreachable():
+    """test the errors of the connection are raised as RuntimeError"""
+    backend = dockpulp_http.RestBackend("qa", "http://127.0.0.1:1", timeout=1)
+    with pytest.raises(RuntimeError, match="Error calling http://127.0.0.1:1"):
+        backend.login("user", "password")
+
+
+def test_read_dockpulp_conf(tmp_path):
+    """test the URL and verify flag of an env are read from dockpulp.conf"""
+    conf = tmp_path / "dockpulp.conf"
+    conf.write_text(
+        u"[pulps]\nqa = https://pulp.qa\nstage = https://pulp.stage\n[verify]\nqa = no\n"
+    )
+    assert dockpulp_http.read_dockpulp_conf("qa", str(conf)) == ("https://pulp.qa", False)
+    assert dockpulp_http.read_dockpulp_conf("stage", str(conf)) == ("https://pulp.stage", True)
+    with pytest.raises(RuntimeError, match="No Pulp server for prod"):
+        dockpulp_http.read_dockpulp_conf("prod", str(conf))
+
+
+def test_read_dockpulp_distributors(tmp_path):
+    """test the distributors of an env are read from the dockpulp configurations"""
+    conf = tmp_path / "dockpulp.conf"
+    conf.write_text(u"[distributors]\nqa = export, web\nstage = missing\n")
+    distributors_conf = tmp_path / "dockpulpdistributors.json"
+    distributors_conf.write_text(
+        u'{"export": {"distributor_type_id": "docker_distributor_export"},'
+        u' "web": {"distributor_type_id": "docker_distributor_web",'
+        u' "distributor_id": "docker_web_distributor_name_cli", "auto_publish": true}}'
+    )
+    paths = (str(conf), str(distributors_conf))
+    distributors = dockpulp_http.read_dockpulp_distributors("qa", *paths)
+    assert distributors == [
+        {"distributor_type_id": "docker_distributor_export", "distributor_id": "export"},
+        {
+            "distributor_type_id": "docker_distributor_web",
+            "distributor_id": "docker_web_distributor_name_cli",
+            "auto_publish": True,
+        },
+    ]
+    assert dockpulp_http.read_dockpulp_distributors("prod", *paths) is None
+    with pytest.raises(RuntimeError, match="No distributor missing"):
+        dockpulp_http.read_dockpulp_distributors("stage", *paths)
+
+    # Only the web distributor gets the registry id and redirect url of the repo
+    web = dockpulp_http.repo_distributors(REPO, distributors)[1]
+    assert web["distributor_config"] == {
+        "repo-registry-id": "ns/repo",
+        "redirect-url": "/content/redhat-ns-repo",
+    }
+    assert "distributor_config" not in distributors[1]
+    assert dockpulp_http.repo_distributors(REPO)[0]["distributor_id"] == (
+        dockpulp_http.DISTRIBUTOR_ID
+    )
+
+
+def test_rest_backend_distributors(server):
+    """test the config of a repo is read from its web distributor, among the others"""
+    backend = dockpulp_http.RestBackend("qa", server.url)
+    backend.distributors = [
+        {
+            "distributor_type_id": "docker_distributor_export",
+            "distributor_id": "export",
+            "distributor_config": {"protected": True},
+        },
+        {"distributor_type_id": "docker_distributor_web", "distributor_id": "web"},
+        {
+            "distributor_type_id": "docker_distributor_web",
+            "distributor_id": dockpulp_http.DISTRIBUTOR_ID,
+            "distributor_config": {"protected": False},
+        },
+    ]
+    backend.login("user", "password")
+    assert backend.create_repo(REPO) == 0
+    repo = backend.get_repo("redhat-ns-repo")
+    assert (repo["docker-id"], repo["redirect"], repo["protected"]) == (
+        "ns/repo",
+        "/content/redhat-ns-repo",
+        False,
+    )
+
+
+def test_main_rest(server, monkeypatch):
+    """test dockpulp_repos creates the repos with the rest backend, then finds them"""
+    monkeypatch.setattr(dockpulp_repos.AnsibleModule, "exit_json", exit_json)
+    monkeypatch.setattr(dockpulp_repos.AnsibleModule, "fail_json", fail_json)
+    repos = [
+        dict(REPO, repo_name="repo-%d" % i, content_url="/content/redhat-ns-repo-%d" % i)
+        for i in range(3)
+    ]
+    args = {
+        "env": "qa",
+        "dockpulp_user": "user",
+        "dockpulp_password": "password",
+        "backend": "rest",
+        "http": {"url": server.url, "pool_size": 2},
+        "max_workers": 2,
+        "repos": repos,
+    }
+    for changed in (True, False):
+        dockpulp_backend.BACKENDS.clear()
+        dockpulp_common.LOGGED_IN["qa"] = False
+        set_module_args(dict(args, session_ttl=0))
+        with pytest.raises(AnsibleExitJson) as result:
+            dockpulp_repos.main()
+        assert result.value.args[0]["changed"] is changed
+        assert result.value.args[0]["backend"] == "rest"
+    assert len(server.state.repos) == 6
+    # The pool of the session outlives the backends of the module runs
+    assert server.stats["connections"] <= 2
+
+
+def test_wait_tasks():
+    """test the tasks of the updates are collected, then polled together with backoff"""
+    METRICS.enable()
+    with FakePulpServer(repos=3, task_duration=0.3) as server:
+        backend = dockpulp_http.RestBackend("qa", server.url)
+        backend.login("user", "password")
+        for i in range(3):
+            differences = [("description", "seeded repo", "new")]
+            assert backend.update_repo("redhat-seed-repo-%06d" % i, differences) == 0
+        tasks = backend.pop_tasks()
+        assert sorted(tasks) == ["redhat-seed-repo-%06d" % i for i in range(3)]
+        assert backend.pop_tasks() == {}
+        task_ids = [task_id for ids in tasks.values() for task_id in ids]
+        states = backend.wait_tasks(task_ids + ["task-missing"])
+    assert [states[task_id]["state"] for task_id in task_ids] == ["finished"] * 3
+    assert states["task-missing"]["state"] == "missing"
+    # 0.1 + 0.2 seconds, then finished
+    assert METRICS.as_dict()["task_polls"] == 3
+    METRICS.enabled = False
+
+
+def test_wait_tasks_timeout():
+    """test the tasks still running at the timeout are reported as running"""
+    with FakePulpServer(repos=1, task_duration=60) as server:
+        backend = dockpulp_http.RestBackend("qa", server.url)
+        backend.login("user", "password")
+        backend.delete_repo("redhat-seed-repo-000000")
+        (task_ids,) = backend.pop_tasks().values()
+        assert backend.wait_tasks(task_ids, timeout=0.2)[task_ids[0]]["state"] == "running"
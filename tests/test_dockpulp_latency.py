@@ -0,0 +1,152 @@
+import sys
+
+import pytest
+from utils import patch
+
+from ansible.module_utils import dockpulp_common, dockpulp_latency
+from ansible.module_utils.dockpulp_metrics import METRICS
+
+
+@pytest.fixture(autouse=True)
+def policies():
+    yield dockpulp_latency.POLICIES
+    dockpulp_latency.POLICIES.clear()
+    METRICS.enabled = False
+
+
+@pytest.fixture
+def clock():
+    """A fake clock, frozen unless moved"""
+    now = [1000.0]
+    with patch.object(dockpulp_latency.time, "time", lambda: now[0]):
+        yield now
+
+
+def test_command_operation():
+    """test the lists of some repos are lookups, apart from the listings"""
+    operation = dockpulp_latency.command_operation
+    assert operation(["dock-pulp", "--server", "qa", "list", "-d", "redhat-a"]) == "lookup"
+    assert operation(["dock-pulp", "--server", "qa", "list", "-d"]) == "list"
+    assert operation(["dock-pulp", "-d", "--server", "qa", "login", "-u", "u"]) == "login"
+    assert operation(["sh", "-c", "true"]) is None
+
+
+def test_timeout_for():
+    """test the timeouts follow the p99 latency once there are enough samples"""
+    assert dockpulp_latency.timeout_for("qa", "lookup", 120) == 120
+    dockpulp_latency.configure_latency("qa", adaptive=True)
+    for _ in range(5):
+        dockpulp_latency.record_latency("qa", "lookup", 1.5)
+    assert dockpulp_latency.timeout_for("qa", "lookup", 120) == 120
+
+    for _ in range(dockpulp_latency.MIN_SAMPLES):
+        dockpulp_latency.record_latency("qa", "lookup", 1.5)
+    assert dockpulp_latency.latency_percentile("qa", "lookup") == 2
+    # 3 x 2 seconds, raised to the minimum
+    assert dockpulp_latency.timeout_for("qa", "lookup", 120) == 10
+    assert dockpulp_latency.timeout_for("qa", "create", 120) == 120
+
+    for _ in range(10):
+        dockpulp_latency.record_latency("qa", "lookup", 20)
+    assert dockpulp_latency.timeout_for("qa", "lookup", 120) == 90
+    assert dockpulp_latency.timeout_for("qa", "lookup", 60) == 60
+
+
+def test_latency_decay():
+    """test the histogram forgets the old samples"""
+    dockpulp_latency.configure_latency("qa", adaptive=True)
+    for _ in range(50):
+        dockpulp_latency.record_latency("qa", "lookup", 50)
+    assert dockpulp_latency.latency_percentile("qa", "lookup") == 60
+    for _ in range(1000):
+        dockpulp_latency.record_latency("qa", "lookup", 0.2)
+    assert dockpulp_latency.latency_percentile("qa", "lookup") == 0.25
+
+
+def test_backoff():
+    """test the backoff is jittered, doubled at every attempt, up to the maximum"""
+    for attempt in range(8):
+        bound = min(dockpulp_latency.BACKOFF_MAX, dockpulp_latency.BACKOFF_BASE * 2 ** attempt)
+        waits = [dockpulp_latency.backoff(attempt) for _ in range(100)]
+        assert all(0 <= wait <= bound for wait in waits)
+        assert len(set(waits)) > 1
+
+
+def test_circuit_breaker(clock):
+    """test the circuit opens after consecutive failures, for the cooldown"""
+    METRICS.enable()
+    dockpulp_latency.configure_latency("qa", threshold=2)
+    dockpulp_latency.record_outcome("qa", False)
+    dockpulp_latency.record_outcome("qa", True)
+    dockpulp_latency.record_outcome("qa", False)
+    dockpulp_latency.check_circuit("qa")
+    dockpulp_latency.record_outcome("qa", False)
+    with pytest.raises(RuntimeError, match="The circuit of qa is open after 2 consecutive"):
+        dockpulp_latency.check_circuit("qa")
+    assert METRICS.as_dict()["circuit_rejections"] == 1
+    dockpulp_latency.check_circuit("stage")
+
+    # One call goes through after the cooldown, and opens the circuit again on failure
+    clock[0] += dockpulp_latency.CIRCUIT_COOLDOWN
+    dockpulp_latency.check_circuit("qa")
+    dockpulp_latency.record_outcome("qa", False)
+    with pytest.raises(RuntimeError):
+        dockpulp_latency.check_circuit("qa")
+    clock[0] += dockpulp_latency.CIRCUIT_COOLDOWN
+    dockpulp_latency.record_outcome("qa", True)
+    dockpulp_latency.record_outcome("qa", False)
+    dockpulp_latency.check_circuit("qa")
+
+
+@patch("ansible.module_utils.dockpulp_common.time.sleep")
+@patch("ansible.module_utils.dockpulp_common.execute_command")
+def test_read_command_retries(mock_ec, mock_sleep):
+    """test the reads are retried on transient errors and timeouts only"""
+    METRICS.enable()
+    command = ["dock-pulp", "--server", "qa", "list", "-d", "redhat-a"]
+    mock_ec.side_effect = [
+        (1, "Error: 503 Service Unavailable"),
+        dockpulp_latency.CommandTimeout(command, 10),
+        (0, "{}"),
+    ]
+    dockpulp_common.read_command(command)
+    assert mock_ec.call_count == 1
+
+    dockpulp_latency.configure_latency("qa", retries=2)
+    mock_ec.side_effect = [
+        (1, "Error: 503 Service Unavailable"),
+        dockpulp_latency.CommandTimeout(command, 10),
+        (0, "{}"),
+    ]
+    assert dockpulp_common.read_command(command) == (0, "{}")
+    assert mock_sleep.call_count == 2
+    assert METRICS.as_dict()["read_retries"] == 2
+
+    mock_ec.side_effect = [(1, "repo not found")]
+    assert dockpulp_common.read_command(command) == (1, "repo not found")
+    mock_ec.side_effect = [dockpulp_latency.CommandTimeout(command, 10)] * 3
+    with pytest.raises(RuntimeError, match="Timed out after 10 seconds: dock-pulp --server qa"):
+        dockpulp_common.read_command(command)
+
+
+def test_execute_command_timeout():
+    """test a hung command is killed at its timeout, and counts as a failure"""
+    METRICS.enable()
+    dockpulp_latency.configure_latency("qa", adaptive=True, threshold=1)
+    command = [sys.executable, "-c", "import time; time.sleep(30)", "--server", "qa", "list"]
+    with pytest.raises(dockpulp_latency.CommandTimeout, match="Timed out after 0.5 seconds"):
+        dockpulp_common.execute_command(command, timeout=0.5)
+    assert METRICS.as_dict()["commands"] == 1
+    counts = dockpulp_latency.read_state("latency-qa")["list"]["counts"]
+    assert counts[dockpulp_latency.LATENCY_BUCKETS.index(1)] == 1
+    with pytest.raises(RuntimeError, match="The circuit of qa is open"):
+        dockpulp_common.execute_command(command, timeout=0.5)
+
+
+def test_hide_password():
+    """test the password of a login is hidden from the timeout errors"""
+    command = ["dock-pulp", "-d", "--server", "qa", "login", "-u", "user", "-p", "secret"]
+    error = dockpulp_latency.CommandTimeout(command, 10)
+    assert str(error) == (
+        "Timed out after 10 seconds: dock-pulp -d --server qa login -u user -p ********"
+    )
@@ -0,0 +1,36 @@
+from ansible.module_utils.dockpulp_metrics import Metrics, METRICS, timed
+
+
+def test_metrics_disabled():
+    """test nothing is recorded until the metrics are enabled"""
+    metrics = Metrics()
+    with metrics.timer("login"):
+        metrics.count("commands")
+    assert metrics.as_dict() == {"phases": {}}
+
+
+def test_metrics():
+    """test the phases and counters of the metrics"""
+    metrics = Metrics()
+    metrics.enable()
+    for _ in range(2):
+        with metrics.timer("login"):
+            metrics.count("commands")
+    metrics.count("output_bytes", 10)
+    result = metrics.as_dict()
+    assert result["phases"]["login"]["count"] == 2
+    assert result["phases"]["login"]["seconds"] >= 0
+    assert result["commands"] == 2
+    assert result["output_bytes"] == 10
+
+
+def test_timed():
+    """test timed records the calls of a function"""
+    METRICS.enable()
+
+    @timed("phase")
+    def phase():
+        return "done"
+
+    assert phase() == "done"
+    assert METRICS.as_dict()["phases"]["phase"]["count"] == 1
@@ -0,0 +1,68 @@
+import pytest
+from utils import patch
+
+from ansible.module_utils import dockpulp_ratelimit
+from ansible.module_utils.dockpulp_metrics import METRICS
+
+
+@pytest.fixture(autouse=True)
+def limits():
+    yield dockpulp_ratelimit.LIMITS
+    dockpulp_ratelimit.LIMITS.clear()
+    METRICS.enabled = False
+
+
+@pytest.fixture
+def clock():
+    """A fake clock, frozen unless moved"""
+    now = [1000.0]
+    with patch.object(dockpulp_ratelimit.time, "time", lambda: now[0]):
+        yield now
+
+
+def test_command_env():
+    """test command_env finds the env of dock-pulp commands only"""
+    assert dockpulp_ratelimit.command_env(["dock-pulp", "-d", "--server", "qa", "list"]) == "qa"
+    assert dockpulp_ratelimit.command_env(["sh", "-c", "true"]) is None
+
+
+def test_configure_rate_limit():
+    """test the burst defaults to the rate rounded up"""
+    dockpulp_ratelimit.configure_rate_limit("qa", 2.5)
+    assert dockpulp_ratelimit.LIMITS["qa"] == (2.5, 3)
+    dockpulp_ratelimit.configure_rate_limit("qa", 0.5, 4)
+    assert dockpulp_ratelimit.LIMITS["qa"] == (0.5, 4)
+    dockpulp_ratelimit.configure_rate_limit("qa", 0)
+    assert "qa" not in dockpulp_ratelimit.LIMITS
+
+
+def test_reserve(clock):
+    """test reserve serves the burst at once, then one call every 1/rate seconds"""
+    assert dockpulp_ratelimit.reserve("qa") == 0
+    dockpulp_ratelimit.configure_rate_limit("qa", 10, 2)
+    waits = [dockpulp_ratelimit.reserve("qa") for _ in range(4)]
+    assert waits == pytest.approx([0, 0, 0.1, 0.2])
+
+    # Another process of the host shares the same bucket
+    dockpulp_ratelimit.LIMITS.clear()
+    dockpulp_ratelimit.configure_rate_limit("qa", 10, 2)
+    assert dockpulp_ratelimit.reserve("qa") == pytest.approx(0.3)
+
+    # The bucket refills up to the burst
+    clock[0] += 60
+    waits = [dockpulp_ratelimit.reserve("qa") for _ in range(3)]
+    assert waits == pytest.approx([0, 0, 0.1])
+
+
+@patch("ansible.module_utils.dockpulp_ratelimit.time.sleep")
+def test_acquire_metrics(mock_sleep, clock):
+    """test acquire sleeps over the limit, and reports the wait time"""
+    METRICS.enable()
+    dockpulp_ratelimit.configure_rate_limit("qa", 4, 1)
+    dockpulp_ratelimit.acquire("qa")
+    mock_sleep.assert_not_called()
+    dockpulp_ratelimit.acquire("qa")
+    mock_sleep.assert_called_once_with(pytest.approx(0.25))
+    metrics = METRICS.as_dict()
+    assert metrics["rate_limit_waits"] == 1
+    assert metrics["phases"]["rate_limit"]["count"] == 1
@@ -0,0 +1,100 @@
+import json
+import os
+
+import pytest
+import dockpulp_repo_info
+from ansible.module_utils import dockpulp_common
+from utils import AnsibleExitJson, AnsibleFailJson, exit_json, fail_json, set_module_args
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench")
+
+PARAMS = {
+    "env": "qa",
+    "dockpulp_user": "dockpulp_user",
+    "dockpulp_password": "dockpulp_Passw0rd",
+    "backend": "cli",
+}
+
+
+def fake_repo(namespace, name, distribution="ga"):
+    full_repo_name = "redhat-%s-%s" % (namespace, name)
+    return {
+        "id": full_repo_name,
+        "title": full_repo_name,
+        "docker-id": "%s/%s" % (namespace, name),
+        "description": "repo %s" % name,
+        "distribution": distribution,
+    }
+
+
+@pytest.fixture(autouse=True)
+def fake_dock_pulp(tmp_path, monkeypatch):
+    """Run the module against the fake dock-pulp CLI of the benchmarks"""
+    repos = [
+        fake_repo("rhceph", "rhceph-4-rhel8"),
+        fake_repo("rhceph", "rhceph-4-rhel9", "beta"),
+        fake_repo("rhceph", "rhceph-5-rhel9"),
+        fake_repo("other", "rhceph-4-rhel9"),
+    ]
+    state = tmp_path / "state.json"
+    state.write_text(json.dumps({"repos": {repo["id"]: repo for repo in repos}}))
+    monkeypatch.setenv("PATH", BENCH_DIR + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_DOCK_PULP_STATE", str(state))
+    monkeypatch.setattr(dockpulp_repo_info.AnsibleModule, "exit_json", exit_json)
+    monkeypatch.setattr(dockpulp_repo_info.AnsibleModule, "fail_json", fail_json)
+    dockpulp_common.LOGGED_IN["qa"] = False
+    yield
+    dockpulp_common.LOGGED_IN["qa"] = False
+
+
+def run_info(**params):
+    set_module_args(dict(PARAMS, **params))
+    with pytest.raises(AnsibleExitJson) as ex:
+        dockpulp_repo_info.main()
+    return ex.value.args[0]
+
+
+def test_filters():
+    """Test dockpulp_repo_info filters by namespace, distribution and name glob"""
+    result = run_info(namespace="rhceph", distribution="ga", name="rhceph-*-rhel9")
+    assert result["changed"] is False
+    assert result["next_offset"] is None
+    assert [repo["full_repo_name"] for repo in result["repos"]] == ["redhat-rhceph-rhceph-5-rhel9"]
+    repo = result["repos"][0]
+    assert (repo["namespace"], repo["repo_name"], repo["description"]) == (
+        "rhceph",
+        "rhceph-5-rhel9",
+        "repo rhceph-5-rhel9",
+    )
+
+
+def test_pages():
+    """Test dockpulp_repo_info returns the matching repos one page at a time"""
+    pages = []
+    offset = 0
+    while offset is not None:
+        result = run_info(name="rhceph-4-*", limit=2, offset=offset)
+        pages.append([repo["full_repo_name"] for repo in result["repos"]])
+        offset = result["next_offset"]
+    assert pages == [
+        ["redhat-rhceph-rhceph-4-rhel8", "redhat-rhceph-rhceph-4-rhel9"],
+        ["redhat-other-rhceph-4-rhel9"],
+    ]
+
+
+def test_names():
+    """Test dockpulp_repo_info looks up the repos of names only"""
+    result = run_info(names=["redhat-other-rhceph-4-rhel9", "redhat-rhceph-missing"])
+    assert [repo["full_repo_name"] for repo in result["repos"]] == ["redhat-other-rhceph-4-rhel9"]
+
+
+def test_listing_failed(tmp_path, monkeypatch):
+    """Test dockpulp_repo_info fails when the listing fails"""
+    state = tmp_path / "broken.json"
+    state.write_text("{}")
+    monkeypatch.setenv("FAKE_DOCK_PULP_STATE", str(state))
+    dockpulp_common.LOGGED_IN["qa"] = True
+    set_module_args(dict(PARAMS))
+    with pytest.raises(AnsibleFailJson) as ex:
+        dockpulp_repo_info.main()
+    assert ex.value.args[0]["msg"].startswith("Error listing the repos of qa")
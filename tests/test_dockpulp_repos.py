@@ -0,0 +1,337 @@
+import json
+from unittest import TestCase
+from utils import patch
+
+import pytest
+import dockpulp_repos
+from ansible.module_utils import dockpulp_common
+from utils import AnsibleExitJson, AnsibleFailJson, exit_json, fail_json, set_module_args
+
+
+class TestDockpulpRepos(TestCase):
+    def setUp(self):
+        self.repos = [
+            {
+                "repo_name": "virt-artifacts-server-rhel8",
+                "namespace": "namespace-test",
+                "distribution": "ga",
+                "description": "virt-artifacts-server contains different builds of virtctl.",
+                "content_url": "/content/redhat-namespace-test-virt-artifacts-server-rhel8",
+            },
+            {
+                "repo_name": "virt-artifacts-server-rhel9",
+                "namespace": "namespace-test",
+                "distribution": "ga",
+                "description": "virt-artifacts-server contains different builds of virtctl.",
+                "content_url": "/content/redhat-namespace-test-virt-artifacts-server-rhel9",
+            },
+        ]
+        self.params = {
+            "env": "qa",
+            "dockpulp_user": "dockpulp_user",
+            "dockpulp_password": "dockpulp_Passw0rd",
+            "repos": self.repos,
+        }
+        self.existing = {
+            "redhat-namespace-test-virt-artifacts-server-rhel8": {
+                "description": "virt-artifacts-server contains different builds of virtctl.",
+                "title": "redhat-namespace-test-virt-artifacts-server-rhel8",
+                "docker-id": "namespace-test/virt-artifacts-server-rhel8",
+                "distribution": "ga",
+            },
+        }
+        dockpulp_common.LOGGED_IN["qa"] = False
+
+    @pytest.fixture(autouse=True)
+    def fake_exits(self, monkeypatch):
+        monkeypatch.setattr(dockpulp_repos.AnsibleModule, "exit_json", exit_json)
+        monkeypatch.setattr(dockpulp_repos.AnsibleModule, "fail_json", fail_json)
+
+    def get_existing_repos(self, full_repo_names, *args, **kwargs):
+        return {name: self.existing.get(name) for name in full_repo_names}
+
+    @patch("ansible.module_utils.dockpulp_common.create_dockpulp_repo")
+    @patch("ansible.module_utils.dockpulp_common.get_existing_repos")
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
+    def test_ensure_dockpulp_repos(self, mock_ec, mock_ger, mock_cdp):
+        """Test ensure_dockpulp_repos logs in once and only creates missing repos"""
+        mock_ec.return_value = (0, "logged in")
+        mock_ger.side_effect = self.get_existing_repos
+        mock_cdp.return_value = 0
+        results = dockpulp_common.ensure_dockpulp_repos(self.params, False)
+        mock_ec.assert_called_once()
+        mock_ger.assert_called_once()
+        mock_cdp.assert_called_once()
+        self.assertEqual(
+            [(r["full_repo_name"], r["changed"]) for r in results],
+            [
+                ("redhat-namespace-test-virt-artifacts-server-rhel8", False),
+                ("redhat-namespace-test-virt-artifacts-server-rhel9", True),
+            ],
+        )
+        created = mock_cdp.call_args[0][1]
+        self.assertEqual(created["content_url"], self.repos[1]["content_url"])
+
+    @patch("ansible.module_utils.dockpulp_common.update_dockpulp_repo")
+    @patch("ansible.module_utils.dockpulp_common.create_dockpulp_repo")
+    @patch("ansible.module_utils.dockpulp_common.get_existing_repos")
+    def test_ensure_dockpulp_repos_parallel(self, mock_ger, mock_cdp, mock_udr):
+        """Test ensure_dockpulp_repos applies changes in parallel and keeps going on failure"""
+        dockpulp_common.LOGGED_IN["qa"] = True
+        self.existing["redhat-namespace-test-virt-artifacts-server-rhel8"]["distribution"] = "beta"
+        mock_ger.side_effect = self.get_existing_repos
+        mock_udr.side_effect = RuntimeError("update failed")
+        mock_cdp.return_value = 0
+        self.params["max_workers"] = 8
+        results = dockpulp_common.ensure_dockpulp_repos(self.params, False)
+        self.assertEqual([r["returncode"] for r in results], [1, 0])
+        self.assertEqual(results[0]["msg"], "update failed")
+        self.assertEqual(
+            results[1]["full_repo_name"], "redhat-namespace-test-virt-artifacts-server-rhel9"
+        )
+
+    @patch("ansible.module_utils.dockpulp_common.create_dockpulp_repo")
+    @patch("ansible.module_utils.dockpulp_common.get_existing_repos")
+    def test_ensure_dockpulp_repos_check_mode(self, mock_ger, mock_cdp):
+        """Test ensure_dockpulp_repos doesn't apply anything in check mode"""
+        dockpulp_common.LOGGED_IN["qa"] = True
+        mock_ger.side_effect = self.get_existing_repos
+        results = dockpulp_common.ensure_dockpulp_repos(self.params, True)
+        self.assertEqual([r["changed"] for r in results], [False, True])
+        mock_cdp.assert_not_called()
+
+    @patch("ansible.module_utils.dockpulp_common.get_existing_repos")
+    def test_ensure_dockpulp_repos_fingerprint(self, mock_ger):
+        """Test ensure_dockpulp_repos only looks up the repos without a fresh fingerprint"""
+        dockpulp_common.LOGGED_IN["qa"] = True
+        mock_ger.side_effect = self.get_existing_repos
+        self.params["fingerprint_max_age"] = 3600
+        results = dockpulp_common.ensure_dockpulp_repos(self.params, True)
+        self.assertEqual([r["changed"] for r in results], [False, True])
+
+        results = dockpulp_common.ensure_dockpulp_repos(self.params, True)
+        self.assertEqual(
+            mock_ger.call_args[0][0], ["redhat-namespace-test-virt-artifacts-server-rhel9"]
+        )
+        self.assertEqual(
+            [(r["full_repo_name"], r["changed"]) for r in results],
+            [
+                ("redhat-namespace-test-virt-artifacts-server-rhel8", False),
+                ("redhat-namespace-test-virt-artifacts-server-rhel9", True),
+            ],
+        )
+
+    @patch("ansible.module_utils.dockpulp_common.execute_command")
+    def test_ensure_dockpulp_repos_nologin(self, mock_ec):
+        """Test ensure_dockpulp_repos with failed login"""
+        mock_ec.return_value = (-1, "not logged in")
+        with pytest.raises(RuntimeError):
+            dockpulp_common.ensure_dockpulp_repos(self.params, True)
+
+    @patch("dockpulp_repos.ensure_dockpulp_repos")
+    def test_main_ok(self, mock_edr):
+        """Test dockpulp_repos module when it succeeds"""
+        set_module_args(self.params)
+        mock_edr.return_value = [
+            {"returncode": 0, "changed": False, "stdout_lines": [], "full_repo_name": "a"},
+            {
+                "returncode": 0,
+                "changed": True,
+                "stdout_lines": ["Created b"],
+                "diff": {"before": {}, "after": {}},
+                "full_repo_name": "b",
+            },
+        ]
+        with pytest.raises(AnsibleExitJson) as ex:
+            dockpulp_repos.main()
+        result = ex.value.args[0]
+        assert result["changed"] is True
+        assert len(result["results"]) == 2
+        assert result["diff"] == [{"before": {}, "after": {}}]
+
+    @patch("dockpulp_repos.ensure_dockpulp_repos")
+    def test_main_repo_failed(self, mock_edr):
+        """Test dockpulp_repos module when one repo fails"""
+        set_module_args(self.params)
+        mock_edr.return_value = [
+            {"returncode": 1, "changed": True, "stdout_lines": [], "full_repo_name": "a"},
+        ]
+        with pytest.raises(AnsibleFailJson) as ex:
+            dockpulp_repos.main()
+        result = ex.value.args[0]
+        assert result["msg"] == "Error ensuring dockpulp repos: a"
+
+    def test_main_bad_content_url(self):
+        """Test dockpulp_repos module validates every content_url"""
+        self.repos[1]["content_url"] = "/wrong/virt-artifacts-server-rhel9"
+        set_module_args(self.params)
+        with pytest.raises(AnsibleFailJson) as ex:
+            dockpulp_repos.main()
+        result = ex.value.args[0]
+        assert result["msg"] == "the content-url needs to start with /content"
+
+    @pytest.fixture(autouse=True)
+    def manifest_path(self, tmp_path):
+        self.manifest = str(tmp_path / "manifest.json")
+
+    @patch("ansible.module_utils.dockpulp_common.delete_dockpulp_repo")
+    @patch("ansible.module_utils.dockpulp_common.create_dockpulp_repo")
+    @patch("ansible.module_utils.dockpulp_common.list_all_repos")
+    def test_main_manifest_prune(self, mock_lar, mock_cdp, mock_ddr):
+        """Test dockpulp_repos reconciles a manifest, pruning its namespaces only"""
+        dockpulp_common.LOGGED_IN["qa"] = True
+        with open(self.manifest, "w") as f:
+            json.dump({"repos": self.repos}, f)
+        mock_lar.return_value = dict(
+            self.existing,
+            **{
+                "redhat-namespace-test-old": {"docker-id": "namespace-test/old"},
+                "redhat-other-repo": {"docker-id": "other/repo"},
+            }
+        )
+        mock_cdp.return_value = 0
+        mock_ddr.return_value = 0
+        set_module_args(
+            {
+                "env": "qa",
+                "dockpulp_user": "dockpulp_user",
+                "dockpulp_password": "dockpulp_Passw0rd",
+                "manifest": self.manifest,
+                "prune": True,
+            }
+        )
+        with pytest.raises(AnsibleExitJson) as ex:
+            dockpulp_repos.main()
+        result = ex.value.args[0]
+        mock_lar.assert_called_once()
+        mock_cdp.assert_called_once()
+        mock_ddr.assert_called_once_with("qa", "redhat-namespace-test-old")
+        assert [(r["full_repo_name"], r["changed"]) for r in result["results"]] == [
+            ("redhat-namespace-test-virt-artifacts-server-rhel8", False),
+            ("redhat-namespace-test-virt-artifacts-server-rhel9", True),
+            ("redhat-namespace-test-old", True),
+        ]
+
+    def test_main_manifest_invalid(self):
+        """Test dockpulp_repos fails on a manifest without a list of repos"""
+        with open(self.manifest, "w") as f:
+            json.dump({"repos": "none"}, f)
+        set_module_args(
+            {
+                "env": "qa",
+                "dockpulp_user": "dockpulp_user",
+                "dockpulp_password": "dockpulp_Passw0rd",
+                "manifest": self.manifest,
+            }
+        )
+        with pytest.raises(AnsibleFailJson) as ex:
+            dockpulp_repos.main()
+        assert ex.value.args[0]["msg"].startswith("Error loading the manifest: ")
+
+    def test_main_manifest_not_strings(self):
+        """Test dockpulp_repos fails on a manifest repo with numbers, not strings"""
+        repo = dict(self.repos[0], repo_name=8, distribution=1)
+        with open(self.manifest, "w") as f:
+            json.dump([repo], f)
+        set_module_args(
+            {
+                "env": "qa",
+                "dockpulp_user": "dockpulp_user",
+                "dockpulp_password": "dockpulp_Passw0rd",
+                "manifest": self.manifest,
+            }
+        )
+        with pytest.raises(AnsibleFailJson) as ex:
+            dockpulp_repos.main()
+        assert ex.value.args[0]["msg"] == (
+            "repo_name, distribution need to be strings in repo %s" % repo
+        )
+
+    @patch("ansible.module_utils.dockpulp_common.create_dockpulp_repo")
+    @patch("ansible.module_utils.dockpulp_common.get_existing_repos")
+    def test_main_plan_apply(self, mock_ger, mock_cdp):
+        """Test dockpulp_repos applies the plan of check mode, reading only the changed repos"""
+        dockpulp_common.LOGGED_IN["qa"] = True
+        mock_ger.side_effect = self.get_existing_repos
+        mock_cdp.return_value = 0
+        plan_file = self.manifest.replace("manifest", "plan")
+        set_module_args(dict(self.params, plan_file=plan_file, _ansible_check_mode=True))
+        with pytest.raises(AnsibleExitJson) as ex:
+            dockpulp_repos.main()
+        assert ex.value.args[0]["changed"] is True
+        mock_cdp.assert_not_called()
+        with open(plan_file) as f:
+            plan = json.load(f)
+        assert [(c["action"], c["remote"]) for c in plan["changes"]] == [
+            ("noop", self.existing["redhat-namespace-test-virt-artifacts-server-rhel8"]),
+            ("create", None),
+        ]
+
+        mock_ger.reset_mock()
+        set_module_args(
+            {
+                "env": "qa",
+                "dockpulp_user": "dockpulp_user",
+                "dockpulp_password": "dockpulp_Passw0rd",
+                "plan_file": plan_file,
+            }
+        )
+        with pytest.raises(AnsibleExitJson) as ex:
+            dockpulp_repos.main()
+        result = ex.value.args[0]
+        mock_ger.assert_called_once()
+        assert mock_ger.call_args[0][0] == ["redhat-namespace-test-virt-artifacts-server-rhel9"]
+        mock_cdp.assert_called_once_with("qa", dict(self.repos[1]))
+        assert [r["changed"] for r in result["results"]] == [False, True]
+
+        # Applying the plan again finds the repo created, and changes nothing
+        self.existing["redhat-namespace-test-virt-artifacts-server-rhel9"] = {
+            "description": "virt-artifacts-server contains different builds of virtctl.",
+            "title": "redhat-namespace-test-virt-artifacts-server-rhel9",
+            "docker-id": "namespace-test/virt-artifacts-server-rhel9",
+            "distribution": "ga",
+        }
+        with pytest.raises(AnsibleExitJson) as ex:
+            dockpulp_repos.main()
+        assert ex.value.args[0]["changed"] is False
+        mock_cdp.assert_called_once()
+
+    @patch("ansible.module_utils.dockpulp_common.create_dockpulp_repo")
+    @patch("ansible.module_utils.dockpulp_common.update_dockpulp_repo")
+    @patch("ansible.module_utils.dockpulp_common.get_existing_repos")
+    @patch("dockpulp_repos.AnsibleModule.warn")
+    def test_main_plan_conflict(self, mock_warn, mock_ger, mock_udr, mock_cdp):
+        """Test dockpulp_repos doesn't apply the plan of a repo changed since,
+        the plan winning over the repos"""
+        dockpulp_common.LOGGED_IN["qa"] = True
+        mock_ger.side_effect = self.get_existing_repos
+        mock_cdp.return_value = 0
+        plan_file = self.manifest.replace("manifest", "plan")
+        self.repos[0]["description"] = "new description"
+        set_module_args(dict(self.params, plan_file=plan_file, _ansible_check_mode=True))
+        with pytest.raises(AnsibleExitJson):
+            dockpulp_repos.main()
+
+        self.existing["redhat-namespace-test-virt-artifacts-server-rhel8"]["distribution"] = "beta"
+        set_module_args(dict(self.params, plan_file=plan_file))
+        with pytest.raises(AnsibleFailJson) as ex:
+            dockpulp_repos.main()
+        result = ex.value.args[0]
+        mock_warn.assert_called_once_with(
+            "repos and manifest are not used when applying the plan_file"
+        )
+        mock_udr.assert_not_called()
+        mock_cdp.assert_called_once()
+        assert result["results"][0]["msg"] == (
+            "redhat-namespace-test-virt-artifacts-server-rhel8 changed on the server "
+            "since the plan was made"
+        )
+
+    def test_main_plan_missing(self):
+        """Test dockpulp_repos reports a plan_file it can't read"""
+        dockpulp_common.LOGGED_IN["qa"] = True
+        plan_file = self.manifest.replace("manifest", "missing-plan")
+        set_module_args(dict(self.params, plan_file=plan_file))
+        with pytest.raises(AnsibleFailJson) as ex:
+            dockpulp_repos.main()
+        assert ex.value.args[0]["msg"].startswith("Error with the plan_file: ")
@@ -0,0 +1,102 @@
+import os
+import sys
+
+import pytest
+import dockpulp_repos
+import dockpulp_task_info
+from ansible.module_utils import dockpulp_backend, dockpulp_common, dockpulp_http
+from utils import AnsibleExitJson, AnsibleFailJson, exit_json, fail_json, set_module_args
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench"))
+
+from fake_pulp_server import FakePulpServer  # noqa E402
+
+PARAMS = {
+    "env": "qa",
+    "dockpulp_user": "user",
+    "dockpulp_password": "password",
+}
+
+REPOS = [
+    {
+        "repo_name": "repo-%06d" % i,
+        "namespace": "seed",
+        "content_url": "/content/redhat-seed-repo-%06d" % i,
+        "description": "updated repo",
+        "distribution": "ga",
+    }
+    for i in range(3)
+]
+
+
+@pytest.fixture(autouse=True)
+def fake_exits(monkeypatch):
+    for module in (dockpulp_repos, dockpulp_task_info):
+        monkeypatch.setattr(module.AnsibleModule, "exit_json", exit_json)
+        monkeypatch.setattr(module.AnsibleModule, "fail_json", fail_json)
+    yield
+    dockpulp_http.SESSIONS.clear()
+    dockpulp_backend.BACKENDS.clear()
+    dockpulp_common.LOGGED_IN["qa"] = False
+
+
+@pytest.fixture
+def server():
+    with FakePulpServer(repos=3, task_duration=0.3) as server:
+        yield server
+
+
+def run(module, **params):
+    """Run a module like a new module process"""
+    dockpulp_backend.BACKENDS.clear()
+    dockpulp_common.LOGGED_IN["qa"] = False
+    set_module_args(dict(PARAMS, **params))
+    with pytest.raises((AnsibleExitJson, AnsibleFailJson)) as ex:
+        module.main()
+    return ex.value.args[0]
+
+
+def test_submit_then_collect(server):
+    """test the updates return their task ids without wait, checked later"""
+    http = {"url": server.url}
+    result = run(dockpulp_repos, repos=REPOS, backend="rest", http=http, wait=False)
+    assert not result.get("failed")
+    task_ids = [task_id for repo in result["results"] for task_id in repo["task_ids"]]
+    assert len(task_ids) == 3
+
+    result = run(dockpulp_task_info, task_ids=task_ids, http=http)
+    assert result["finished"] is False
+    assert {task["state"] for task in result["tasks"]} == {"running"}
+
+    result = run(dockpulp_task_info, task_ids=task_ids, http=http, wait=True)
+    assert result["finished"] is True
+    assert [task["task_id"] for task in result["tasks"]] == task_ids
+    assert {task["state"] for task in result["tasks"]} == {"finished"}
+
+
+def test_wait_failed_task(server, monkeypatch):
+    """test a repo fails when its Pulp task fails"""
+    spawn_task = server.state.spawn_task
+    monkeypatch.setattr(server.state, "spawn_task", lambda error=None: spawn_task("boom"))
+    http = {"url": server.url}
+    result = run(dockpulp_repos, repos=REPOS[:1], backend="rest", http=http)
+    assert result["failed"]
+    (repo,) = result["results"]
+    assert repo["returncode"] == 1
+    assert repo["msg"] == "The task %s of redhat-seed-repo-000000 is error: boom" % (
+        repo["task_ids"][0]
+    )
+
+    result = run(dockpulp_task_info, task_ids=repo["task_ids"] + ["task-0"], http=http)
+    assert result["msg"] == "Pulp tasks failed: %s, task-0" % repo["task_ids"][0]
+    assert [task["state"] for task in result["tasks"]] == ["error", "missing"]
+
+
+def test_wait_timeout(server):
+    """test a repo fails when its Pulp task is still running at the timeout"""
+    server.state.task_duration = 60
+    result = run(
+        dockpulp_repos, repos=REPOS[:1], backend="rest", http={"url": server.url}, wait_timeout=1
+    )
+    (repo,) = result["results"]
+    assert repo["msg"].endswith("is still running after 1 seconds")